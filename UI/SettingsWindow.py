@@ -3,12 +3,14 @@ This module defines the dialog window for selecting channels in the Cells Calcul
 """
 import os
 import traceback
-import tifffile
+import numpy as np
 from PyQt5.QtWidgets import QGraphicsPixmapItem,\
         QMessageBox, QPushButton, QGraphicsView, QMainWindow, QGraphicsView, QGraphicsScene, \
                 QVBoxLayout, QWidget, QGraphicsTextItem, QComboBox, QLabel, QHBoxLayout
 from PyQt5.QtGui import QPixmap, QImage
 
+from model.lsm import get_lsm_reader, to_uint8
+
 
 def has_duplicates(lst):
     """
@@ -276,7 +278,7 @@ class SettingsWindow(QMainWindow):
 
         Note:
         - This method clears the scene.
-        - It reads the LSM file using tifffile.
+        - It reads the LSM file channel by channel through the cached reader.
         - It determines the number of channels in the LSM file.
         - If combo_box_dict is not None, it adjusts the combo box items based on the number of channels.
         - It calculates image dimensions for display on the screen.
@@ -284,9 +286,8 @@ class SettingsWindow(QMainWindow):
         - It adds a text item "Channel X" below each image.
         """
         self.scene.clear()
-        with tifffile.TiffFile(self.lsm_path) as tif:
-            lsm = tif.pages[0].asarray()
-        self.num_channels = lsm.shape[0]
+        reader = get_lsm_reader(self.lsm_path)
+        self.num_channels = reader.num_channels
         if self.combo_box_dict:
             options = list(self.parametrs.keys())
             for option in options:
@@ -300,8 +301,10 @@ class SettingsWindow(QMainWindow):
         image_height = int(self.parent_height * 0.75 / 2)
 
         for i in range(self.num_channels):
+            channel = np.ascontiguousarray(to_uint8(reader.channel(i)))
             pixmap = QPixmap.fromImage(
-                QImage(lsm[i], lsm.shape[1], lsm.shape[2], QImage.Format_Grayscale8))
+                QImage(channel.data, channel.shape[1], channel.shape[0], channel.strides[0],
+                       QImage.Format_Grayscale8))
             pixmap_item = QGraphicsPixmapItem(pixmap)
             current_image_height = (i // 2) * (image_height + 40)
             pixmap_item.setPos((i % 2) * image_width, current_image_height)
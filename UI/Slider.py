@@ -24,9 +24,16 @@ class Slider(QWidget):
     """
     Class for filtering sliders in the right layout menu.
     """
-    def __init__(self, object_size : dict, default_object_size : dict, key : str): 
+    def __init__(self, object_size : dict, default_object_size : dict, key : str, on_change=None):
+        """
+        on_change is called without arguments when the user changes the value,
+        e.g. for re-filtering the detections without running the model again.
+        It is not called when the value is reset programmatically by change_default() or set_default().
+        """
         self.object_size = object_size
         self.key = key
+        self.on_change = on_change
+        self.silent = False
         self.round_parametr_slider = object_size['round_parametr_slider']
         self.round_parametr_value_input = object_size['round_parametr_value_input']
         self.default_object_size = default_object_size
@@ -45,7 +52,15 @@ class Slider(QWidget):
         value = self.default_object_size[self.key]
         self.object_size[self.key] = value
         self.value_input.setText(str(f'{value * self.round_parametr_value_input:.2f}'))
-        self.value_slider.setValue(int (value * self.round_parametr_slider))
+        self.silent = True
+        try:
+            self.value_slider.setValue(int (value * self.round_parametr_slider))
+        finally:
+            self.silent = False
+
+    def notify_change(self, previous_value):
+        if self.on_change is not None and not self.silent and self.object_size[self.key] != previous_value:
+            self.on_change()
 
     def initUI(self):
         # Переменная для хранения значения
@@ -99,6 +114,7 @@ class Slider(QWidget):
         min_size = self.default_object_size['min_size']
         max_size = self.default_object_size['max_size']
 
+        previous_value = self.object_size[self.key]
         value = self.value_slider.value() / self.round_parametr_slider
         # Проверяем значение на корректность, если вне диапазона — устанавливаем границы
         if self.key == 'min_size' and value > self.object_size['max_size']:
@@ -109,14 +125,16 @@ class Slider(QWidget):
             value = min_size
         elif value > max_size:
             value = max_size 
-        self.value_slider.setValue(int(value * self.round_parametr_slider))
         self.object_size[self.key] = value
+        self.value_slider.setValue(int(value * self.round_parametr_slider))
         self.value_input.setText(str(f'{value * self.round_parametr_value_input:.2f}'))
+        self.notify_change(previous_value)
 
     def update_value_from_input(self):
         # Обновляем переменную и слайдер при изменении значения в QLineEdit
         min_size = self.default_object_size['min_size']
         max_size = self.default_object_size['max_size']
+        previous_value = self.object_size[self.key]
         try:
             value = float(self.value_input.text()) / self.round_parametr_value_input
             # Проверяем значение на корректность, если вне диапазона — устанавливаем границы
@@ -130,8 +148,14 @@ class Slider(QWidget):
                 value = max_size
 
             self.object_size[self.key] = value
-            self.value_slider.setValue(int(value * self.round_parametr_slider))
+            # the slider echoes the new value back, it is notified once below
+            self.silent = True
+            try:
+                self.value_slider.setValue(int(value * self.round_parametr_slider))
+            finally:
+                self.silent = False
             self.value_input.setText(str(f'{value * self.round_parametr_value_input:.2f}'))
+            self.notify_change(previous_value)
         except ValueError:
 
             self.value_input.setText(str(f'{self.object_size[self.key] * self.round_parametr_value_input:.2f}'))
@@ -37,6 +37,10 @@ class menubar(QMenuBar):
         self.settings_action.triggered.connect(self.open_settings)
         settings_menu.addAction(self.settings_action)
 
+        self.clear_cache_action = QAction("Clear Inference Cache", self)
+        self.clear_cache_action.triggered.connect(self.clear_cache)
+        settings_menu.addAction(self.clear_cache_action)
+
         self.plugin_actions = {}
 
         # Добавляем плагины в меню
@@ -118,5 +122,8 @@ class menubar(QMenuBar):
     def open_settings(self):
         self.menubar_signal.emit("open_settings", None)
 
+    def clear_cache(self):
+        self.menubar_signal.emit("clear_cache", None)
+
     def save_as(self):
         self.menubar_signal.emit("save_as", None)
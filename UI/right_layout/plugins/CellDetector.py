@@ -1,13 +1,15 @@
 import os
 import traceback
+import numpy as np
 from PyQt5.QtWidgets import QCheckBox, QPushButton, QGraphicsView, QGraphicsView, QGraphicsScene,\
-    QGraphicsTextItem, QComboBox, QLabel
+    QGraphicsTextItem, QComboBox, QLabel, QFileDialog
 from PyQt5.QtGui import QFont
 from PyQt5.QtCore import Qt
 
 from UI.Slider import Slider
 from UI.right_layout.plugins.BasePlagin import BasePlugin
-from model.Model import Model
+from model.pool import MODEL_POOL
+from model.utils import export_detections
 from errorhandling import app_logger
 
 class CellDetector(BasePlugin):
@@ -21,10 +23,7 @@ class CellDetector(BasePlugin):
         self.plugin_signal.emit("Settings", False)
         self.plugin_signal.emit("Save_as", False)
         currentModel = self.combo_box.currentText()
-        self.model = Model(path=arg[-1][currentModel]['path'],
-                           object_size=arg[-1][currentModel]['object_size'],
-                           model_type = arg[-1][currentModel]['model_type']
-                           )
+        self.acquire_model(currentModel)
 
     def init_value(self, parent, parametrs, object_size, default_object_size, models):
         self.show_boundry = 0
@@ -35,10 +34,14 @@ class CellDetector(BasePlugin):
         self.default_object_size = default_object_size
         self.right_layout = parent
         self.lsm_filesList = None
+        self.result = None
+        self.model = None
 
     def handle_action(self, action_name, value):
         if action_name == "reset_detection":
             self.reset_detection()
+        elif action_name == "save_as":
+            self.save_as()
         elif action_name == "set_size":
             self.set_size(value)
         elif action_name == "open_lsm":
@@ -89,6 +92,7 @@ class CellDetector(BasePlugin):
 
     def update_colormap(self, colormap):
         self.object_size["color_map"] = colormap
+        self.refilter_result(colormap=colormap)
     # def update_lineWidth(self):
     #     # Получаем значение из QLineEdit
     #     input_text = self.LineWidth_edit.text()
@@ -106,23 +110,60 @@ class CellDetector(BasePlugin):
     #         size = self.object_size["line_width"]
     #         self.LineWidth_edit.setText(f"{size:.2f}") 
 
+    def acquire_model(self, model_name):
+        """
+        Takes the model for the given modelconfig.json entry from the warm model pool.
+        A model coming back from the pool may still keep detections of another image, so they are dropped.
+        """
+        model = MODEL_POOL.get(model_name, self.models[model_name])
+        if model is not self.model:
+            model.cell_counter.clear_cached_detections()
+        self.model = model
+        return model
+
     def reset_detection(self):
+        self.result = None
+        self.plugin_signal.emit("Save_as", False)
         try:
             self.model.cell_counter.detections = None
         except:
             pass
 
-    def set_size(self, detection, img_size : tuple = (512,512)):
+    def save_as(self):
+        """
+        Exports the image with detections and the table of detections to the file chosen by the user.
+        This is the only place where the results of a single image calculation are written to disk.
+        """
+        prediction_image = None
+        if self.model is not None and self.result:
+            prediction_image = self.model.cell_counter.prediction_image
+        if prediction_image is None:
+            self.plugin_signal.emit("show_warning", "Warning\n\nNothing to save. Calculate the image first.")
+            return
+        file_path, _ = QFileDialog.getSaveFileName(
+            caption="Save As",
+            directory="",
+            filter="Image Files (*.png *.jpg *.bmp)",
+        )
+        if not file_path:
+            return
+        if not file_path.lower().endswith(('.png', '.jpg', '.bmp')):
+            file_path += '.png'
+        try:
+            export_detections(prediction_image, self.result["Cells"], file_path)
+        except Exception as e:
+            traceback.print_exc()
+            app_logger().error(e)
+            self.plugin_signal.emit("show_warning", f"Error during saving:{e}")
+
+    def set_size(self, box_areas):
+        """Sets up the filtering sliders given relative areas of detected boxes (Detections.box_areas())."""
         min_size, max_size = self.default_object_size["min_size"], self.default_object_size["max_size"]
         model = self.combo_box.currentText()
-        if all(len(cell) >= 4 for cell in detection):
-            img_sq = img_size[0] * img_size[1]
-            # Вычисляем произведения для каждого 
-            values = [cell[2] * cell[3] for cell in detection] 
-
+        if len(box_areas) > 0:
             # Находим максимальное и минимальное произведение
-            min_size_from_detection = min(values) / img_sq
-            max_size_from_detection = max(values) / img_sq
+            min_size_from_detection = float(np.min(box_areas))
+            max_size_from_detection = float(np.max(box_areas))
             if self.lsm_filesList or model != "All_models":
                 if min_size_from_detection >= min_size:
                     min_size = None
@@ -183,51 +224,28 @@ class CellDetector(BasePlugin):
             self.button.setEnabled(False)
             self.button.repaint()
             try:
-                # Attempt to calculate the result using the selected method
-                if self.model and (self.models[model]['path'] == self.model.path):
-                    # result = self.models[model].calculate(
-                    #     img_path=self.lsm_path, cell_channel=self.parametrs['Cell'],\
-                    #         nuclei_channel=self.parametrs['Nuclei'])
-                    result = self.model.calculate(
-                        img_path=self.lsm_path, cell_channel=self.parametrs['Cell'],\
-                            nuclei_channel=self.parametrs['Nuclei'])
-                else:
-                    if self.model:
-                        del self.model
-                        self.model = None
-                    self.model = Model(path=self.models[model]['path'],
-                                    object_size=self.models[model]['object_size'],
-                                    model_type=self.models[model]['model_type']
-                                    )
-                    result = self.model.calculate(
-                        img_path=self.lsm_path, cell_channel=self.parametrs['Cell'],\
-                            nuclei_channel=self.parametrs['Nuclei'])
+                # Attempt to calculate the result using the selected method,
+                # recently used models are kept warm in the model pool
+                self.acquire_model(model)
+                result = self.model.calculate(
+                    img_path=self.lsm_path, cell_channel=self.parametrs['Cell'],\
+                        nuclei_channel=self.parametrs['Nuclei'])
             except  Exception as e:
                 traceback.print_exc()
                 app_logger().error(e)
                 try:
                     # If an error occurs, try without channel information
-                    if self.models[model]['path'] == self.model.path:
-                        # result = self.models[model].calculate(img_path=self.lsm_path)
-                        result = self.model.calculate(img_path=self.lsm_path)
-                    else:
-                        del self.model
-                        self.model = None
-                        a_path = self.models[model]['path']
-                        self.model = Model(path=a_path,
-                                        object_size=self.models[model]['object_size'],
-                                        model_type=self.models[model]['model_type'])
-                        result = self.model.calculate(img_path=self.lsm_path)
+                    self.acquire_model(model)
+                    result = self.model.calculate(img_path=self.lsm_path)
                 except  Exception as e:
                     traceback.print_exc()
                     app_logger().error(e)
                     # If still not successful, show an error dialog
                     self.plugin_signal.emit("show_warning", f"Error during calculation:{e} \n\nChoose another model or change channels settings")
                     result = None
-                    if self.model:
-                        del self.model
-                        self.model = None
-                    # clear the model so it can be restarted 
+                    # drop the model from the pool so it can be restarted
+                    MODEL_POOL.remove(model, self.models[model])
+                    self.model = None
                     self.draw_bounding = 0
         finally:
             self.button.setText("Calculate")
@@ -238,6 +256,9 @@ class CellDetector(BasePlugin):
         if not result:
             return 0
 
+        self.result = result
+        self.plugin_signal.emit("Save_as", True)
+
         # Create QGraphicsTextItems to display the results
         self.right_scene.clear()
         self.print_result(result)
@@ -248,6 +269,24 @@ class CellDetector(BasePlugin):
         # Draw bounding boxes
         self.draw_bounding_box()
 
+    def refilter_result(self, **render_params):
+        """
+        Updates the result and the image with detections after the filtering sliders were moved
+        or the colormap was changed. The detections of the current image are only re-filtered
+        and redrawn, the model is not run again.
+        """
+        if not self.result or self.model is None:
+            return
+        try:
+            self.result = self.model.refilter(self.result, **render_params)
+        except Exception as e:
+            traceback.print_exc()
+            app_logger().error(e)
+            return
+        self.right_scene.clear()
+        self.print_result(self.result)
+        self.draw_bounding_box()
+
     def print_result(self, result):
         model = self.combo_box.currentText()
         if model == "Detector":
@@ -267,8 +306,8 @@ class CellDetector(BasePlugin):
             boxes = result["Cells"]["box"]
 
             # Извлечение длины и ширины (второй и третий элемент в массивах)
-            lengths = boxes.apply(lambda x: x[2])
-            widths = boxes.apply(lambda x: x[3])
+            lengths = boxes[:, 2]
+            widths = boxes[:, 3]
 
             img_area = self.model.cell_counter.original_image.shape[0] * self.model.cell_counter.original_image.shape[0]
 
@@ -392,9 +431,12 @@ class CellDetector(BasePlugin):
 
         try:
             # Check if the show boundary flag is set
-            if self.show_boundry:
+            prediction_image = None
+            if self.model is not None:
+                prediction_image = self.model.cell_counter.prediction_image
+            if self.show_boundry and prediction_image is not None:
                 # If set, add an image with bounding box detections to the scene
-                self.plugin_signal.emit("add_image", ".cache\cell_tmp_img_with_detections.png" )
+                self.plugin_signal.emit("add_image", prediction_image)
             else:
                 # If not set, add the original image to the scene
                 self.plugin_signal.emit("add_image", self.lsm_path)
@@ -510,8 +552,10 @@ class CellDetector(BasePlugin):
         range_lable.setFont(font)
 
         #self.right_layout.addSpacing(1)
-        self.min_range_slider = Slider(self.object_size, self.default_object_size, 'min_size')
-        self.max_range_slider = Slider(self.object_size, self.default_object_size, 'max_size')
+        self.min_range_slider = Slider(self.object_size, self.default_object_size, 'min_size',
+                                       on_change=self.refilter_result)
+        self.max_range_slider = Slider(self.object_size, self.default_object_size, 'max_size',
+                                       on_change=self.refilter_result)
 
         # LineWidth_label = QLabel("Line Width:")
         # LineWidth_label.setFont(QFont("Arial", 16))
@@ -1,5 +1,6 @@
 import os
 import traceback
+import numpy as np
 from PyQt5.QtWidgets import QLabel, QPushButton, QGraphicsView, QGraphicsView, QGraphicsScene, \
     QGraphicsTextItem, QComboBox, QPushButton, QGraphicsView, QCheckBox
 from PyQt5.QtGui import QFont
@@ -111,17 +112,14 @@ class SpheroidSegmenter(BasePlugin):
         for key, model in self.models.items():
             model.cell_counter.detections = None
 
-    def set_size(self, detection, img_size : tuple = (512,512)):
+    def set_size(self, box_areas):
+        """Sets up the filtering sliders given relative areas of detected boxes (Detections.box_areas())."""
         min_size, max_size = self.default_object_size["min_size"], self.default_object_size["max_size"]
         model = self.combo_box.currentText()
-        if all(len(cell) >= 4 for cell in detection):
-            img_sq = img_size[0] * img_size[1]
-            # Вычисляем произведения для каждого 
-            values = [cell[2] * cell[3] for cell in detection] 
-
+        if len(box_areas) > 0:
             # Находим максимальное и минимальное произведение
-            min_size_from_detection = min(values) / img_sq
-            max_size_from_detection = max(values) / img_sq
+            min_size_from_detection = float(np.min(box_areas))
+            max_size_from_detection = float(np.max(box_areas))
             if self.lsm_filesList or model != "All_models":
                 if min_size_from_detection >= min_size:
                     min_size = None
@@ -268,9 +266,11 @@ class SpheroidSegmenter(BasePlugin):
         # Clear the main scene
         try:
             # Check if the show boundary flag is set
-            if self.show_boundry:
+            model = self.models.get(self.combo_box.currentText())
+            prediction_image = model.cell_counter.prediction_image if model else None
+            if self.show_boundry and prediction_image is not None:
                 # If set, add an image with bounding box detections to the scene
-                self.plugin_signal.emit("add_image", ".cache\cell_tmp_img_with_detections.png" )
+                self.plugin_signal.emit("add_image", prediction_image)
             else:
                 # If not set, add the original image to the scene
                 self.plugin_signal.emit("add_image", self.lsm_path)
@@ -5,7 +5,6 @@ from PyQt5.QtWidgets import QPushButton, QGraphicsView, QMessageBox, QGraphicsVi
 from PyQt5.QtGui import QFont
 from PyQt5.QtCore import Qt
 
-from model.tracker import Tracker as T
 
 from UI.right_layout.plugins.BasePlagin import BasePlugin
 from UI.Slider import Slider
@@ -28,6 +27,8 @@ class Tracker(BasePlugin):
     def init_value(self, parent, parametrs, object_size, default_object_size, models):
         self.models = models
         default_model = models[list(models.keys())[0]]
+        # the tracker pulls in ultralytics, so it is imported only when the plugin is opened
+        from model.tracker import Tracker as T
         self.model = T(default_model['path'], default_model['size'])
         self.parametrs = parametrs
         self.object_size = object_size
@@ -128,6 +129,7 @@ class Tracker(BasePlugin):
                 text_to_show ="""Success!"""
                 self.show_result(text_to_show)
             else:
+                from model.tracker import Tracker as T
                 self.model = T(path=self.models[model]['path'],
                                      size=self.models[model]['object_size'])
                 self.model.track(img_seq_folder=self.folder_path, time_period = 15)
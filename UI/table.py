@@ -2,7 +2,6 @@
 This module defines the function to calculate a table based on certain methods applied to image files.
 """
 import os
-import pandas as pd
 
 
 def calculate_table(model_dict: dict, files_name: list, parametrs: dict):
@@ -17,6 +16,7 @@ def calculate_table(model_dict: dict, files_name: list, parametrs: dict):
     Returns:
     DataFrame: A pandas DataFrame representing the calculated table.
     """
+    import pandas as pd
     # Convert single file name string to a list
     if isinstance(files_name, str): 
         files_name = [files_name]
@@ -2,15 +2,17 @@
 This module defines the MainWindow class for the Cells Calculator application.
 The application is designed to open, process, and analyze cell images.
 """
+import time
+# measured before any other import, so that the startup report covers the import time as well
+STARTUP_TIME = time.perf_counter()
 import sys
 import os
-import shutil
 import traceback
 from PyQt5.QtWidgets import QAbstractItemView, QMessageBox, QTableWidget, QTableWidgetItem, \
      QGraphicsView, QApplication, QMainWindow, QGraphicsView, QGraphicsScene, QWidget, QHBoxLayout
 from PyQt5.QtGui import QPixmap, QImage
 from PyQt5.QtCore import pyqtSignal, pyqtSlot, Qt
-import tifffile
+import numpy as np
 from UI.SettingsWindow import SettingsWindow
 from UI.table import calculate_table
 from UI.right_layout.right_layout import right_layout
@@ -18,8 +20,27 @@ from UI.menubar import menubar
 from UI.right_layout.plugins.CellDetector import CellDetector as CellDetector_plugin
 from UI.right_layout.plugins.tracker import Tracker as Tracker_plugin
 from model.utils import COLOR_NUMBER as color_number
+from model.lsm import get_lsm_reader, to_uint8
+from model.cache import INFERENCE_CACHE
 import json
 
+IMPORT_DURATION = time.perf_counter() - STARTUP_TIME
+# frameworks of the model backends, which are expected to be loaded only on the first use of a model
+HEAVY_MODULES = ["torch", "ultralytics", "tensorflow", "cellpose", "stardist", "csbdeep",
+                 "instanseg", "matplotlib", "pandas", "sklearn", "onnxruntime"]
+
+
+def startup_report():
+    """
+    Prints the time spent on startup of the application, split into imports and window creation,
+    and lists the heavy frameworks which were loaded before the first model was used.
+    """
+    total_duration = time.perf_counter() - STARTUP_TIME
+    loaded = [name for name in HEAVY_MODULES if name in sys.modules]
+    print(f"Startup finished in {total_duration:.2f} seconds "
+          f"(imports: {IMPORT_DURATION:.2f} s, window: {total_duration - IMPORT_DURATION:.2f} s)")
+    print(f"Heavy frameworks loaded on startup: {', '.join(loaded) if loaded else 'none'}")
+
 
 class MainWindow(QMainWindow):
     """
@@ -36,13 +57,8 @@ class MainWindow(QMainWindow):
         This method sets up the initial state of the main window.
         """
         super().__init__()
-        # Add cache directory creation
-        try:
-            # Remove the existing cache directory if it exists
-            shutil.rmtree('.cache', ignore_errors=True)  # Ignore errors if directory is empty
-        except OSError as e:
-            pass
-        # Create a new cache directory if it doesn't exist
+        # Create the cache directory if it doesn't exist. The cache is persistent between launches,
+        # so that the inference results of already processed images are reused
         os.makedirs('.cache', exist_ok=True)
 
         # Get desktop information
@@ -87,6 +103,8 @@ class MainWindow(QMainWindow):
             self.open_folder(value)
         elif action_name == "open_settings":
             self.open_settings()
+        elif action_name == "clear_cache":
+            INFERENCE_CACHE.clear()
 
         elif action_name == "show_warning":
             self.show_warning_dialog(value)
@@ -364,8 +382,8 @@ class MainWindow(QMainWindow):
         
         Args:
         lsm_file (str or numpy.ndarray): Path to the image file or a numpy array representing an image.
-            If it's a string (file path), it opens the image file. If it's a numpy array, it assumes
-            it represents an image.
+            If it's a string (file path), it opens the image file. If it's a numpy array, it is either
+            (H, W, 3) BGR image rendered by the model or (C, H, W) LSM image.
 
         Notes:
         If lsm_file is a string (file path), it creates a QImage from the file path.
@@ -375,17 +393,23 @@ class MainWindow(QMainWindow):
 
         if isinstance(lsm_file, str) and not lsm_file.endswith(".lsm"):
             image = QImage(lsm_file)
-        elif isinstance(lsm_file, str):
-            with tifffile.TiffFile(lsm_file) as tif:
-                # Read the first page of the LSM file as an array
-                lsm_file = tif.pages[0].asarray()
-            image = QImage(lsm_file[self.parametrs['Cell']], lsm_file.shape[1],
-                        lsm_file.shape[2], QImage.Format_Grayscale8)
+        elif isinstance(lsm_file, np.ndarray) and lsm_file.ndim == 3 and lsm_file.shape[2] == 3:
+            # BGR image rendered by the model, e.g. the image with detections
+            rgb = np.ascontiguousarray(lsm_file[:, :, ::-1])
+            image = QImage(rgb.data, rgb.shape[1], rgb.shape[0], rgb.strides[0],
+                           QImage.Format_RGB888)
         else:
-            # If it's not a string, assume it's a numpy array representing an image
-            # and create a QImage from it with grayscale format
-            image = QImage(lsm_file[self.parametrs['Cell']], lsm_file.shape[1],
-                        lsm_file.shape[2], QImage.Format_Grayscale8)
+            if isinstance(lsm_file, str):
+                # only the displayed channel is read from the LSM file
+                channel = get_lsm_reader(lsm_file).channel(self.parametrs['Cell'])
+            elif lsm_file.ndim == 2:
+                channel = lsm_file
+            else:
+                # (C, H, W) LSM image
+                channel = lsm_file[self.parametrs['Cell']]
+            channel = np.ascontiguousarray(to_uint8(channel))
+            image = QImage(channel.data, channel.shape[1], channel.shape[0], channel.strides[0],
+                           QImage.Format_Grayscale8)
 
         # Convert the QImage to a QPixmap
         pixmap = QPixmap.fromImage(image)
@@ -434,16 +458,11 @@ class MainWindow(QMainWindow):
                     a warning dialog is shown to notify the user about the error.
         """
         try:
-            # Attempt to open the LSM file using tifffile
-            with tifffile.TiffFile(self.lsm_path) as tif:
-                # Read the first page of the LSM file as an array
-                lsm_file = tif.pages[0].asarray()
-
             # Clear the main scene
             self.main_scene.clear()
 
-            # Add the new image to the scene
-            self.add_image(lsm_file)
+            # Add the new image to the scene, the LSM file is read through the cached reader
+            self.add_image(self.lsm_path)
         except Exception as e:
             traceback.print_exc()
             # If an error occurs, show a warning dialog
@@ -513,25 +532,23 @@ class MainWindow(QMainWindow):
         self.main_scene.clear()
         # Reset the file list
         try:
-            # Attempt to open the LSM file using tifffile
-            with tifffile.TiffFile(self.lsm_path) as tif:
-                # Read the first page of the LSM file as an array
-                lsm_file = tif.pages[0].asarray()
+            # Open the LSM file, only its header is read here
+            num_channels = get_lsm_reader(self.lsm_path).num_channels
 
             # Check if the number of channels in the LSM file is less than the maximum channel index specified in parameters
-            if lsm_file.shape[0] < max([value+1 for key, value in self.parametrs.items()]):
+            if num_channels < max([value+1 for key, value in self.parametrs.items()]):
                 # If so, reset the parameters to default
                 self.parametrs['Cell'] = 0
                 self.parametrs['Nuclei'] = 1
 
             # Check if the number of channels in the LSM file is less than or equal to 1
-            if lsm_file.shape[0] <= 1:
+            if num_channels <= 1:
                 # If so, show a warning dialog and return
                 self.show_warning_dialog("File is wrong\n\nAmount of Channel less than 2")
                 return
 
             # Add the LSM file image to the scene and set the window title
-            self.add_image(lsm_file)
+            self.add_image(self.lsm_path)
             self.setWindowTitle(
                 f"Cells Calculator - {os.path.basename(lsm_path)}")
         except Exception as e:
@@ -600,6 +617,7 @@ if __name__ == '__main__':
         # Attempt to create and show the main window
         window = MainWindow()
         window.showMaximized()
+        startup_report()
         # Start the application event loop
         sys.exit(app.exec_())
 
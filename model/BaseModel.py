@@ -4,7 +4,12 @@ We define both the structure and the main functionality utils.
 """
 import os
 from pathlib import Path
-import shutil
+
+import cv2
+
+from model.utils import load_image_bgr
+from model.overlay import LabelOverlay
+from model.cache import INFERENCE_CACHE
 
 OUT_DIR = Path("cellprocesser_output")
 
@@ -13,6 +18,9 @@ class BaseModel():
     Base class for general YOLO instance models.
     Implements the neccessary high-level functional utils for using the model.
     """
+    # whether the detections are filtered by the size sliders (object_size['min_size'/'max_size'])
+    filter_by_size = True
+
     def __init__(self, path_to_model: str, object_size):
         """
         Model constructor. Slightly differs for detectors and segmenters.
@@ -27,6 +35,11 @@ class BaseModel():
         self.original_image = None
         self.prediction_image = None
         self.detections = None
+        # state of the last rendering, reused by self.refilter()
+        self.display_image = None
+        self.min_score = 0.0
+        self.render_params = {}
+        self.overlay = None
         self.out_dir = OUT_DIR
         os.makedirs(OUT_DIR, exist_ok=True)
         self.inference_duration = 0
@@ -59,33 +72,56 @@ class BaseModel():
         """
         pass
 
-    def count_cells(self, img_path):
+    def count_cells(self, img):
         """
         By calling this method, the model class instance calculates cells on a given image.
         This method fully relies on the self.count() method.
-        The input param is the path to RGB image of cells.
+        The input param is the path to image of cells or the image itself as BGR np.array.
+        The image is decoded only once and then passed to the model in memory.
         The output param is optimized count of cells.
         """
-        dst = os.path.join('.cache', 'cell_tmp_img.png')
-        shutil.copy2(img_path, dst)
-        detections = self.count(dst)
+        detections = self.count(load_image_bgr(img))
         if detections is None:
             return 0
         return detections
 
-    def count(self, input_image, scale: int = 20,
-              filename=".cache/cell_tmp_img_with_detections.png"):
-        """General method for processing microimages of cells."""
+    def cache_params(self) -> dict:
+        """
+        Returns the inference params of the model, which are a part of the key of cached detections.
+        Each backend extends it with all the params affecting its detections, so that changing
+        any of them leads to a new inference instead of the stale cached detections.
+        """
+        return {"model": type(self).__name__}
+
+    def count(self, input_image, scale: int = 20, filename=None, **kwargs):
+        """
+        General method for processing microimages of cells.
+        The image with detections is kept in self.prediction_image and written
+        to the given filename only if the filename is given.
+        The detections are taken from the persistent inference cache when the same image was
+        already processed by the same model with the same params, see model.cache.
+        The additional **kwargs are passed to self.count_x20() / self.count_x10()
+        and are a part of the cache key as well.
+        """
 
         scale = self.object_size["scale"]
         assert scale in [10, 20], f"Scale must be either 10 or 20, instead received scale {scale}"
         import time
         start_time = time.time()
+        cache_params = self.cache_params()
+        if kwargs:
+            cache_params["kwargs"] = kwargs
+        cache_key = INFERENCE_CACHE.make_key(input_image, self.path_to_model, scale, cache_params)
+        # the models run the inference only if self.detections is None
+        self.detections = INFERENCE_CACHE.get(cache_key)
+        cache_hit = self.detections is not None
         result = None
         if scale == 20:
-            result =  self.count_x20(input_image, filename=filename)
+            result =  self.count_x20(input_image, filename=filename, **kwargs)
         else:
-            result =  self.count_x10(input_image, filename=filename)
+            result =  self.count_x10(input_image, filename=filename, **kwargs)
+        if not cache_hit and self.detections is not None:
+            INFERENCE_CACHE.put(cache_key, self.detections)
         end_time = time.time()
         self.inference_duration = end_time - start_time
         return result
@@ -98,6 +134,74 @@ class BaseModel():
         """Method for processing images of x20 scale using single-time inference, as usual."""
         raise NotImplementedError
 
+    def set_render_state(self, display_image, min_score: float = 0.0, **render_params):
+        """
+        Remembers how the detections of the current image are filtered and drawn,
+        so that self.refilter() can repeat it without running the inference.
+
+        Input params:
+        - display_image: np.array - the image the detections are drawn on;
+        - min_score: float - minimal confidence of the detections to be kept;
+        - **render_params: additional params of self.render(), e.g. colormap and alpha.
+        """
+        self.display_image = display_image
+        self.min_score = min_score
+        self.render_params = render_params
+
+    def render(self, visible, filename=None):
+        """
+        Draws the visible detections on the copy of the display image.
+        All the detections of the image are rasterized only once, see model.overlay.LabelOverlay,
+        so redrawing them with another filtering or colormap is a single lookup-table pass.
+        The result is saved to disk only if filename is given.
+        Detectors without masks should override it.
+
+        Input params:
+        - visible: np.array of bool - which of self.detections are drawn;
+        - filename: path for saving the image with detections. Nothing is saved if None.
+
+        Returns:
+        - np.array - BGR image with detections.
+        """
+        if (self.overlay is None or self.overlay.detections is not self.detections
+                or self.overlay.image is not self.display_image):
+            self.overlay = LabelOverlay(self.display_image, self.detections)
+        image = self.overlay.render(visible, **self.render_params)
+        if filename is not None:
+            cv2.imwrite(filename, image)
+        return image
+
+    def refilter(self, min_score: float = None, filename=None, plot: bool = True,
+                 filter_by_size: bool = None, **render_params):
+        """
+        Filters the detections of the last processed image by score and by the current size sliders
+        and redraws self.prediction_image, without running the inference again.
+        Used when the filtering params change while the image stays the same.
+
+        Input params:
+        - min_score: float - new minimal confidence. Default to the one used by the last self.count();
+        - filename: path for saving the image with detections. Nothing is saved if None;
+        - plot: bool - whether to redraw self.prediction_image;
+        - filter_by_size: bool - whether to apply the size sliders. Default to self.filter_by_size;
+        - **render_params: new params of self.render(), e.g. colormap and alpha.
+
+        Returns:
+        - filtered Detections, or None if no image was processed yet.
+        """
+        if self.detections is None or self.display_image is None:
+            return None
+        if min_score is not None:
+            self.min_score = min_score
+        self.render_params.update(render_params)
+        if filter_by_size is None:
+            filter_by_size = self.filter_by_size
+        visible = self.detections.confidence >= self.min_score
+        if filter_by_size:
+            areas = self.detections.box_areas()
+            visible &= (areas >= self.object_size['min_size']) & (areas <= self.object_size['max_size'])
+        self.prediction_image = self.render(visible, filename) if plot else None
+        return self.detections.subset(visible)
+
     def clear_cached_detections(self):
         """Resets cached detections of needed."""
         self.detections = None
@@ -1,6 +1,7 @@
 """
 In this module the CellCounter class is defined which is used
 to calculate cells on a given contrast microimage.
+The ONNX detector runs on ONNX Runtime when it is installed, otherwise on OpenCV DNN module.
 """
 
 import os
@@ -8,7 +9,22 @@ import cv2
 import numpy as np
 import pandas as pd
 from model.BaseModel import BaseModel
-from model.utils import draw_bounding_box, filter_detections
+from model.detections import Detections
+from model.utils import draw_bounding_box, load_image_bgr
+
+try:
+    import onnxruntime as ort
+except ImportError:
+    ort = None
+
+INPUT_SIZE = 512
+# minimal class score of the anchors kept before NMS
+SCORE_THRESHOLD = 0.2  # originally >= .25
+NMS_SCORE_THRESHOLD = 0.25
+NMS_IOU_THRESHOLD = 0.6
+# number of intra-op threads of ONNX Runtime, None for the number of physical cores.
+# The batch engine lowers it, so that the worker processes do not oversubscribe the CPU
+INTRA_OP_THREADS = None
 
 CLASSES = ['Cell']
 colors = np.random.uniform(0, 255, size=(len(CLASSES), 3))
@@ -29,15 +45,71 @@ class CellCounter(BaseModel):
     #     super().__init__(path, object_size)
 
     def init_x20_model(self, path_to_model: str):
-        self.model = cv2.dnn.readNetFromONNX(path_to_model)
+        if ort is not None:
+            options = ort.SessionOptions()
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+            options.intra_op_num_threads = INTRA_OP_THREADS or max(1, (os.cpu_count() or 2) // 2)
+            options.inter_op_num_threads = 1
+            self.model = ort.InferenceSession(path_to_model, sess_options=options,
+                                              providers=["CPUExecutionProvider"])
+            self.input_name = self.model.get_inputs()[0].name
+            print(f"CellCounter: running {path_to_model} on ONNX Runtime {ort.__version__} "
+                  f"with {options.intra_op_num_threads} threads")
+        else:
+            self.model = cv2.dnn.readNetFromONNX(path_to_model)
+            print(f"CellCounter: onnxruntime is not installed, running {path_to_model} "
+                  f"on OpenCV DNN module, which is slower")
+
+    def forward(self, blob: np.array) -> np.array:
+        """Runs the detector on the blob (1, 3, INPUT_SIZE, INPUT_SIZE) and returns its raw output."""
+        if ort is not None:
+            return self.model.run(None, {self.input_name: blob})[0]
+        self.model.setInput(blob)
+        return self.model.forward()
+
+    @staticmethod
+    def decode_outputs(outputs: np.array):
+        """
+        Decodes the raw output of YOLOv8 detection head (1, 4 + num_classes, num_anchors)
+        without any per-anchor loops: the best class of each anchor is taken by argmax,
+        the anchors are thresholded by its score, and a single NMS call is applied to the rest.
+
+        Returns:
+        - boxes: np.array (N, 4) in [x1, y1, w, h] format in pixels of the model input;
+        - scores: np.array (N,) of the best class scores;
+        - class_ids: np.array (N,) of the best classes.
+        """
+        predictions = outputs[0].T
+        class_scores = predictions[:, 4:]
+        class_ids = np.argmax(class_scores, axis=1)
+        scores = class_scores[np.arange(len(class_scores)), class_ids]
+        keep = scores >= SCORE_THRESHOLD
+        predictions, scores, class_ids = predictions[keep], scores[keep], class_ids[keep]
+        boxes = np.empty((len(predictions), 4), dtype=predictions.dtype)
+        boxes[:, :2] = predictions[:, :2] - 0.5 * predictions[:, 2:4]
+        boxes[:, 2:] = predictions[:, 2:4]
+        # class-agnostic NMS, as all the anchors compete for the same cells
+        result_boxes = cv2.dnn.NMSBoxes(boxes.astype(np.float64), scores.astype(np.float32),
+                                        NMS_SCORE_THRESHOLD, NMS_IOU_THRESHOLD)
+        result_boxes = np.array(result_boxes, dtype=np.int64).reshape(-1)
+        return (boxes.astype(np.float64)[result_boxes], scores.astype(np.float64)[result_boxes],
+                class_ids.astype(np.int64)[result_boxes])
 
     def init_x10_model(self, path_to_model):
         self.model_x10 = None
 
-    def count_x10(self, input_image, filename):
+    def cache_params(self) -> dict:
+        # ONNX Runtime and OpenCV DNN may give slightly different outputs
+        return {"model": type(self).__name__, "input_size": INPUT_SIZE,
+                "score_threshold": SCORE_THRESHOLD, "nms_score_threshold": NMS_SCORE_THRESHOLD,
+                "nms_iou_threshold": NMS_IOU_THRESHOLD,
+                "runtime": "onnxruntime" if ort is not None else "opencv"}
+
+    def count_x10(self, input_image, filename=None):
         return self.count_x20(input_image, filename)
 
-    def count_x20(self, input_image, filename):
+    def count_x20(self, input_image, filename=None):
         # # NOTE: this function is deprecated and no longer used, because we have implemented ultralytics-based inference pipeline for simplicity
         """
         Main function to load ONNX model, perform inference, draw bounding boxes,
@@ -45,17 +117,19 @@ class CellCounter(BaseModel):
 
         Args:
             onnx_model (str): Path to the ONNX model.
-            input_image (str): Path to the input image.
+            input_image (str or np.ndarray): Path to the input image or the image itself in BGR format.
+            filename (str): Path for saving the image with detections. Nothing is saved if None.
 
         Returns:
             list: List of dictionaries containing detection information such as class_id,
             class_name, confidence, etc.
         """
         # Read the input image
+        original_image: np.ndarray = load_image_bgr(input_image)
+        self.original_image = original_image.copy()
+        [height, width, _] = original_image.shape
+        # the inference is skipped if the detections were taken from the cache
         if self.detections is None:
-            original_image: np.ndarray = cv2.imread(input_image)
-            self.original_image = original_image.copy()
-            [height, width, _] = original_image.shape
 
             # Prepare a square image for inference
             length = max((height, width))
@@ -63,100 +137,58 @@ class CellCounter(BaseModel):
             image[0:height, 0:width] = original_image
 
             # Calculate scale factor
-            scale = length / 512
+            scale = length / INPUT_SIZE
 
             # Preprocess the image and prepare blob for model
-            blob = cv2.dnn.blobFromImage(image, scalefactor=1 / 255, size=(512, 512), swapRB=True)
-            self.model.setInput(blob)
+            blob = cv2.dnn.blobFromImage(image, scalefactor=1 / 255, size=(INPUT_SIZE, INPUT_SIZE),
+                                         swapRB=True)
 
             # Perform inference
-            outputs = self.model.forward()
-            # outputs = model(input_image, imgsz=512, conf=0.2, iou=0.6)
-            # print("Outputs done")
-            # return []
-
-            # Prepare output array
-            outputs = np.array([cv2.transpose(outputs[0])])
-            rows = outputs.shape[1]
-
-            boxes = []
-            scores = []
-            class_ids = []
-
-            # Iterate through output to collect bounding boxes, confidence scores, and class IDs
-            for i in range(rows):
-                classes_scores = outputs[0][i][4:]
-                (minScore, maxScore, minClassLoc, (x, maxClassIndex)) = cv2.minMaxLoc(classes_scores)
-                if maxScore >= 0.2:  # originally >= .25
-                    box = [
-                        outputs[0][i][0] - (0.5 * outputs[0][i][2]),
-                        outputs[0][i][1] - (0.5 * outputs[0][i][3]),
-                        outputs[0][i][2],
-                        outputs[0][i][3],
-                    ]
-                    boxes.append(box)
-                    scores.append(maxScore)
-                    class_ids.append(maxClassIndex)
-
-            # Apply NMS (Non-maximum suppression)
-            result_boxes = cv2.dnn.NMSBoxes(boxes, scores, 0.25, 0.6)  # score, nms thresholds
-            boxes_to_filter = np.array(boxes)[result_boxes,:]
-
-            detections = []
-
-            # Iterate through NMS results to draw bounding boxes and labels
-            for i, _ in enumerate(result_boxes):
-                index = result_boxes[i]
-                box = boxes[index]
-                detection = {
-                    "class_id": class_ids[index],
-                    "class_name": CLASSES[class_ids[index]],
-                    "confidence": scores[index],
-                    "box": np.array(box),
-                    "scale": scale,
-                }
-                detections.append(detection)
-            # perform square-based filtering of bboxes
-            detections = pd.DataFrame(detections)
+            boxes, scores, class_ids = self.decode_outputs(self.forward(blob))
+
+            # boxes are predicted for 512x512 input, so we scale them back to image pixels
+            detections = Detections.from_polygons(
+                [np.zeros((0, 2))] * len(boxes),
+                boxes * scale,
+                scores,
+                (height, width),
+                id_label=class_ids)
             self.detections = detections
-            csv_data = self.detections.copy()
-            csv_data['width'] = csv_data['box'].apply(lambda b: b[2] / length)
-            csv_data['height'] = csv_data['box'].apply(lambda b: b[3] / length)
-            csv_data['bbox_area'] = csv_data['width'] * csv_data['height'] / length**2
-            csv_data[['confidence', 'width', 'height',
-                      'bbox_area']].to_csv(self.out_dir / "cell_data.csv", sep=';', index=False)
             self.scale = scale
-            # change object_size for detection
-            self.object_size['signal']("set_size", detections['box'].copy())
 
         detections = self.detections
-        self.object_size['signal']("set_size", detections['box'].copy())
-        original_image = self.original_image.copy()
-        scale = self.scale
+        csv_data = pd.DataFrame({
+            'confidence': detections.confidence,
+            'width': detections.boxes[:, 2] / width,
+            'height': detections.boxes[:, 3] / height,
+            'bbox_area': detections.box_areas()
+        })
+        csv_data.to_csv(self.out_dir / "cell_data.csv", sep=';', index=False)
+        self.object_size['signal']("set_size", detections.box_areas())
         # TODO: in this codeline, calculate max and min squares of obtained bboxes and automatically
         # set them as lower and upper bounds for the filtering sliders if the sliders currently
         # have default values (0 and 10) set up. Otherwise do not re-set up them.
-        # TODO: in this codeline, add initialization of min_size and max_size params where their
-        # values are read from the boundary sliders. Scale them to be in 0.0-1.0 range, as required
-        # by the filter_detections() function.
-        # TODO: pass the min/max_size params to filter_detections() call below.
         # TODO: when opening a new image or folder of images, reset boundary sliders to their default values (min=0%, max=10%).
-        filtered_detections = filter_detections(detections, min_size = self.object_size['min_size'], max_size= self.object_size['max_size'])
-        for i in range(filtered_detections.shape[0]):
+        self.set_render_state(self.original_image)
+        return self.refilter(filename=filename)
+
+    def render(self, visible, filename=None):
+        """Draws the bounding boxes of the visible detections on the copy of the display image."""
+        detections = self.detections.subset(visible)
+        image = self.display_image.copy()
+        corners = np.round(detections.boxes[:, :2]).astype(int)
+        opposite_corners = np.round(detections.boxes[:, :2] + detections.boxes[:, 2:]).astype(int)
+        for i in range(len(detections)):
             draw_bounding_box(
-                original_image,
-                filtered_detections.iloc[i,0],
-                filtered_detections.iloc[i,2],
-                round(filtered_detections.iloc[i,3][0] * scale),
-                round(filtered_detections.iloc[i,3][1] * scale),
-                round((filtered_detections.iloc[i,-2][0] + filtered_detections.iloc[i,-2][2]) * filtered_detections.iloc[i,-1]),
-                round((filtered_detections.iloc[i,-2][1] + filtered_detections.iloc[i,-2][3]) * filtered_detections.iloc[i,-1]),
+                image,
+                detections.id_label[i],
+                detections.confidence[i],
+                corners[i][0],
+                corners[i][1],
+                opposite_corners[i][0],
+                opposite_corners[i][1],
             )
-        try:
-            os.remove(filename)
-        except:
-            pass
-        cv2.imwrite(filename, original_image)
-
-        return filtered_detections
+        if filename is not None:
+            cv2.imwrite(filename, image)
+        return image
         
\ No newline at end of file
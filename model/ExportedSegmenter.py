@@ -0,0 +1,73 @@
+"""
+Here we define the runtime class for YOLO segmenters exported by model.export
+to ONNX or OpenVINO format, optionally with int8 quantization.
+The exported models are run through ultralytics, which selects ONNX Runtime or OpenVINO runtime
+by the artifact, so the pre- and postprocessing, and thus the detections, are the same
+as for the original PyTorch model, see Segmenter.
+"""
+import os
+import ast
+
+from ultralytics import YOLO
+from model.sahi.auto_model import AutoDetectionModel
+
+from model.segmenter import Segmenter, X10_CONFIDENCE_THRESHOLD
+
+
+def read_export_metadata(path_to_model: str) -> dict:
+    """
+    Reads the metadata written by ultralytics into the exported model (imgsz, names, task etc.).
+
+    Input params:
+    - path_to_model: str - path to .onnx file or to the directory of OpenVINO model.
+
+    Returns:
+    - dict of the metadata, empty if the model has none.
+    """
+    if os.path.isdir(path_to_model):
+        import yaml
+        metadata_path = os.path.join(path_to_model, "metadata.yaml")
+        if not os.path.exists(metadata_path):
+            return {}
+        with open(metadata_path, 'r') as f:
+            return yaml.safe_load(f) or {}
+    try:
+        import onnx
+        props = {prop.key: prop.value for prop in
+                 onnx.load(path_to_model, load_external_data=False).metadata_props}
+    except ImportError:
+        import onnxruntime as ort
+        props = ort.InferenceSession(path_to_model, providers=["CPUExecutionProvider"])\
+            .get_modelmeta().custom_metadata_map
+    metadata = {}
+    for key, value in props.items():
+        try:
+            metadata[key] = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            metadata[key] = value
+    return metadata
+
+
+class ExportedSegmenter(Segmenter):
+    """
+    Segmenter running the model exported to ONNX / OpenVINO.
+    A single model instance serves both x10 (sliced) and x20 inference.
+    The x20 inference runs at the image size the model was exported with.
+    """
+    def init_x10_model(self, path_to_model: str):
+        # exported models can not be moved to a device, so the model is passed to SAHI ready-made
+        self.model_x10 = AutoDetectionModel.from_pretrained(
+            model_type='yolov8',
+            model=YOLO(path_to_model, task="segment"),
+            confidence_threshold=X10_CONFIDENCE_THRESHOLD,
+            device="cpu",
+        )
+
+    def init_x20_model(self, path_to_model: str):
+        self.model = self.model_x10.model
+        self.imgsz = read_export_metadata(path_to_model).get("imgsz")
+        if self.imgsz is not None:
+            self.model.overrides["imgsz"] = self.imgsz
+
+    def cache_params(self) -> dict:
+        return dict(super().cache_params(), imgsz=self.imgsz)
@@ -1,6 +1,7 @@
 import os
 from model.BaseModel import BaseModel
 from model.utils import *
+from model.detections import Detections
 import torch
 import pandas as pd
 
@@ -9,6 +10,11 @@ import cv2  # OpenCV for findContours
 #from typing import Optional, List, Tuple, Dict, Any # For type hinting
 
 class InstansegSegmenter(BaseModel):
+    # size filtering is disabled until the tracking feature is restored, see count_x20()
+    filter_by_size = False
+    # objects segmented by the model
+    target = "cells"
+
     def __init__(self, path_to_model: str, object_size):
         super().__init__(path_to_model, object_size)
    
@@ -32,44 +38,35 @@ class InstansegSegmenter(BaseModel):
     def init_x10_model(self, path_to_model):
         pass
 
+    def cache_params(self) -> dict:
+        return {"model": type(self).__name__, "target": self.target}
+
     def count_x20(self, input_image, plot = True, colormap="tab20", tracking=False,
-              filename=".cache/cell_tmp_img_with_detections.png", min_score=0.05,
+              filename=None, min_score=0.05,
               alpha=0.75, store_bin_mask=False, **kwargs):
         image = self.load_image(input_image)
         img_rgb = self.image_preprocess(image)
         self.original_image = img_rgb
         try:
-            
-            image_array, pixel_size = self.model.read_image(input_image)
+
             #labeled_output = self.model.eval_medium_image(image = image_array, return_image_tensor=False, target= "cells")
-            labeled_output = self.model.eval_medium_image(image = img_rgb, return_image_tensor=False, target= "cells")
+            # the inference is skipped if the detections were taken from the cache
+            if self.detections is None:
+                labeled_output = self.model.eval_medium_image(image = img_rgb, return_image_tensor=False, target= self.target)
+                self.detections = self.instanseg_results_to_detections(labeled_output)
             
             # display = self.model.display(image_array, labeled_output)
             # from instanseg.utils.utils import show_images
             # show_images(image_array,display, colorbar=False, titles = ["Original Image", "Image with segmentation"])            
             
 #            labeled_output = self.model.eval(image = input_image, save_output = False, save_overlay=False)
-            self.detections = self.instanseg_results_to_pandas(labeled_output)
             
-            detections = self.detections[self.detections['confidence'] >= min_score]
+            self.set_render_state(self.original_image, min_score, colormap=colormap, alpha=alpha)
             if tracking is False:
-                self.object_size['signal']("set_size", self.detections['box'].copy())
-            original_image = self.original_image.copy()
+                self.object_size['signal']("set_size", self.detections.box_areas())
             
-            #todo restore tracking feature
-            # if tracking is False:
-            #     filtered_detections = filter_detections(detections,
-            #                                             min_size = self.object_size['min_size'],
-            #                                             max_size= self.object_size['max_size'])
-            # else:
-            #     filtered_detections = detections
-
-            filtered_detections = detections
-
-            self.prediction_image = None
-            if plot is True:
-                self.prediction_image = plot_predictions(original_image, filtered_detections['mask'].tolist(), filename=filename, colormap=colormap, alpha=alpha)
-            return filtered_detections
+            #todo restore tracking feature, see filter_by_size
+            return self.refilter(filename=filename, plot=plot)
         except Exception as e:
             raise RuntimeError(f"Error when inferrecing InstanSeg: {e}")
         
@@ -85,7 +82,7 @@ class InstansegSegmenter(BaseModel):
         cv2.imwrite(filename, image)
         return
     def count_x10(self, input_image: str, colormap="tab20",
-              filename=".cache/cell_tmp_img_with_detections.png", min_score=0.01,
+              filename=None, min_score=0.01,
               alpha=0.75, **kwargs):
         raise NotImplementedError
     
@@ -97,56 +94,13 @@ class InstansegSegmenter(BaseModel):
             img_prepared = cv2.cvtColor(img_rgb, cv2.COLOR_GRAY2RGB)
         return img_prepared
 
-    def load_image(self, image_path):
-        img_bgr = cv2.imread(image_path, cv2.IMREAD_COLOR)
-        if img_bgr is None:
-            raise RuntimeError(f"Unable to load image {image_path}")
-        if len(img_bgr.shape) == 2: img_bgr = cv2.cvtColor(img_bgr, cv2.COLOR_GRAY2BGR)
-        elif img_bgr.shape[2] == 4: img_bgr = cv2.cvtColor(img_bgr, cv2.COLOR_BGRA2BGR)
-        return img_bgr
+    def load_image(self, image):
+        return load_image_bgr(image)
     
-    def instanseg_results_to_pandas(self, labeled_output) -> pd.DataFrame:
-        from instanseg.utils.utils import labels_to_features
-        instanseg_objects = labels_to_features(labeled_output[:,0,:].numpy())
-        data = {
-            "id_label": [],
-            "box": [],
-            "mask": [],
-            "confidence": [],
-            "diameter": [],
-            "area": [],
-            "volume": []
-        }
-
-        features = instanseg_objects['features']
-        from shapely.geometry import shape
-        minx, miny, maxx, maxy = None, None, None, None
-        for i, feature in enumerate(features):
-            geom = shape(feature['geometry'])  # Convert to shapely geometry
-            bounds = geom.bounds  # (minx, miny, maxx, maxy)
-            if minx is None:
-                minx, miny, maxx, maxy = bounds
-            else:
-                minx = min(minx, bounds[0])
-                miny = min(miny, bounds[1])
-                maxx = max(maxx, bounds[2])
-                maxy = max(maxy, bounds[3])
-                
-            p_mask = feature['geometry']['coordinates'][0]
-            data['id_label'].append(i)
-            box = [minx, miny, maxx, maxy] 
-            data['box'].append(box)
-            data['mask'].append(p_mask)
-            #todo restore confidence
-            data['confidence'].append(1 #outputs.boxes.conf[i].cpu().detach().numpy()
-                                    )
-            #todo restore morphology
-            morphology = None
-            data['diameter'].append(None #morphology['diameter']
-                                    )
-            data['area'].append(None #morphology['area']
-                                )
-            data['volume'].append(None #morphology['volume']
-                                    )
-        return pd.DataFrame(data)
-           
+    def instanseg_results_to_detections(self, labeled_output) -> Detections:
+        """
+        Converts InstanSeg labeled output to Detections container in a single pass over the label image,
+        see model.utils.labels_to_detections(). The confidences are 1.0, since InstanSeg does not provide them.
+        """
+        label_image = labeled_output[0, 0].cpu().numpy()
+        return labels_to_detections(label_image, img_shape=self.original_image.shape[:2])
@@ -5,14 +5,53 @@ In this module the general Model class is defined which is used to calculate:
 """
 
 import os
+import time
+import importlib
+
+import cv2
+import numpy as np
 
-from model.CellCounter import CellCounter
 from model.NucleiCounter import NucleiCounter
-from model.segmenter import Segmenter
-from model.utils import is_image_valid, calculate_lsm
-from model.CellposeSegmenter import CellposeSegmenter
-from model.InstanSegSegmenter import InstansegSegmenter
-from model.StardistSegmenter import StardistSegmenter
+from model.utils import is_image_valid, calculate_lsm, calculate_lsm_channels
+from model.lsm import PageStream, read_stack_layout, to_uint8
+
+# Backends are matched against model_type in the given order and imported on first use,
+# so that the frameworks behind them (torch, ultralytics, tensorflow etc.) are not loaded on startup.
+# Each entry: (substring of model_type, module, class).
+BACKENDS = [
+    ("stardist", "model.StardistSegmenter", "StardistSegmenter"),
+    ("instanseg", "model.InstanSegSegmenter", "InstansegSegmenter"),
+    ("cellpose", "model.CellposeSegmenter", "CellposeSegmenter"),
+    ("cellcounter", "model.CellCounter", "CellCounter"),
+    # must precede "segmenter", which is a substring of it
+    ("exported_segmenter", "model.ExportedSegmenter", "ExportedSegmenter"),
+    ("segmenter", "model.segmenter", "Segmenter"),
+]
+
+# module name -> time (in seconds) spent on its first import
+BACKEND_LOAD_TIMES = {}
+
+
+def load_backend(model_type: str):
+    """
+    Imports the backend module for the given model_type and returns its model class.
+    The import time of each backend is measured once and stored in BACKEND_LOAD_TIMES.
+
+    Input params:
+    - model_type: str - model type as defined in modelconfig.json.
+
+    Returns:
+    - class of the backend model.
+    """
+    for key, module_name, class_name in BACKENDS:
+        if key in model_type:
+            start_time = time.perf_counter()
+            module = importlib.import_module(module_name)
+            if module_name not in BACKEND_LOAD_TIMES:
+                BACKEND_LOAD_TIMES[module_name] = time.perf_counter() - start_time
+                print(f"Backend {class_name} loaded in {BACKEND_LOAD_TIMES[module_name]:.2f} seconds")
+            return getattr(module, class_name)
+    raise ValueError("Unknown model type given as input. Expected 'det' for detection model or 'seg' for segmenting model to be presented in the model filename.")
 
 class Model():
     """
@@ -49,20 +88,9 @@ class Model():
         Helper constructor method for initializing cell counter param.
         Depending on the model file name, either CellCounter or Segmenter
         class is being called for initialization.
+        The backend module is imported only when its model type is used for the first time.
         """
-        
-        if "stardist" in model_type: 
-            self.cell_counter = StardistSegmenter(path, object_size = object_size)
-        elif "instanseg" in model_type: 
-            self.cell_counter = InstansegSegmenter(path, object_size = object_size)
-        elif "cellpose" in model_type: 
-            self.cell_counter = CellposeSegmenter(path, object_size = object_size)
-        elif "cellcounter" in model_type:
-            self.cell_counter = CellCounter(path_to_model=path, object_size = object_size)
-        elif "segmenter" in model_type:
-            self.cell_counter = Segmenter(path, object_size = object_size)
-        else:
-            raise ValueError("Unknown model type given as input. Expected 'det' for detection model or 'seg' for segmenting model to be presented in the model filename.")
+        self.cell_counter = load_backend(model_type)(path, object_size = object_size)
 
     def calculate(self, img_path, cell_channel=0, nuclei_channel=1):
         """
@@ -86,7 +114,56 @@ class Model():
             self.inference_duration = self.cell_counter.inference_duration
             return result
 
-def calculate_standard(cell_counter : CellCounter, img_path : str):
+    def refilter(self, result, **render_params):
+        """
+        Re-applies the filtering of the cell counter (score and size sliders) to the last calculated result,
+        without running the models again. The image with detections of the cell counter is redrawn as well.
+        Input params are:
+        - result: dictionary returned by the last calculate() call;
+        - **render_params: new drawing params of the cell counter, e.g. colormap.
+
+        Returns the updated dictionary, see calculate() for its fields,
+        or the given one if there is nothing to re-filter.
+        """
+        cells = self.cell_counter.refilter(**render_params)
+        if cells is None:
+            return result
+        result = dict(result, Cells=cells)
+        if result['Nuclei'] != -100:
+            result['%'] = -100 if len(cells) == 0 else round((1 - result['Nuclei']/len(cells)) * 100, 3)
+        return result
+
+    def calculate_stream(self, img_path, cell_channel=0, nuclei_channel=1, read_ahead=2):
+        """
+        Calculates the resulting target values for each frame of multi-page lsm/tif image
+        (Z-stack or time series) without loading the whole file into memory.
+        The frames are decoded lazily with bounded read-ahead, see model.lsm.PageStream.
+        LSM files and TIFF stacks with a channel axis (e.g. ImageJ hyperstacks) are processed as
+        lsm images, while grayscale and RGB TIFF stacks contain cells only and are processed
+        frame by frame as standard images, like calculate() does for a single tif image.
+        Input params are:
+        - img_path: path to lsm/tif image;
+        - cell_channel: channel with cells. Default to 0;
+        - nuclei_channel: channel with stained nuclei. Default to 1;
+        - read_ahead: maximal number of pages decoded ahead of the model. Default to 2.
+
+        Yields the result of each page as a dictionary, see calculate() for its fields.
+        """
+        if not img_path.lower().endswith(('lsm', 'tif', 'tiff')):
+            yield self.calculate(img_path, cell_channel=cell_channel, nuclei_channel=nuclei_channel)
+            return
+        if img_path.lower().endswith('lsm') or read_stack_layout(img_path).channel_axis == 'C':
+            self.inference_duration = -1
+            for cell_img, nuclei_img in PageStream(img_path, [cell_channel, nuclei_channel],
+                                                   read_ahead=read_ahead):
+                yield calculate_lsm_channels(self.cell_counter, self.nuclei_counter, cell_img, nuclei_img)
+            return
+        for frame in PageStream(img_path, read_ahead=read_ahead):
+            result = calculate_standard(self.cell_counter, frame_to_bgr(frame))
+            self.inference_duration = self.cell_counter.inference_duration
+            yield result
+
+def calculate_standard(cell_counter : "CellCounter", img_path : str):
     """
     Calculates cells only on given standard image.
     Input params are:
@@ -99,4 +176,13 @@ def calculate_standard(cell_counter : CellCounter, img_path : str):
     - %: -100 (encoding for NaN).
     """
     cell_count = cell_counter.count_cells(img_path)
-    return {'Nuclei': -100, 'Cells': cell_count, '%': -100}
\ No newline at end of file
+    return {'Nuclei': -100, 'Cells': cell_count, '%': -100}
+
+def frame_to_bgr(frame: np.array) -> np.array:
+    """
+    Converts the frame of grayscale or RGB(A) TIFF stack, given as (C, H, W) array
+    of any integer or float type, to uint8 BGR image.
+    """
+    if len(frame) == 1:
+        return cv2.cvtColor(to_uint8(frame[0]), cv2.COLOR_GRAY2BGR)
+    return cv2.cvtColor(to_uint8(np.ascontiguousarray(np.moveaxis(frame[:3], 0, -1))), cv2.COLOR_RGB2BGR)
@@ -4,9 +4,7 @@ to calculate stained nuclei presented in LSM images.
 """
 
 import numpy as np
-import pandas as pd
 import cv2
-from sklearn.cluster import DBSCAN
 
 class NucleiCounter():
     """
@@ -19,6 +17,7 @@ class NucleiCounter():
     - threshold value for nuclei image binarization;
     - eps param for DBSCAN algorithm;
     - min_samples value for DBSCAN algorithm.
+    The nuclei are counted with connected components giving the same clusters as DBSCAN.
 
     Output value is the number of marked nuclei detected.
     """
@@ -40,20 +39,89 @@ class NucleiCounter():
 
     def channel2points(self, channel):
         """Converts given binary channel to a set of points in 2D space."""
+        import pandas as pd
         indices = np.argwhere(channel > self.threshold)
         Y_coordinates = channel.shape[0] - indices[:, 0]
         X_coordinates = indices[:, 1]
         return pd.DataFrame({'x': X_coordinates, 'y': Y_coordinates})
 
     def groupNuclei(self, points):
-        """Groups marked cell nuclei represented as points using DBSCAN clustering algorithm."""
+        """
+        Groups marked cell nuclei represented as points using DBSCAN clustering algorithm.
+        This is the reference implementation, see groupNucleiComponents() for the one used by countNuclei().
+        """
+        from sklearn.cluster import DBSCAN
         dbscan = DBSCAN(eps=self.eps, min_samples=self.min_samples)
         if points.shape[0] == 0:
             return 0
         cluster_labels = dbscan.fit_predict(points[['x', 'y']])
         return np.max(cluster_labels)+1
 
+    def neighbourhood_offsets(self):
+        """Returns (dy, dx) pixel offsets within eps distance, including (0, 0)."""
+        radius = int(np.floor(self.eps))
+        dy, dx = np.mgrid[-radius:radius + 1, -radius:radius + 1]
+        inside = np.sqrt(dy**2 + dx**2) <= self.eps
+        return np.stack((dy[inside], dx[inside]), axis=1)
+
+    def groupNucleiComponents(self, mask):
+        """
+        Counts the same clusters as DBSCAN does on the foreground pixels of the given binary mask,
+        without turning the pixels into a table of points.
+        The pipeline can be described through the following steps:
+        1. Core pixels are found by counting the foreground pixels within eps with a disk convolution;
+        2. Core pixels are grouped into connected components;
+        3. The components having core pixels within eps of each other are merged through a graph
+        of components, which is aggregated over the neighbourhood offsets.
+        Border pixels never create clusters on their own, so the number of merged components
+        is the number of clusters found by DBSCAN.
+
+        Input params:
+        - mask: np.array - binary image, where the foreground pixels are non-zero.
+
+        Returns:
+        - the number of clusters.
+        """
+        from scipy.sparse import coo_matrix
+        from scipy.sparse.csgraph import connected_components
+        mask = (np.asarray(mask) > 0).astype(np.float32)
+        offsets = self.neighbourhood_offsets()
+        radius = int(np.max(np.abs(offsets))) if len(offsets) > 0 else 0
+        kernel = np.zeros((2 * radius + 1, 2 * radius + 1), dtype=np.float32)
+        kernel[offsets[:, 0] + radius, offsets[:, 1] + radius] = 1
+        neighbours = cv2.filter2D(mask, -1, kernel, borderType=cv2.BORDER_CONSTANT)
+        core = (mask > 0) & (np.rint(neighbours) >= self.min_samples)
+        if not core.any():
+            return 0
+        if self.eps < 1:
+            return int(np.sum(core))
+
+        connectivity = 8 if self.eps >= np.sqrt(2) else 4
+        num_labels, labels = cv2.connectedComponents(core.astype(np.uint8), connectivity=connectivity,
+                                                     ltype=cv2.CV_32S)
+        # pairs of different components having core pixels within eps of each other
+        height, width = labels.shape
+        edges = []
+        for dy, dx in offsets:
+            if dy < 0 or (dy == 0 and dx <= 0):
+                continue
+            first = labels[:height - dy, max(0, -dx):width - max(0, dx)]
+            second = labels[dy:, max(0, dx):width - max(0, -dx)]
+            linked = (first > 0) & (second > 0) & (first != second)
+            if linked.any():
+                edges.append(np.unique(first[linked].astype(np.int64) * num_labels + second[linked]))
+        if not edges:
+            return num_labels - 1
+        edges = np.unique(np.concatenate(edges))
+        graph = coo_matrix((np.ones(len(edges)), (edges // num_labels, edges % num_labels)),
+                           shape=(num_labels, num_labels))
+        # the background label 0 forms a component of its own
+        return connected_components(graph, directed=False)[0] - 1
+
     def countNuclei(self, img_channel):
         """Unites the functions above and calculates marked cell nuclei on a given image channel."""
+        return self.groupNucleiComponents(self.preprocess(img_channel) > self.threshold)
+
+    def countNucleiDBSCAN(self, img_channel):
+        """Reference version of countNuclei() clustering every foreground pixel with DBSCAN."""
         return self.groupNuclei(self.channel2points(self.preprocess(img_channel)))
-    
\ No newline at end of file
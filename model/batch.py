@@ -0,0 +1,209 @@
+"""
+Here we define the headless batch engine used for processing whole folders of microimages.
+The engine is built around Model.calculate() and spreads images over a pool of worker processes,
+where each worker loads its model only once. The results of a run are aggregated into one table.
+
+Example of usage from the command line:
+    python -m model.batch path/to/folder --model "YOLO-512 Segmenter" --workers 4
+"""
+import os
+import json
+import time
+import argparse
+import traceback
+import multiprocessing as mp
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from model.BaseModel import OUT_DIR
+from model.detections import Detections
+
+BATCH_DIR = OUT_DIR / "batch"
+VALID_EXTENSIONS = ('.png', '.jpg', '.bmp', '.lsm', '.tif')
+TABLE_COLUMNS = ["File name", "Model", "Cells", "Nuclei", "Alive", "Mean D", "Mean S", "Mean V",
+                 "Duration", "Error"]
+
+# the model instance owned by the current worker process
+_worker_model = None
+
+
+def _ignore_signal(action_name, value):
+    """Replaces the UI signal of object_size when running without GUI."""
+    pass
+
+
+def headless_object_size(scale: int = 20, min_size: float = 0.0, max_size: float = 1.0,
+                         color_map: str = "viridis") -> dict:
+    """
+    Builds object_size UI util param for running the models without GUI.
+    Filtering by object size is disabled by default (the whole 0.0-1.0 range is kept).
+    """
+    return {
+        'min_size': min_size,
+        'max_size': max_size,
+        'scale': scale,
+        'color_map': color_map,
+        'signal': _ignore_signal
+    }
+
+
+def list_images(folder: str) -> list:
+    """Lists all the supported image files in the given folder in sorted order."""
+    return sorted(os.path.join(folder, file) for file in os.listdir(folder)
+                  if file.lower().endswith(VALID_EXTENSIONS))
+
+
+def summarize_result(result: dict) -> dict:
+    """
+    Converts the output of Model.calculate() into one row of the aggregated table.
+    The encoding -100 used by the models for NaN values is converted to None.
+    """
+    cells = result['Cells']
+    row = {"Cells": None, "Mean D": None, "Mean S": None, "Mean V": None}
+    if isinstance(cells, Detections):
+        row["Cells"] = len(cells)
+        for column, key in (("diameter", "Mean D"), ("area", "Mean S"), ("volume", "Mean V")):
+            if not cells.empty and not np.isnan(cells[column]).all():
+                row[key] = float(np.nanmean(cells[column]))
+    else:
+        row["Cells"] = cells
+    row["Nuclei"] = None if result['Nuclei'] == -100 else result['Nuclei']
+    row["Alive"] = None if result['%'] == -100 else result['%']
+    return row
+
+
+def _init_worker(model_config: dict, object_size: dict, num_threads: int):
+    """Loads the model once per worker process."""
+    global _worker_model
+    if num_threads:
+        try:
+            import torch
+            torch.set_num_threads(num_threads)
+        except ImportError:
+            pass
+        if 'cellcounter' in model_config['model_type']:
+            import model.CellCounter
+            model.CellCounter.INTRA_OP_THREADS = num_threads
+    from model.Model import Model
+    _worker_model = Model(path=model_config['path'], object_size=object_size,
+                          model_type=model_config['model_type'])
+
+
+def _process_image(img_path: str, cell_channel: int, nuclei_channel: int) -> dict:
+    """Calculates a single image inside of the worker process."""
+    row = {"File name": os.path.basename(img_path), "Error": None}
+    start_time = time.time()
+    try:
+        # cached detections belong to the previous image and must be dropped
+        _worker_model.cell_counter.clear_cached_detections()
+        result = _worker_model.calculate(img_path, cell_channel=cell_channel,
+                                         nuclei_channel=nuclei_channel)
+        if result is None:
+            row["Error"] = "Unsupported image format"
+        else:
+            row.update(summarize_result(result))
+    except Exception as e:
+        traceback.print_exc()
+        row["Error"] = str(e)
+    row["Duration"] = time.time() - start_time
+    return row
+
+
+class BatchEngine():
+    """
+    Headless engine for processing a batch of microimages with one of the models.
+
+    Input params are:
+    - model_name: name of the model as defined in modelconfig.json;
+    - model_config: dictionary with 'path' and 'model_type' fields of the model;
+    - num_workers: number of worker processes. Default to half of available CPU cores;
+    - threads_per_worker: number of intra-op threads for each worker. Default to an even split of CPU cores;
+    - scale: scale of the images to be processed (10 or 20). Default to 20;
+    - cell_channel, nuclei_channel: channels used for LSM images;
+    - output_dir: directory where the aggregated tables are saved.
+    """
+    def __init__(self, model_name: str, model_config: dict, num_workers: int = None,
+                 threads_per_worker: int = None, scale: int = 20, cell_channel: int = 0,
+                 nuclei_channel: int = 1, output_dir: Path = BATCH_DIR):
+        cpu_count = os.cpu_count() or 1
+        self.model_name = model_name
+        self.model_config = model_config
+        self.num_workers = num_workers or max(1, cpu_count // 2)
+        self.threads_per_worker = threads_per_worker or max(1, cpu_count // self.num_workers)
+        self.object_size = headless_object_size(scale=scale)
+        self.cell_channel = cell_channel
+        self.nuclei_channel = nuclei_channel
+        self.output_dir = Path(output_dir)
+
+    def run(self, img_paths: list, table_name: str = None):
+        """
+        Processes all the given images and writes one aggregated table for the run.
+
+        Input params:
+        - img_paths: list of paths to lsm/jpg/png/tif/bmp images;
+        - table_name: name of the resulting CSV table. Default to timestamp-based name.
+
+        Returns:
+        - table: pd.DataFrame with one row per image;
+        - path to the saved table.
+        """
+        os.makedirs(self.output_dir, exist_ok=True)
+        if table_name is None:
+            table_name = f"batch_{time.strftime('%Y%m%d_%H%M%S')}.csv"
+        rows = []
+        if img_paths:
+            num_workers = min(self.num_workers, len(img_paths))
+            chunksize = max(1, len(img_paths) // (num_workers * 4))
+            with ProcessPoolExecutor(max_workers=num_workers, mp_context=mp.get_context("spawn"),
+                                     initializer=_init_worker,
+                                     initargs=(self.model_config, self.object_size,
+                                               self.threads_per_worker)) as executor:
+                outputs = executor.map(_process_image, img_paths,
+                                       [self.cell_channel] * len(img_paths),
+                                       [self.nuclei_channel] * len(img_paths),
+                                       chunksize=chunksize)
+                for row in tqdm(outputs, total=len(img_paths), desc=self.model_name):
+                    row["Model"] = self.model_name
+                    rows.append(row)
+        table = pd.DataFrame(rows, columns=TABLE_COLUMNS)
+        path = self.output_dir / table_name
+        table.to_csv(path, sep=';', index=False)
+        return table, path
+
+
+def main():
+    """Command line entry point of the batch engine."""
+    parser = argparse.ArgumentParser(description="Headless batch processing of cell microimages.")
+    parser.add_argument("folder", help="folder with lsm/jpg/png/tif/bmp images")
+    parser.add_argument("--model", required=True, help="model name as defined in modelconfig.json")
+    parser.add_argument("--config", default="modelconfig.json", help="path to the models config file")
+    parser.add_argument("--workers", type=int, default=None, help="number of worker processes")
+    parser.add_argument("--threads", type=int, default=None, help="intra-op threads per worker")
+    parser.add_argument("--scale", type=int, default=20, choices=[10, 20], help="scale of the images")
+    parser.add_argument("--cell-channel", type=int, default=0, help="LSM channel with cells")
+    parser.add_argument("--nuclei-channel", type=int, default=1, help="LSM channel with stained nuclei")
+    parser.add_argument("--output", default=str(BATCH_DIR), help="directory for the aggregated table")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        models = json.load(f)
+    if args.model not in models:
+        raise ValueError(f"Unknown model '{args.model}'. Available models: {list(models.keys())}")
+
+    engine = BatchEngine(args.model, models[args.model], num_workers=args.workers,
+                         threads_per_worker=args.threads, scale=args.scale,
+                         cell_channel=args.cell_channel, nuclei_channel=args.nuclei_channel,
+                         output_dir=args.output)
+    img_paths = list_images(args.folder)
+    start_time = time.time()
+    table, path = engine.run(img_paths)
+    print(f"Processed {table.shape[0]} images in {time.time() - start_time:.2f} seconds. "
+          f"Table saved to {path}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+"""
+Here we define the persistent on-disk cache of inference results.
+The detections of a model on an image are stored under a content-addressed key, which combines:
+- hash of the image pixels;
+- model path and hash of its weights file;
+- scale and the inference params of the model.
+Thus reopening the same image with the same model returns the detections without running the
+inference again, while any change of the image, of the weights or of the params leads to a new key.
+The cache is bounded by its total size on disk, the least recently used entries are evicted first.
+"""
+import os
+import json
+import hashlib
+from pathlib import Path
+
+import numpy as np
+
+from model.detections import Detections
+
+CACHE_DIR = Path(".cache") / "inference"
+DEFAULT_MAX_SIZE_MB = 1024
+# files are hashed in chunks, so that large weights files are not loaded into memory at once
+HASH_CHUNK_SIZE = 2**20
+
+
+def _hash_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class InferenceCache():
+    """
+    Size-bounded on-disk cache of Detections.
+
+    Input params are:
+    - cache_dir: directory of the cache. Default to .cache/inference;
+    - max_size_mb: maximal total size of the cache files in MB. Default to 1024.
+
+    Each entry is stored as a single .npz file named <path digest>_<weights digest>_<image key>.npz,
+    so that all the entries of a model can be invalidated at once, whatever the version of its weights.
+    """
+    def __init__(self, cache_dir=CACHE_DIR, max_size_mb: float = DEFAULT_MAX_SIZE_MB):
+        self.cache_dir = Path(cache_dir)
+        self.max_size_mb = max_size_mb
+        self.enabled = True
+        # (path, mtime, size) -> hash of the weights file, so that the weights are hashed only once
+        self._weights_hashes = {}
+
+    def model_digest(self, model_path: str) -> str:
+        """
+        Returns the digest of the model given its path.
+        For files the digest depends on the content of the weights, for directories on their
+        modification time, and for names of pretrained models (e.g. 'cyto') on the name only.
+        """
+        if model_path and os.path.isfile(model_path):
+            stat = os.stat(model_path)
+            file_key = (os.path.abspath(model_path), stat.st_mtime_ns, stat.st_size)
+            if file_key not in self._weights_hashes:
+                self._weights_hashes[file_key] = _hash_file(model_path)
+            weights = self._weights_hashes[file_key]
+        elif model_path and os.path.isdir(model_path):
+            weights = str(os.stat(model_path).st_mtime_ns)
+        else:
+            weights = ""
+        return f"{self._path_digest(model_path)}_{hashlib.sha256(weights.encode()).hexdigest()[:16]}"
+
+    @staticmethod
+    def _path_digest(model_path: str) -> str:
+        return hashlib.sha256(str(model_path).encode()).hexdigest()[:16]
+
+    def make_key(self, image: np.array, model_path: str, scale: int, params: dict = None) -> str:
+        """
+        Builds the key of the cache entry.
+
+        Input params:
+        - image: np.array - the image passed to the model;
+        - model_path: str - path to the model weights or name of the pretrained model;
+        - scale: int - scale of the image (10 or 20);
+        - params: dict - inference params of the model. Values which are not JSON-serializable
+        are keyed by their string representation.
+
+        Returns:
+        - str key of the entry.
+        """
+        image = np.ascontiguousarray(image)
+        digest = hashlib.sha256()
+        digest.update(f"{image.shape}|{image.dtype}".encode())
+        digest.update(image.data)
+        digest.update(f"|{scale}|{json.dumps(params or {}, sort_keys=True, default=str)}".encode())
+        return f"{self.model_digest(model_path)}_{digest.hexdigest()}"
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.npz"
+
+    def get(self, key: str):
+        """Returns the cached Detections for the key, or None if there is no such entry."""
+        if not self.enabled:
+            return None
+        path = self._path(key)
+        if not path.exists():
+            return None
+        try:
+            with np.load(path) as data:
+                bin_masks = None
+                if 'bin_masks' in data:
+                    shape = tuple(data['bin_masks_shape'])
+                    bin_masks = list(np.unpackbits(data['bin_masks'], count=int(np.prod(shape)))
+                                     .reshape(shape).astype(bool))
+                detections = Detections(data['id_label'], data['boxes'], data['confidence'],
+                                        data['coords'], data['offsets'], tuple(data['img_shape']),
+                                        diameter=data['diameter'], area=data['area'],
+                                        volume=data['volume'], bin_masks=bin_masks)
+        except FileNotFoundError:
+            # evicted by another process sharing the cache
+            return None
+        except Exception as e:
+            print(f"Inference cache: dropping broken entry {path.name}: {e}")
+            path.unlink(missing_ok=True)
+            return None
+        # the modification time marks the entry as recently used for the eviction
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            pass
+        return detections
+
+    def put(self, key: str, detections: Detections):
+        """Stores the detections under the key and evicts the old entries if the cache is full."""
+        if not self.enabled or detections is None:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        data = {
+            'id_label': detections.id_label,
+            'boxes': detections.boxes,
+            'confidence': detections.confidence,
+            'coords': detections.coords,
+            'offsets': detections.offsets,
+            'img_shape': np.array(detections.img_shape),
+            'diameter': detections.diameter,
+            'area': detections.area,
+            'volume': detections.volume
+        }
+        if detections.bin_masks is not None and len(detections.bin_masks) > 0:
+            bin_masks = np.stack([np.asarray(mask, dtype=bool) for mask in detections.bin_masks])
+            data['bin_masks'] = np.packbits(bin_masks, axis=None)
+            data['bin_masks_shape'] = np.array(bin_masks.shape)
+        # written to a temporary file first, so that a crash never leaves a broken entry
+        path = self._path(key)
+        tmp_path = path.with_name(f"{path.stem}.{os.getpid()}.tmp.npz")
+        np.savez(tmp_path, **data)
+        os.replace(tmp_path, path)
+        self.evict()
+
+    def _entries(self) -> list:
+        if not self.cache_dir.exists():
+            return []
+        return [entry for entry in os.scandir(self.cache_dir)
+                if entry.name.endswith(".npz") and not entry.name.endswith(".tmp.npz")]
+
+    def _entry_stats(self) -> list:
+        """
+        Returns (path, size, mtime) of the cache entries, each entry is stat'ed only once.
+        The entries removed by another process sharing the cache in the meantime are skipped.
+        """
+        stats = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+            except FileNotFoundError:
+                continue
+            stats.append((entry.path, stat.st_size, stat.st_mtime))
+        return stats
+
+    @property
+    def size_mb(self) -> float:
+        """Total size of the cache files in MB."""
+        return sum(size for _, size, _ in self._entry_stats()) / 2**20
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits into max_size_mb."""
+        entries = sorted(self._entry_stats(), key=lambda entry: entry[2])
+        total_size = sum(size for _, size, _ in entries)
+        max_size = self.max_size_mb * 2**20
+        for path, size, _ in entries:
+            if total_size <= max_size:
+                break
+            total_size -= size
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path: str):
+        # the entry may be already removed by another process sharing the cache
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def invalidate(self, model_path: str = None):
+        """
+        Removes the cached entries of the given model, or all the entries if no model is given.
+        Should be called e.g. after the weights of a model were replaced in place.
+        """
+        prefix = None if model_path is None else self._path_digest(model_path) + "_"
+        for entry in self._entries():
+            if prefix is None or entry.name.startswith(prefix):
+                self._remove(entry.path)
+
+    def clear(self):
+        """Removes all the cached entries."""
+        self.invalidate()
+
+
+INFERENCE_CACHE = InferenceCache()
@@ -0,0 +1,161 @@
+"""
+Here we define the columnar container for detections produced by all the models of the application.
+Instead of a DataFrame with per-row numpy arrays in object columns, the detections are stored as:
+- contiguous arrays of labels, boxes, confidences and morphology;
+- ragged buffer of polygon coordinates with the offsets of each polygon in it.
+The container is exported to pandas DataFrame only on demand.
+"""
+import numpy as np
+
+COLUMNS = ["id_label", "box", "mask", "confidence", "diameter", "area", "volume"]
+
+
+class Detections():
+    """
+    Columnar container of detections for a single image.
+
+    Input params are:
+    - id_label: np.array (N,) - labels of the detected objects;
+    - boxes: np.array (N, 4) - boxes in [x1, y1, w, h] pixel format, where x1, y1 - upper-left corner;
+    - confidence: np.array (N,) - confidences of the detections;
+    - coords: np.array (M, 2) - normalized (x, y) coordinates of all the polygons one after another;
+    - offsets: np.array (N + 1,) - polygon i occupies coords[offsets[i]:offsets[i + 1]];
+    - img_shape: tuple - (height, width) of the processed image;
+    - diameter, area, volume: np.array (N,) - morphology of the objects. NaN-filled if not given;
+    - bin_masks: optional list of N binary masks of the objects.
+    """
+    def __init__(self, id_label, boxes, confidence, coords, offsets, img_shape,
+                 diameter=None, area=None, volume=None, bin_masks=None):
+        self.id_label = np.asarray(id_label, dtype=np.int64)
+        n = len(self.id_label)
+        self.boxes = np.asarray(boxes, dtype=np.float64).reshape(n, 4)
+        self.confidence = np.asarray(confidence, dtype=np.float64).reshape(n)
+        self.coords = np.asarray(coords, dtype=np.float32).reshape(-1, 2)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.img_shape = (int(img_shape[0]), int(img_shape[1]))
+        self.diameter = self._column(diameter, n)
+        self.area = self._column(area, n)
+        self.volume = self._column(volume, n)
+        self.bin_masks = bin_masks
+
+    @staticmethod
+    def _column(values, n: int) -> np.array:
+        if values is None:
+            return np.full(n, np.nan)
+        return np.asarray(values, dtype=np.float64).reshape(n)
+
+    @classmethod
+    def from_polygons(cls, polygons: list, boxes, confidence, img_shape, id_label=None,
+                      diameter=None, area=None, volume=None, bin_masks=None):
+        """
+        Builds the container from a list of polygons in normalized coordinates.
+        Each polygon may be given as np.array of any shape with pairs of (x, y) coordinates, or as a list.
+        Labels default to the order of the polygons.
+        """
+        polygons = [np.asarray(polygon, dtype=np.float32).reshape(-1, 2) for polygon in polygons]
+        lengths = np.array([len(polygon) for polygon in polygons], dtype=np.int64)
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        coords = np.concatenate(polygons) if polygons else np.zeros((0, 2), dtype=np.float32)
+        if id_label is None:
+            id_label = np.arange(len(polygons))
+        return cls(id_label, boxes, confidence, coords, offsets, img_shape,
+                   diameter=diameter, area=area, volume=volume, bin_masks=bin_masks)
+
+    @classmethod
+    def empty_for(cls, img_shape):
+        """Builds the container without any detections."""
+        return cls.from_polygons([], np.zeros((0, 4)), np.zeros(0), img_shape)
+
+    def __len__(self):
+        return len(self.id_label)
+
+    @property
+    def shape(self):
+        """Shape of the equivalent DataFrame, kept for compatibility with the table consumers."""
+        return (len(self), len(COLUMNS) + (self.bin_masks is not None))
+
+    @property
+    def empty(self):
+        return len(self) == 0
+
+    def polygon(self, i: int) -> np.array:
+        """Returns the polygon of i-th detection as a view of the coordinates buffer."""
+        return self.coords[self.offsets[i]:self.offsets[i + 1]]
+
+    @property
+    def masks(self) -> list:
+        """Returns the list of polygons of all the detections."""
+        return np.split(self.coords, self.offsets[1:-1]) if len(self) > 0 else []
+
+    def __getitem__(self, key):
+        """
+        Gives DataFrame-like access to the columns by their names,
+        or selects the subset of detections given boolean mask or indices.
+        """
+        if isinstance(key, str):
+            if key == "box":
+                return self.boxes
+            if key == "mask":
+                return self.masks
+            if key == "bin_mask":
+                return self.bin_masks
+            if key in COLUMNS:
+                return getattr(self, key)
+            raise KeyError(key)
+        return self.subset(key)
+
+    def subset(self, index):
+        """
+        Selects the detections given boolean mask or indices.
+        The polygons are gathered from the ragged buffer without any per-object loops.
+        """
+        index = np.asarray(index)
+        if index.dtype == bool:
+            index = np.flatnonzero(index)
+        index = index.astype(np.int64).reshape(-1)
+        starts = self.offsets[index]
+        lengths = self.offsets[index + 1] - starts
+        offsets = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        positions = np.repeat(starts - offsets[:-1], lengths) + np.arange(offsets[-1])
+        bin_masks = None
+        if self.bin_masks is not None:
+            bin_masks = [self.bin_masks[i] for i in index]
+        return Detections(self.id_label[index], self.boxes[index], self.confidence[index],
+                          self.coords[positions], offsets, self.img_shape,
+                          diameter=self.diameter[index], area=self.area[index],
+                          volume=self.volume[index], bin_masks=bin_masks)
+
+    def box_areas(self) -> np.array:
+        """Returns the areas of the boxes relative to the image area (between 0.0 and 1.0)."""
+        return self.boxes[:, 2] * self.boxes[:, 3] / (self.img_shape[0] * self.img_shape[1])
+
+    def filter_by_score(self, min_score: float):
+        """Keeps the detections with confidence >= min_score."""
+        return self.subset(self.confidence >= min_score)
+
+    def filter_by_size(self, min_size: float = 0.0, max_size: float = 1.0):
+        """Keeps the detections with relative box area in [min_size, max_size] range."""
+        areas = self.box_areas()
+        return self.subset((areas >= min_size) & (areas <= max_size))
+
+    def to_pandas(self, columns: list = None) -> "pd.DataFrame":
+        """
+        Exports the detections to pandas DataFrame of the standard form.
+
+        Input params:
+        - columns: list - columns to be exported. Default to all the columns.
+
+        Returns:
+        - pd.DataFrame with one row per detection.
+        """
+        import pandas as pd
+        if columns is None:
+            columns = COLUMNS + (["bin_mask"] if self.bin_masks is not None else [])
+        data = {}
+        for column in columns:
+            values = self[column]
+            data[column] = list(values) if column in ("box", "mask", "bin_mask") else values
+        return pd.DataFrame(data, columns=columns)
+
+    def __repr__(self):
+        return repr(self.to_pandas())
@@ -0,0 +1,278 @@
+"""
+Here we define the conversion of YOLO segmenters to CPU-optimized runtimes.
+A segmenter (.pt) is exported to ONNX or OpenVINO format, optionally with static int8
+quantization calibrated on a small set of our own microimages. The exported model is then
+compared with the original fp32 model on a set of images, and may be registered in
+modelconfig.json with 'exported_segmenter' model type, see model.ExportedSegmenter.
+The packages needed for the export (onnx, onnxruntime, openvino) are listed in requirements-export.txt.
+
+Example of usage from the command line:
+    python -m model.export "YOLO-512 Segmenter" --format onnx --int8 --calibration path/to/folder --register
+"""
+import os
+import json
+import time
+import argparse
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from model.BaseModel import OUT_DIR
+from model.utils import load_image_bgr, is_image_valid, rasterize_labels, label_iou
+
+EXPORT_DIR = OUT_DIR / "export"
+FORMATS = ("onnx", "openvino")
+# number of calibration images used by default, more images rarely change the quantization ranges
+DEFAULT_NUM_CALIBRATION = 32
+REPORT_COLUMNS = ["File name", "Reference", "Exported", "Matched", "Precision", "Recall", "F1",
+                  "Mean IoU", "Reference time", "Exported time"]
+
+
+def sample_images(folder: str, num_images: int = None) -> list:
+    """Takes up to num_images images evenly spread over the sorted images of the folder (all if None)."""
+    img_paths = sorted(os.path.join(folder, file) for file in os.listdir(folder) if is_image_valid(file))
+    if not img_paths:
+        raise ValueError(f"No images found in {folder}")
+    if num_images is not None and len(img_paths) > num_images:
+        img_paths = [img_paths[i] for i in np.linspace(0, len(img_paths) - 1, num_images).astype(int)]
+    return img_paths
+
+
+def letterbox(image: np.array, imgsz: int) -> np.array:
+    """
+    Prepares BGR image as the input tensor (1, 3, imgsz, imgsz) of the exported model,
+    the same way ultralytics does: resizing with kept aspect ratio, centered gray padding,
+    RGB channels order and 0.0-1.0 range.
+    """
+    height, width = image.shape[:2]
+    ratio = min(imgsz / height, imgsz / width)
+    new_height, new_width = int(round(height * ratio)), int(round(width * ratio))
+    resized = cv2.resize(image, (new_width, new_height), interpolation=cv2.INTER_LINEAR)
+    top, left = (imgsz - new_height) // 2, (imgsz - new_width) // 2
+    padded = np.full((imgsz, imgsz, 3), 114, dtype=np.uint8)
+    padded[top:top + new_height, left:left + new_width] = resized
+    return np.ascontiguousarray(padded[:, :, ::-1].transpose(2, 0, 1)[np.newaxis], dtype=np.float32) / 255
+
+
+def quantize_onnx(path_to_onnx: str, calibration_images: list, imgsz: int) -> str:
+    """
+    Applies static int8 quantization (QDQ format, per-channel weights) to the exported ONNX model.
+    The activation ranges are calibrated on the given images.
+
+    Input params:
+    - path_to_onnx: str - path to fp32 ONNX model;
+    - calibration_images: list of paths to the calibration images;
+    - imgsz: int - input size of the model.
+
+    Returns:
+    - str path to the quantized model, saved next to the fp32 one with '-int8' suffix.
+    """
+    import onnx
+    from onnxruntime.quantization import (CalibrationDataReader, CalibrationMethod, QuantFormat,
+                                          QuantType, quantize_static)
+    from onnxruntime.quantization.shape_inference import quant_pre_process
+
+    class ImagesReader(CalibrationDataReader):
+        def __init__(self, input_name):
+            self.inputs = iter({input_name: letterbox(load_image_bgr(img_path), imgsz)}
+                               for img_path in calibration_images)
+
+        def get_next(self):
+            return next(self.inputs, None)
+
+    input_name = onnx.load(path_to_onnx, load_external_data=False).graph.input[0].name
+    stem = os.path.splitext(path_to_onnx)[0]
+    preprocessed_path = f"{stem}-preprocessed.onnx"
+    quantized_path = f"{stem}-int8.onnx"
+    quant_pre_process(path_to_onnx, preprocessed_path)
+    try:
+        quantize_static(preprocessed_path, quantized_path, ImagesReader(input_name),
+                        quant_format=QuantFormat.QDQ, per_channel=True,
+                        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+                        calibrate_method=CalibrationMethod.MinMax)
+    finally:
+        if os.path.exists(preprocessed_path):
+            os.remove(preprocessed_path)
+    # the metadata of ultralytics (imgsz, names, task) is needed for running the quantized model
+    original = onnx.load(path_to_onnx, load_external_data=False)
+    quantized = onnx.load(quantized_path)
+    del quantized.metadata_props[:]
+    quantized.metadata_props.extend(original.metadata_props)
+    onnx.save(quantized, quantized_path)
+    return quantized_path
+
+
+def _calibration_dataset(calibration_images: list, names: dict) -> str:
+    """Writes ultralytics dataset config with the calibration images, as needed for OpenVINO int8 export."""
+    import yaml
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    list_path = EXPORT_DIR / "calibration.txt"
+    with open(list_path, 'w') as f:
+        f.write("\n".join(os.path.abspath(img_path) for img_path in calibration_images))
+    data_path = EXPORT_DIR / "calibration.yaml"
+    with open(data_path, 'w') as f:
+        yaml.safe_dump({"train": str(list_path.absolute()), "val": str(list_path.absolute()),
+                        "names": dict(names)}, f)
+    return str(data_path)
+
+
+def export_segmenter(path_to_model: str, export_format: str = "onnx", int8: bool = False,
+                     calibration_images: list = None, imgsz: int = None) -> str:
+    """
+    Exports YOLO segmenter to the given format.
+    The models are exported with dynamic input shapes, so that the same artifact serves both
+    the x20 images and the batches of x10 slices.
+
+    Input params:
+    - path_to_model: str - path to .pt YOLO segmenter;
+    - export_format: str - 'onnx' or 'openvino';
+    - int8: bool - whether to apply static int8 quantization;
+    - calibration_images: list of paths to the calibration images, required for int8;
+    - imgsz: int - input size of the exported model. Default to the training size of the model.
+
+    Returns:
+    - str path to the exported model (.onnx file or OpenVINO model directory).
+    """
+    from ultralytics import YOLO
+    if export_format not in FORMATS:
+        raise ValueError(f"Unknown export format '{export_format}', expected one of {FORMATS}")
+    if int8 and not calibration_images:
+        raise ValueError("Calibration images are required for int8 quantization")
+    model = YOLO(path_to_model, task="segment")
+    imgsz = imgsz or model.overrides.get("imgsz", 640)
+    if export_format == "onnx":
+        exported_path = model.export(format="onnx", imgsz=imgsz, dynamic=True, simplify=True)
+        if int8:
+            exported_path = quantize_onnx(exported_path, calibration_images, imgsz)
+    else:
+        kwargs = {}
+        if int8:
+            kwargs = {"int8": True, "data": _calibration_dataset(calibration_images, model.names)}
+        exported_path = model.export(format="openvino", imgsz=imgsz, dynamic=True, **kwargs)
+    return str(exported_path)
+
+
+def match_detections(reference, candidate, iou_threshold: float = 0.5):
+    """
+    Matches the masks of 2 Detections of the same image one-to-one by their IoU.
+
+    Returns:
+    - iou: np.array of IoU values of the matched pairs with IoU >= iou_threshold.
+    """
+    from model.tracker import associate
+    img_shape = reference.img_shape
+    labels_1, areas_1 = rasterize_labels(reference.masks, img_shape)
+    labels_2, areas_2 = rasterize_labels(candidate.masks, img_shape)
+    iou_matrix = label_iou(labels_1, areas_1, labels_2, areas_2)
+    rows, cols = associate(iou_matrix)
+    iou = iou_matrix[rows, cols]
+    return iou[iou >= iou_threshold]
+
+
+def accuracy_report(reference, exported, img_paths: list, iou_threshold: float = 0.5,
+                    min_score: float = 0.05):
+    """
+    Compares the detections of the exported model with those of the reference fp32 model.
+    The detections of the reference model are taken as ground truth.
+
+    Input params:
+    - reference, exported: Segmenter instances of the fp32 and the exported models;
+    - img_paths: list of paths to the evaluation images;
+    - iou_threshold: float - minimal IoU of the matched masks. Default to 0.5;
+    - min_score: float - minimal confidence of the compared detections.
+
+    Returns:
+    - pd.DataFrame with one row per image, see REPORT_COLUMNS.
+    """
+    import pandas as pd
+    rows = []
+    for img_path in img_paths:
+        image = load_image_bgr(img_path)
+        start_time = time.perf_counter()
+        reference_detections = reference.count_batch([image], min_score=min_score)[0]
+        reference_time = time.perf_counter() - start_time
+        start_time = time.perf_counter()
+        exported_detections = exported.count_batch([image], min_score=min_score)[0]
+        exported_time = time.perf_counter() - start_time
+        num_reference = 0 if reference_detections is None else len(reference_detections)
+        num_exported = 0 if exported_detections is None else len(exported_detections)
+        iou = np.zeros(0)
+        if num_reference > 0 and num_exported > 0:
+            iou = match_detections(reference_detections, exported_detections, iou_threshold)
+        precision = len(iou) / num_exported if num_exported > 0 else float(num_reference == 0)
+        recall = len(iou) / num_reference if num_reference > 0 else float(num_exported == 0)
+        f1 = 2 * precision * recall / (precision + recall) if precision + recall > 0 else 0.0
+        rows.append({"File name": os.path.basename(img_path), "Reference": num_reference,
+                     "Exported": num_exported, "Matched": len(iou), "Precision": precision,
+                     "Recall": recall, "F1": f1, "Mean IoU": iou.mean() if len(iou) > 0 else None,
+                     "Reference time": reference_time, "Exported time": exported_time})
+    return pd.DataFrame(rows, columns=REPORT_COLUMNS)
+
+
+def register_model(model_name: str, exported_path: str, config_path: str = "modelconfig.json"):
+    """Adds the exported model to modelconfig.json with 'exported_segmenter' model type."""
+    with open(config_path, 'r') as f:
+        models = json.load(f)
+    models[model_name] = {"path": Path(exported_path).as_posix(), "model_type": "exported_segmenter"}
+    with open(config_path, 'w') as f:
+        json.dump(models, f, indent=4, ensure_ascii=False)
+
+
+def main():
+    """Command line entry point of the export."""
+    parser = argparse.ArgumentParser(description="Export of YOLO segmenters to ONNX / OpenVINO.")
+    parser.add_argument("model", help="segmenter name as defined in modelconfig.json")
+    parser.add_argument("--config", default="modelconfig.json", help="path to the models config file")
+    parser.add_argument("--format", default="onnx", choices=FORMATS, help="export format")
+    parser.add_argument("--int8", action="store_true", help="apply static int8 quantization")
+    parser.add_argument("--calibration", default=None, help="folder with calibration images")
+    parser.add_argument("--num-calibration", type=int, default=DEFAULT_NUM_CALIBRATION,
+                        help="number of calibration images")
+    parser.add_argument("--eval", default=None,
+                        help="folder with evaluation images. Default to the calibration folder")
+    parser.add_argument("--imgsz", type=int, default=None, help="input size of the exported model")
+    parser.add_argument("--register", action="store_true", help="add the exported model to the config")
+    args = parser.parse_args()
+
+    with open(args.config, 'r') as f:
+        models = json.load(f)
+    if args.model not in models:
+        raise ValueError(f"Unknown model '{args.model}'. Available models: {list(models.keys())}")
+    model_config = models[args.model]
+    # the exported segmenters can not be exported again, only the original PyTorch ones
+    if model_config['model_type'] != "segmenter":
+        raise ValueError(f"Model '{args.model}' is not a PyTorch YOLO segmenter "
+                         f"(model type '{model_config['model_type']}')")
+
+    calibration_images = None
+    if args.calibration:
+        calibration_images = sample_images(args.calibration, args.num_calibration)
+    exported_path = export_segmenter(model_config['path'], export_format=args.format, int8=args.int8,
+                                     calibration_images=calibration_images, imgsz=args.imgsz)
+    print(f"Exported model saved to {exported_path}")
+
+    eval_folder = args.eval or args.calibration
+    if eval_folder:
+        from model.batch import headless_object_size
+        from model.segmenter import Segmenter
+        from model.ExportedSegmenter import ExportedSegmenter
+        reference = Segmenter(model_config['path'], object_size=headless_object_size())
+        exported = ExportedSegmenter(exported_path, object_size=headless_object_size())
+        report = accuracy_report(reference, exported, sample_images(eval_folder))
+        os.makedirs(EXPORT_DIR, exist_ok=True)
+        report_path = EXPORT_DIR / f"{Path(exported_path).stem}_report.csv"
+        report.to_csv(report_path, sep=';', index=False)
+        print(f"Precision: {report['Precision'].mean():.3f}, Recall: {report['Recall'].mean():.3f}, "
+              f"F1: {report['F1'].mean():.3f}, Mean IoU: {report['Mean IoU'].mean():.3f}")
+        print(f"Speed-up: {report['Reference time'].sum() / report['Exported time'].sum():.2f}x. "
+              f"Report saved to {report_path}")
+
+    if args.register:
+        suffix = f"{args.format.upper()}{' int8' if args.int8 else ''}"
+        register_model(f"{args.model} {suffix}", exported_path, args.config)
+        print(f"Model registered in {args.config} as '{args.model} {suffix}'")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""
+Here we define the reader of LSM and multi-channel TIFF images.
+The reader keeps the file open and memory-maps the pixel data of the image when the file layout
+allows it (uncompressed contiguous data, which is the usual case for LSM files), so that only the
+requested channels are actually read from the disk. Compressed files are decoded once per handle.
+The recently used handles are cached, so that the UI and the models share one handle per file.
+
+Z-stacks and time series stored in a single file are read page by page with PageStream,
+which decodes the pages lazily in a background thread with bounded read-ahead.
+"""
+import os
+import queue
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# number of files kept open in the cache of readers
+MAX_OPEN_READERS = 4
+
+_readers = OrderedDict()
+
+
+def to_uint8(channel: np.array) -> np.array:
+    """Converts the channel of any integer or float type to uint8, scaling it by its maximum value."""
+    channel = np.asarray(channel)
+    if channel.dtype == np.uint8:
+        return channel
+    max_value = float(np.max(channel)) if channel.size > 0 else 0.0
+    if max_value <= 0:
+        return np.zeros(channel.shape, dtype=np.uint8)
+    return (channel.astype(np.float32) * (255.0 / max_value)).astype(np.uint8)
+
+
+def _chw_shape(shape: tuple, axes: str) -> tuple:
+    """Returns (C, H, W) shape of the page given its shape and axes."""
+    if len(shape) == 2:
+        return (1, shape[0], shape[1])
+    if axes.endswith("S"):
+        return (shape[2], shape[0], shape[1])
+    return tuple(shape[-3:])
+
+
+def _to_chw(data: np.array, shape: tuple) -> np.array:
+    """Brings the pixel data of the page to (C, H, W) order without copying."""
+    if data.ndim == 2:
+        data = data[np.newaxis]
+    elif shape != data.shape[-3:]:
+        data = np.moveaxis(data, -1, -3)
+    return data.reshape(shape)
+
+
+def _page_pixels(path: str, page, byteorder: str) -> np.array:
+    """Memory-maps the pixel data of the given page if possible, otherwise decodes it."""
+    if page.is_memmappable:
+        return np.memmap(path, dtype=page.dtype.newbyteorder(byteorder), mode='r',
+                         offset=page.dataoffsets[0], shape=page.shape)
+    return page.asarray()
+
+
+class LsmReader():
+    """
+    Reader of the first image of LSM / TIFF file, giving access to its channels.
+
+    Input params are:
+    - path: str - path to the LSM / TIFF file.
+
+    The image is exposed in (C, H, W) order: grayscale images have a single channel,
+    and images with interleaved samples (H, W, C) are transposed as views.
+    """
+    def __init__(self, path: str):
+        import tifffile
+        self.path = path
+        self.tif = tifffile.TiffFile(path)
+        page = self.tif.pages[0]
+        self.axes = page.axes
+        self.dtype = page.dtype
+        self.memory_mapped = bool(page.is_memmappable)
+        self.shape = _chw_shape(page.shape, page.axes)
+        self._data = None
+
+    @property
+    def num_channels(self) -> int:
+        return self.shape[0]
+
+    @property
+    def height(self) -> int:
+        return self.shape[1]
+
+    @property
+    def width(self) -> int:
+        return self.shape[2]
+
+    def _pixels(self) -> np.array:
+        """Returns the pixel data in (C, H, W) order, memory-mapped if possible."""
+        if self._data is None:
+            data = _page_pixels(self.path, self.tif.pages[0], self.tif.byteorder)
+            self._data = _to_chw(data, self.shape)
+        return self._data
+
+    def _check_channel(self, channel: int):
+        if not 0 <= channel < self.num_channels:
+            raise ValueError(f"Channel {channel} is out of range for image with "
+                             f"{self.num_channels} channels: {self.path}")
+
+    def channel(self, channel: int) -> np.array:
+        """Reads the given channel as (H, W) array."""
+        self._check_channel(channel)
+        return np.array(self._pixels()[channel])
+
+    def channels(self, channels: list) -> np.array:
+        """Reads the given channels as (len(channels), H, W) array."""
+        for channel in channels:
+            self._check_channel(channel)
+        pixels = self._pixels()
+        return np.stack([pixels[channel] for channel in channels])
+
+    def close(self):
+        self._data = None
+        self.tif.close()
+
+
+def _file_key(path: str) -> tuple:
+    stat = os.stat(path)
+    return (os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def get_lsm_reader(path: str) -> LsmReader:
+    """
+    Returns the cached reader of the given file, opening it if needed.
+    The reader is reopened if the file was changed since it was opened.
+    """
+    key = _file_key(path)
+    if key in _readers:
+        _readers.move_to_end(key)
+        return _readers[key]
+    reader = LsmReader(path)
+    _readers[key] = reader
+    while len(_readers) > MAX_OPEN_READERS:
+        _readers.popitem(last=False)[1].close()
+    return reader
+
+
+def close_lsm_readers():
+    """Closes all the cached readers."""
+    while _readers:
+        _readers.popitem()[1].close()
+
+
+def read_lsm_channels(path: str, channels: list) -> np.array:
+    """Reads only the given channels of LSM / TIFF image as (len(channels), H, W) array."""
+    return get_lsm_reader(path).channels(channels)
+
+
+# axes holding the channels of the image, in the order of preference
+CHANNEL_AXES = "CS"
+
+
+class StackLayout():
+    """
+    Layout of the image series of multi-page LSM / TIFF file.
+    The leading axes of the series enumerate the pages, and the trailing ones are the axes of a page.
+    Depending on the format, the channels are either stored in each page (LSM, RGB and planar TIFF)
+    or as separate pages (ImageJ and OME hyperstacks), so a frame of the stack is a single page
+    in the former case and a group of pages in the latter one.
+
+    Input params are:
+    - series: tifffile.TiffPageSeries - image series of the file.
+
+    The frames are enumerated by all the page axes except the channel one (e.g. T and Z) in the file order.
+    """
+    def __init__(self, series):
+        shape, axes = tuple(series.shape), series.axes
+        num_pages = len(series.pages)
+        split = 0
+        while int(np.prod(shape[:split])) != num_pages:
+            split += 1
+            if split > len(shape):
+                raise ValueError(f"Can not split series of shape {shape} into {num_pages} pages")
+        self.stack_shape, self.stack_axes = shape[:split], axes[:split]
+        self.page_shape, self.page_axes = shape[split:], axes[split:]
+        self.channel_axis = next((axis for axis in CHANNEL_AXES if axis in axes), None)
+        spatial_axes = self.page_axes.replace(self.channel_axis or "", "")
+        if sorted(spatial_axes) != ["X", "Y"]:
+            raise ValueError(f"Unsupported axes {axes} of the image series, expected YX planes")
+        self.num_channels = shape[axes.index(self.channel_axis)] if self.channel_axis else 1
+        self.frame_shape = tuple(size for size, axis in zip(self.stack_shape, self.stack_axes)
+                                 if axis != self.channel_axis)
+
+    @property
+    def num_frames(self) -> int:
+        return int(np.prod(self.frame_shape))
+
+    @property
+    def channels_in_pages(self) -> bool:
+        """Whether the channels are stored as separate pages."""
+        return self.channel_axis is not None and self.channel_axis in self.stack_axes
+
+    def check_channels(self, channels: list, path: str):
+        for channel in channels:
+            if not 0 <= channel < self.num_channels:
+                raise ValueError(f"Channel {channel} is out of range for image with "
+                                 f"{self.num_channels} channels: {path}")
+
+    def page_index(self, frame_index: tuple, channel: int) -> int:
+        """Returns the index of the page in the series holding the given channel of the given frame."""
+        frame_index = iter(frame_index)
+        stack_index = [channel if axis == self.channel_axis else next(frame_index)
+                       for axis in self.stack_axes]
+        return int(np.ravel_multi_index(stack_index, self.stack_shape)) if stack_index else 0
+
+    def plane(self, pixels: np.array, channel: int) -> np.array:
+        """Returns the (H, W) plane of the given channel from the pixel data of the page."""
+        pixels = pixels.reshape(self.page_shape)
+        axes = self.page_axes
+        if self.channel_axis is not None and self.channel_axis in axes:
+            pixels = np.take(pixels, channel, axis=axes.index(self.channel_axis))
+            axes = axes.replace(self.channel_axis, "")
+        return pixels if axes == "YX" else pixels.T
+
+
+class PageStream():
+    """
+    Iterator over the frames of multi-page LSM / TIFF file (Z-stack or time series).
+    The frames are decoded lazily by a background thread, which reads at most read_ahead frames
+    ahead of the consumer, so that the file is never loaded into memory as a whole.
+    The pages are grouped into frames by the axes of the image series, see StackLayout,
+    so hyperstacks storing each channel as a separate page are streamed frame by frame as well.
+    Thumbnail pages of LSM files are skipped.
+
+    Input params are:
+    - path: str - path to the LSM / TIFF file;
+    - channels: list - channels to be read from each frame. Default to all the channels;
+    - read_ahead: int - maximal number of decoded frames waiting for the consumer. Default to 2.
+
+    Each iteration yields np.array (len(channels), H, W) of the next frame.
+    """
+    def __init__(self, path: str, channels: list = None, read_ahead: int = 2):
+        import tifffile
+        if read_ahead < 1:
+            raise ValueError(f"Read-ahead must be positive, got {read_ahead}")
+        self.path = path
+        self.read_ahead = read_ahead
+        with tifffile.TiffFile(path) as tif:
+            self.layout = StackLayout(tif.series[0])
+        self.channels = list(range(self.layout.num_channels)) if channels is None else list(channels)
+        self.layout.check_channels(self.channels, path)
+
+    def __len__(self):
+        return self.layout.num_frames
+
+    @staticmethod
+    def _put(output: queue.Queue, stop: threading.Event, item) -> bool:
+        """Puts the item into the queue unless the consumer has stopped. Returns False if stopped."""
+        while not stop.is_set():
+            try:
+                output.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def _produce(self, output: queue.Queue, stop: threading.Event):
+        import tifffile
+        layout = self.layout
+        try:
+            # the thread owns its own file handle, so the cached readers are not touched
+            with tifffile.TiffFile(self.path) as tif:
+                pages = tif.series[0].pages
+                for frame_index in np.ndindex(*layout.frame_shape):
+                    planes, page_pixels = [], {}
+                    for channel in self.channels:
+                        page_index = layout.page_index(frame_index, channel)
+                        if page_index not in page_pixels:
+                            page = pages[page_index]
+                            if hasattr(page, "aspage"):
+                                page = page.aspage()
+                            page_pixels[page_index] = _page_pixels(self.path, page, tif.byteorder)
+                        planes.append(layout.plane(page_pixels[page_index], channel))
+                    if not self._put(output, stop, np.stack(planes)):
+                        return
+        except Exception as e:
+            self._put(output, stop, e)
+            return
+        self._put(output, stop, None)
+
+    def __iter__(self):
+        output = queue.Queue(maxsize=self.read_ahead)
+        stop = threading.Event()
+        producer = threading.Thread(target=self._produce, args=(output, stop), daemon=True)
+        producer.start()
+        try:
+            while True:
+                data = output.get()
+                if data is None:
+                    return
+                if isinstance(data, Exception):
+                    raise data
+                yield data
+        finally:
+            # stops the producer when the consumer leaves the loop early
+            stop.set()
+            producer.join()
+
+
+def read_stack_layout(path: str) -> StackLayout:
+    """Reads the layout of the image series of the LSM / TIFF file, see StackLayout."""
+    import tifffile
+    with tifffile.TiffFile(path) as tif:
+        return StackLayout(tif.series[0])
+
+
+def is_multipage(path: str) -> bool:
+    """Checks whether the LSM / TIFF file contains more than one frame."""
+    return read_stack_layout(path).num_frames > 1
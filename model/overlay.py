@@ -0,0 +1,119 @@
+"""
+Here we define the renderer of the images with detections.
+All the detections of an image are rasterized only once into an int32 label image, where each
+pixel holds 1 + index of the detection drawn on top of it (0 for the background). Each redraw
+(e.g. after the filtering sliders were moved or the colormap was changed) is then a single
+lookup-table pass over the label image: the visibility table gives the mask of the drawn pixels
+and the color table gives their colors. The few pixels covered by several detections are kept
+aside, so that a hidden detection on top does not hide the visible ones below it.
+"""
+import cv2
+import numpy as np
+
+from model.detections import Detections
+from model.utils import colormap_to_hex, hex_to_bgr
+
+# colormap name -> np.array (num_colors, 3) of BGR colors
+_palettes = {}
+
+
+def get_palette(colormap: str) -> np.array:
+    """Returns BGR colors of the given colormap as np.array (num_colors, 3) of uint8."""
+    if colormap not in _palettes:
+        _palettes[colormap] = np.array(hex_to_bgr(colormap_to_hex(colormap)), dtype=np.uint8)
+    return _palettes[colormap]
+
+
+class LabelOverlay():
+    """
+    Renderer of the detections of a single image.
+
+    Input params are:
+    - image: np.array (H, W, 3) - BGR image the detections are drawn on;
+    - detections: Detections of the image with polygon masks.
+
+    The colors are assigned by the rank of the detection among the visible ones, and where the
+    visible polygons overlap, the pixels belong to the one drawn last, so the images are exactly
+    the same as drawn by model.utils.plot_predictions() for the visible detections only.
+    """
+    def __init__(self, image: np.array, detections: Detections):
+        self.image = image
+        self.detections = detections
+        self.num_labels = len(detections)
+        height, width = image.shape[:2]
+        coords = (detections.coords * np.array([width, height])).astype(np.int32)
+        polygons = np.split(coords, detections.offsets[1:-1]) if self.num_labels > 0 else []
+        # the polygons are drawn in order and in reverse order, so that the pixels covered
+        # by more than one detection are exactly those where the top and the bottom labels differ
+        self.label_image = np.zeros((height, width), dtype=np.int32)
+        bottom = np.zeros((height, width), dtype=np.int32)
+        for i, polygon in enumerate(polygons):
+            if len(polygon) > 0:
+                cv2.fillPoly(self.label_image, [polygon], i + 1)
+        for i in range(len(polygons) - 1, -1, -1):
+            if len(polygons[i]) > 0:
+                cv2.fillPoly(bottom, [polygons[i]], i + 1)
+        shared = self.label_image != bottom
+        # (pixel, label) pairs of the shared pixels, sorted by pixel and then in drawing order
+        pixels, labels = [np.zeros(0, dtype=np.int64)], [np.zeros(0, dtype=np.int64)]
+        if shared.any():
+            for i, polygon in enumerate(polygons):
+                if len(polygon) == 0:
+                    continue
+                x0, y0, w, h = cv2.boundingRect(polygon)
+                x0, y0 = max(x0, 0), max(y0, 0)
+                x1, y1 = min(x0 + w, width), min(y0 + h, height)
+                if x1 <= x0 or y1 <= y0 or not shared[y0:y1, x0:x1].any():
+                    continue
+                crop = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+                cv2.fillPoly(crop, [polygon - np.array([x0, y0], dtype=np.int32)], 1)
+                ys, xs = np.nonzero(crop.view(bool) & shared[y0:y1, x0:x1])
+                pixels.append((ys + y0) * width + xs + x0)
+                labels.append(np.full(len(ys), i, dtype=np.int64))
+        pixels, labels = np.concatenate(pixels), np.concatenate(labels)
+        order = np.lexsort((labels, pixels))
+        self.shared_pixels = pixels[order]
+        self.shared_labels = labels[order]
+
+    def _labels(self, visible: np.array) -> np.array:
+        """Returns the label image where the shared pixels belong to the top visible detection."""
+        if len(self.shared_pixels) == 0:
+            return self.label_image
+        label_image = self.label_image.copy()
+        flat = label_image.ravel()
+        flat[self.shared_pixels] = 0
+        shown = visible[self.shared_labels]
+        pixels, labels = self.shared_pixels[shown], self.shared_labels[shown]
+        top = np.ones(len(pixels), dtype=bool)
+        top[:-1] = pixels[1:] != pixels[:-1]
+        flat[pixels[top]] = labels[top] + 1
+        return label_image
+
+    def render(self, visible: np.array = None, colormap: str = "tab20", alpha: float = .75) -> np.array:
+        """
+        Draws the visible detections on the copy of the image.
+
+        Input params:
+        - visible: np.array of bool - which detections are drawn. Default to all the detections;
+        - colormap: str - name of the colormap, see model.utils.colormap_to_hex();
+        - alpha: float - opacity of the masks.
+
+        Returns:
+        - np.array (H, W, 3) - BGR image with detections.
+        """
+        if visible is None:
+            visible = np.ones(self.num_labels, dtype=bool)
+        visible = np.asarray(visible, dtype=bool)
+        palette = get_palette(colormap)
+        # BGR colors and the visibility are packed into uint32, so that the lookup is a single gather
+        lut = np.zeros((self.num_labels + 1, 4), dtype=np.uint8)
+        lut[1:][visible, :3] = palette[np.arange(np.count_nonzero(visible)) % len(palette)]
+        lut[1:][visible, 3] = 255
+
+        label_image = self._labels(visible)
+        colors = np.take(lut.view(np.uint32).ravel(), label_image, mode='clip')
+        colors = colors.view(np.uint8).reshape(label_image.shape + (4,))
+        blended = cv2.addWeighted(cv2.cvtColor(colors, cv2.COLOR_BGRA2BGR), alpha, self.image, 1 - alpha, 0)
+        output = self.image.copy()
+        cv2.copyTo(blended, cv2.extractChannel(colors, 3), output)
+        return output
@@ -0,0 +1,145 @@
+"""
+Here we define the process-wide pool of warm models.
+Models are keyed by their modelconfig.json entry and stay resident after switching to
+another model, so that comparing models on the same image does not reload the weights.
+When the total memory of the resident models exceeds the configured budget,
+the least recently used models are evicted.
+The budget of the application pool is set by MODEL_POOL_MEMORY_MB environment variable.
+"""
+import gc
+import os
+import sys
+from collections import OrderedDict
+
+from model.Model import Model
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+DEFAULT_MEMORY_BUDGET_MB = 4096
+# environment variable with the memory budget (in MB) of the application pool
+MEMORY_BUDGET_ENV = "MODEL_POOL_MEMORY_MB"
+# used when the memory of a model can not be measured nor estimated from its weights file
+DEFAULT_MODEL_SIZE_MB = 500
+
+
+def _process_memory_mb():
+    """Returns resident memory of the current process in MB, or None if psutil is not available."""
+    if psutil is None:
+        return None
+    return psutil.Process(os.getpid()).memory_info().rss / 2**20
+
+
+def read_memory_budget(default: float = DEFAULT_MEMORY_BUDGET_MB) -> float:
+    """
+    Reads the memory budget (in MB) of the model pool from MODEL_POOL_MEMORY_MB environment variable.
+    The default budget is used if the variable is not set or is not a positive number.
+    """
+    value = os.environ.get(MEMORY_BUDGET_ENV)
+    if not value:
+        return default
+    try:
+        memory_budget_mb = float(value)
+    except ValueError:
+        memory_budget_mb = 0
+    if memory_budget_mb <= 0:
+        print(f"Model pool: invalid {MEMORY_BUDGET_ENV}={value!r}, using {default} MB")
+        return default
+    return memory_budget_mb
+
+
+class ModelPool():
+    """
+    LRU pool of Model instances.
+
+    Input params are:
+    - memory_budget_mb: total memory (in MB) the resident models may occupy.
+    The most recently used model always stays resident, even if it alone exceeds the budget.
+    """
+    def __init__(self, memory_budget_mb: float = DEFAULT_MEMORY_BUDGET_MB):
+        self.memory_budget_mb = memory_budget_mb
+        # key -> (Model, memory in MB), ordered from least to most recently used
+        self.models = OrderedDict()
+
+    @staticmethod
+    def make_key(model_name: str, model_config: dict) -> tuple:
+        """Models are identified by their config entry name, path and type."""
+        return (model_name, model_config['path'], model_config['model_type'])
+
+    def get(self, model_name: str, model_config: dict) -> Model:
+        """
+        Returns the model for the given modelconfig.json entry, loading it if it is not resident.
+
+        Input params:
+        - model_name: str - name of the model in modelconfig.json;
+        - model_config: dict - config entry of the model with 'path', 'model_type' and 'object_size'.
+
+        Returns:
+        - Model instance.
+        """
+        key = self.make_key(model_name, model_config)
+        if key in self.models:
+            self.models.move_to_end(key)
+            model = self.models[key][0]
+        else:
+            memory_before = _process_memory_mb()
+            model = Model(path=model_config['path'], object_size=model_config['object_size'],
+                          model_type=model_config['model_type'])
+            memory_after = _process_memory_mb()
+            self.models[key] = (model, self._estimate_memory(model_config, memory_before, memory_after))
+            self.evict()
+        # UI params may be re-created (e.g. when switching plugins), so they are refreshed on every access
+        model.cell_counter.object_size = model_config['object_size']
+        return model
+
+    @staticmethod
+    def _estimate_memory(model_config: dict, memory_before, memory_after) -> float:
+        """Measures memory of the loaded model, falling back to the size of its weights file."""
+        if memory_before is not None and memory_after is not None and memory_after > memory_before:
+            return memory_after - memory_before
+        if os.path.isfile(model_config['path']):
+            return os.path.getsize(model_config['path']) / 2**20
+        return DEFAULT_MODEL_SIZE_MB
+
+    @property
+    def memory_mb(self) -> float:
+        """Total estimated memory of the resident models."""
+        return sum(memory for _, memory in self.models.values())
+
+    def evict(self):
+        """Evicts the least recently used models until the pool fits into the memory budget."""
+        evicted = False
+        while len(self.models) > 1 and self.memory_mb > self.memory_budget_mb:
+            key, _ = self.models.popitem(last=False)
+            print(f"Model pool: evicting {key[0]}")
+            evicted = True
+        if evicted:
+            self._release_memory()
+
+    def remove(self, model_name: str, model_config: dict):
+        """Drops the given model from the pool, e.g. after it failed."""
+        if self.models.pop(self.make_key(model_name, model_config), None) is not None:
+            self._release_memory()
+
+    def clear(self):
+        """Drops all the resident models."""
+        self.models.clear()
+        self._release_memory()
+
+    def set_memory_budget(self, memory_budget_mb: float):
+        """Changes the memory budget and evicts the models which do not fit into it anymore."""
+        self.memory_budget_mb = memory_budget_mb
+        self.evict()
+
+    @staticmethod
+    def _release_memory():
+        gc.collect()
+        # torch is checked without importing it, since not every backend needs it
+        torch = sys.modules.get("torch")
+        if torch is not None and torch.cuda.is_available():
+            torch.cuda.empty_cache()
+
+
+MODEL_POOL = ModelPool(memory_budget_mb=read_memory_budget())
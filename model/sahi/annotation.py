@@ -9,6 +9,7 @@ import numpy as np
 from model.sahi.utils.coco import CocoAnnotation, CocoPrediction
 from model.sahi.utils.cv import (
     get_bbox_from_coco_segmentation,
+    get_bool_mask_crop_from_coco_segmentation,
     get_bool_mask_from_coco_segmentation,
     get_coco_segmentation_from_bool_mask,
 )
@@ -20,6 +21,9 @@ class BoundingBox:
     Bounding box of the annotation.
     """
 
+    # the slots keep the per-object records compact, sliced inference produces thousands of them
+    __slots__ = ("minx", "miny", "maxx", "maxy", "shift_x", "shift_y")
+
     def __init__(self, box: List[float], shift_amount: List[int] = [0, 0]):
         """
         Args:
@@ -107,6 +111,8 @@ class Category:
     Category of the annotation.
     """
 
+    __slots__ = ("id", "name")
+
     def __init__(self, id=None, name=None):
         """
         Args:
@@ -127,6 +133,16 @@ class Category:
 
 
 class Mask:
+    __slots__ = (
+        "shift_x",
+        "shift_y",
+        "full_shape_height",
+        "full_shape_width",
+        "_segmentation",
+        "_bool_mask_crop",
+        "_offset",
+    )
+
     @classmethod
     def from_float_mask(
         cls,
@@ -192,6 +208,17 @@ class Mask:
 
         self.segmentation = segmentation
 
+    @property
+    def segmentation(self):
+        return self._segmentation
+
+    @segmentation.setter
+    def segmentation(self, segmentation):
+        self._segmentation = segmentation
+        # the bitmap is rasterized from the segmentation on first use
+        self._bool_mask_crop = None
+        self._offset = None
+
     @classmethod
     def from_bool_mask(
         cls,
@@ -215,18 +242,57 @@ class Mask:
             full_shape=full_shape,
         )
 
+    def _rasterize(self):
+        if self._bool_mask_crop is None:
+            self._bool_mask_crop, self._offset = get_bool_mask_crop_from_coco_segmentation(
+                self.segmentation, width=self.full_shape[1], height=self.full_shape[0]
+            )
+
+    @property
+    def bool_mask_crop(self):
+        """
+        Returns 2D boolean mask of the bounding box of the segmentation only, see offset.
+        It is rasterized once and cached.
+        """
+        self._rasterize()
+        return self._bool_mask_crop
+
+    @property
+    def offset(self):
+        """
+        Returns the position of bool_mask_crop in the full mask as [x, y]
+        """
+        self._rasterize()
+        return self._offset
+
     @property
     def bool_mask(self):
-        return get_bool_mask_from_coco_segmentation(
-            self.segmentation, width=self.full_shape[1], height=self.full_shape[0]
-        )
+        """
+        Returns 2D boolean mask of the full shape
+        """
+        bool_mask = np.zeros(self.full_shape, dtype=bool)
+        crop, (x, y) = self.bool_mask_crop, self.offset
+        bool_mask[y : y + crop.shape[0], x : x + crop.shape[1]] = crop
+        return bool_mask
 
     @property
     def shape(self):
         """
         Returns mask shape as [height, width]
         """
-        return [self.bool_mask.shape[0], self.bool_mask.shape[1]]
+        return [self.full_shape_height, self.full_shape_width]
+
+    @property
+    def area(self):
+        """
+        Returns the area enclosed by the polygons of the segmentation (shoelace formula)
+        """
+        area = 0.0
+        for segmentation in self.segmentation:
+            points = np.asarray(segmentation[: len(segmentation) // 2 * 2], dtype=np.float64).reshape(-1, 2)
+            x, y = points[:, 0], points[:, 1]
+            area += abs(np.dot(x, np.roll(y, -1)) - np.dot(y, np.roll(x, -1))) / 2
+        return area
 
     @property
     def full_shape(self):
@@ -246,11 +312,12 @@ class Mask:
         # Confirm full_shape is specified
         if (self.full_shape_height is None) or (self.full_shape_width is None):
             raise ValueError("full_shape is None")
+        shift = np.array([self.shift_x, self.shift_y])
+        full_size = np.array([self.full_shape_width, self.full_shape_height])
         shifted_segmentation = []
         for s in self.segmentation:
-            xs = [min(self.shift_x + s[i], self.full_shape_width) for i in range(0, len(s) - 1, 2)]
-            ys = [min(self.shift_y + s[i], self.full_shape_height) for i in range(1, len(s), 2)]
-            shifted_segmentation.append([j for i in zip(xs, ys) for j in i])
+            points = np.asarray(s[: len(s) // 2 * 2]).reshape(-1, 2)
+            shifted_segmentation.append(np.minimum(points + shift, full_size).ravel().tolist())
         return Mask(
             segmentation=shifted_segmentation,
             shift_amount=[0, 0],
@@ -263,6 +330,8 @@ class ObjectAnnotation:
     All about an annotation such as Mask, Category, BoundingBox.
     """
 
+    __slots__ = ("bbox", "mask", "category", "merged")
+
     @classmethod
     def from_bool_mask(
         cls,
@@ -10,6 +10,9 @@ from model.sahi.utils.torch import select_device as select_torch_device
 
 
 class DetectionModel:
+    # whether perform_inference accepts a list of images processed as a single batch
+    supports_batch = False
+
     def __init__(
         self,
         model_path: Optional[str] = None,
@@ -2,7 +2,7 @@
 # Code written by AnNT, 2023.
 
 import logging
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Union
 
 import cv2
 import numpy as np
@@ -18,6 +18,8 @@ from model.sahi.utils.import_utils import check_requirements
 
 
 class Yolov8DetectionModel(DetectionModel):
+    supports_batch = True
+
     def check_dependencies(self) -> None:
         check_requirements(["ultralytics"])
 
@@ -49,13 +51,14 @@ class Yolov8DetectionModel(DetectionModel):
             category_mapping = {str(ind): category_name for ind, category_name in enumerate(self.category_names)}
             self.category_mapping = category_mapping
 
-    def perform_inference(self, image: np.ndarray):
+    def perform_inference(self, image: Union[np.ndarray, List[np.ndarray]]):
         """
         Prediction is performed using self.model and the prediction result is set to self._original_predictions.
         If predictions have masks, each prediction is a tuple like (boxes, masks).
         Args:
-            image: np.ndarray
+            image: np.ndarray or list of np.ndarray
                 A numpy array that contains the image to be predicted. 3 channel image should be in RGB order.
+                A list of arrays is passed through the model as a single batch.
 
         """
 
@@ -70,13 +73,15 @@ class Yolov8DetectionModel(DetectionModel):
         if self.image_size is not None:
             kwargs = {"imgsz": self.image_size, **kwargs}
 
-        prediction_result = self.model(image[:, :, ::-1], imgsz=512, max_det=600, **kwargs)  # YOLOv8 expects numpy arrays to have BGR
+        images = image if isinstance(image, (list, tuple)) else [image]
+        # YOLOv8 expects numpy arrays to have BGR
+        prediction_result = self.model([img[:, :, ::-1] for img in images], imgsz=512, max_det=600,
+                                       batch=len(images), **kwargs)
 
         if self.has_mask:
-            if not prediction_result[0].masks:
-                prediction_result[0].masks = Masks(
-                    torch.tensor([], device=self.model.device), prediction_result[0].boxes.orig_shape
-                )
+            for result in prediction_result:
+                if not result.masks:
+                    result.masks = Masks(torch.tensor([], device=self.model.device), result.boxes.orig_shape)
 
             # We do not filter results again as confidence threshold is already applied above
             prediction_result = [
@@ -92,7 +97,8 @@ class Yolov8DetectionModel(DetectionModel):
             prediction_result = [result.boxes.data for result in prediction_result]
 
         self._original_predictions = prediction_result
-        self._original_shape = image.shape
+        self._original_shapes = [img.shape for img in images]
+        self._original_shape = self._original_shapes[0]
 
     @property
     def category_names(self):
@@ -138,6 +144,7 @@ class Yolov8DetectionModel(DetectionModel):
         for image_ind, image_predictions in enumerate(original_predictions):
             shift_amount = shift_amount_list[image_ind]
             full_shape = None if full_shape_list is None else full_shape_list[image_ind]
+            orig_height, orig_width = self._original_shapes[image_ind][:2]
             object_prediction_list = []
             if self.has_mask:
                 image_predictions_in_xyxy_format = image_predictions[0]
@@ -155,8 +162,6 @@ class Yolov8DetectionModel(DetectionModel):
                     category_id = int(prediction[5])
                     category_name = self.category_mapping[str(category_id)]
 
-                    orig_width = self._original_shape[1]
-                    orig_height = self._original_shape[0]
                     bool_mask = cv2.resize(bool_mask.astype(np.uint8), (orig_width, orig_height))
                     segmentation = get_coco_segmentation_from_bool_mask(bool_mask)
                     if len(segmentation) == 0:
@@ -4,6 +4,7 @@
 import logging
 from typing import List
 
+import numpy as np
 import torch
 
 from model.sahi.postprocess.utils import ObjectPredictionList, has_match, merge_object_prediction_pair
@@ -13,7 +14,12 @@ from model.sahi.utils.import_utils import check_requirements
 logger = logging.getLogger(__name__)
 
 
-def batched_nms(predictions: torch.tensor, match_metric: str = "IOU", match_threshold: float = 0.5):
+def batched_nms(
+    predictions: torch.tensor,
+    match_metric: str = "IOU",
+    match_threshold: float = 0.5,
+    spatial_index: bool = False,
+):
     """
     Apply non-maximum suppression to avoid detecting too many
     overlapping bounding boxes for a given object.
@@ -23,6 +29,7 @@ def batched_nms(predictions: torch.tensor, match_metric: str = "IOU", match_thre
         match_metric: (str) IOU or IOS
         match_threshold: (float) The overlap thresh for
             match metric.
+        spatial_index: (bool) Use spatial_nms() instead of nms().
     Returns:
         A list of filtered indexes, Shape: [ ,]
     """
@@ -32,7 +39,8 @@ def batched_nms(predictions: torch.tensor, match_metric: str = "IOU", match_thre
     keep_mask = torch.zeros_like(category_ids, dtype=torch.bool)
     for category_id in torch.unique(category_ids):
         curr_indices = torch.where(category_ids == category_id)[0]
-        curr_keep_indices = nms(predictions[curr_indices], match_metric, match_threshold)
+        curr_nms = spatial_nms if spatial_index else nms
+        curr_keep_indices = curr_nms(predictions[curr_indices], match_metric, match_threshold)
         keep_mask[curr_indices[curr_keep_indices]] = True
     keep_indices = torch.where(keep_mask)[0]
     # sort selected indices by their scores
@@ -151,6 +159,7 @@ def batched_greedy_nmm(
     object_predictions_as_tensor: torch.tensor,
     match_metric: str = "IOU",
     match_threshold: float = 0.5,
+    spatial_index: bool = False,
 ):
     """
     Apply greedy version of non-maximum merging per category to avoid detecting
@@ -161,6 +170,7 @@ def batched_greedy_nmm(
         match_metric: (str) IOU or IOS
         match_threshold: (float) The overlap thresh for
             match metric.
+        spatial_index: (bool) Use spatial_greedy_nmm() instead of greedy_nmm().
     Returns:
         keep_to_merge_list: (Dict[int:List[int]]) mapping from prediction indices
         to keep to a list of prediction indices to be merged.
@@ -169,7 +179,10 @@ def batched_greedy_nmm(
     keep_to_merge_list = {}
     for category_id in torch.unique(category_ids):
         curr_indices = torch.where(category_ids == category_id)[0]
-        curr_keep_to_merge_list = greedy_nmm(object_predictions_as_tensor[curr_indices], match_metric, match_threshold)
+        curr_greedy_nmm = spatial_greedy_nmm if spatial_index else greedy_nmm
+        curr_keep_to_merge_list = curr_greedy_nmm(
+            object_predictions_as_tensor[curr_indices], match_metric, match_threshold
+        )
         curr_indices_list = curr_indices.tolist()
         for curr_keep, curr_merge_list in curr_keep_to_merge_list.items():
             keep = curr_indices_list[curr_keep]
@@ -298,6 +311,7 @@ def batched_nmm(
     object_predictions_as_tensor: torch.tensor,
     match_metric: str = "IOU",
     match_threshold: float = 0.5,
+    spatial_index: bool = False,
 ):
     """
     Apply non-maximum merging per category to avoid detecting too many
@@ -308,6 +322,7 @@ def batched_nmm(
         match_metric: (str) IOU or IOS
         match_threshold: (float) The overlap thresh for
             match metric.
+        spatial_index: (bool) Use spatial_nmm() instead of nmm().
     Returns:
         keep_to_merge_list: (Dict[int:List[int]]) mapping from prediction indices
         to keep to a list of prediction indices to be merged.
@@ -316,7 +331,8 @@ def batched_nmm(
     keep_to_merge_list = {}
     for category_id in torch.unique(category_ids):
         curr_indices = torch.where(category_ids == category_id)[0]
-        curr_keep_to_merge_list = nmm(object_predictions_as_tensor[curr_indices], match_metric, match_threshold)
+        curr_nmm = spatial_nmm if spatial_index else nmm
+        curr_keep_to_merge_list = curr_nmm(object_predictions_as_tensor[curr_indices], match_metric, match_threshold)
         curr_indices_list = curr_indices.tolist()
         for curr_keep, curr_merge_list in curr_keep_to_merge_list.items():
             keep = curr_indices_list[curr_keep]
@@ -444,6 +460,253 @@ def nmm(
     return keep_to_merge_list
 
 
+def _predictions_to_numpy(predictions):
+    """Returns float32 np.ndarray of size N x [x1, y1, x2, y2, score, ...] given a tensor or an array."""
+    if torch.is_tensor(predictions):
+        predictions = predictions.detach().cpu().numpy()
+    return np.asarray(predictions, dtype=np.float32)
+
+
+def _is_spatially_indexable(predictions: np.ndarray, match_metric: str, match_threshold: float) -> bool:
+    """
+    Checks whether the spatial index gives the same matches as the exhaustive comparison.
+    That holds only if a match requires the boxes to intersect, i.e. for a positive threshold
+    and finite boxes of positive area (otherwise the metric may be 0/0 and every box matches).
+    """
+    if match_metric not in ("IOU", "IOS") or not match_threshold > 0:
+        return False
+    boxes = predictions[:, :4]
+    areas = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    return bool(np.isfinite(boxes).all() and (areas > 0).all())
+
+
+def _candidate_pairs(boxes: np.ndarray):
+    """
+    Finds all the pairs of intersecting boxes through a uniform grid, so that only the boxes
+    sharing a cell are compared instead of all N x N pairs.
+    Args:
+        boxes: (np.ndarray) Shape: [num_boxes, 4] of x1, y1, x2, y2 with positive areas.
+    Returns:
+        first, second: (np.ndarray, np.ndarray) indices of the boxes of each intersecting pair,
+        every pair is listed once.
+    """
+    x1, y1, x2, y2 = boxes.T.astype(np.float64)
+    # the cells are twice as large as the typical box, so that most boxes cover 1-4 cells
+    cell_size = 2 * float(np.median(np.maximum(x2 - x1, y2 - y1)))
+    cx1 = np.floor((x1 - x1.min()) / cell_size).astype(np.int64)
+    cy1 = np.floor((y1 - y1.min()) / cell_size).astype(np.int64)
+    cx2 = np.floor((x2 - x1.min()) / cell_size).astype(np.int64)
+    cy2 = np.floor((y2 - y1.min()) / cell_size).astype(np.int64)
+
+    # each box is registered in every cell it covers
+    num_x, num_y = cx2 - cx1 + 1, cy2 - cy1 + 1
+    num_cells = num_x * num_y
+    box_ids = np.repeat(np.arange(len(boxes)), num_cells)
+    local = np.arange(len(box_ids)) - np.repeat(np.cumsum(num_cells) - num_cells, num_cells)
+    grid_x = cx1[box_ids] + local % num_x[box_ids]
+    grid_y = cy1[box_ids] + local // num_x[box_ids]
+    cell_ids = grid_y * (int(cx2.max()) + 1) + grid_x
+    order = np.argsort(cell_ids, kind="stable")
+    box_ids, grid_x, grid_y, cell_ids = box_ids[order], grid_x[order], grid_y[order], cell_ids[order]
+
+    # all the pairs within each cell: every entry is paired with the following entries of its cell
+    positions = np.arange(len(cell_ids))
+    num_partners = np.searchsorted(cell_ids, cell_ids, side="right") - positions - 1
+    first = np.repeat(positions, num_partners)
+    second = first + 1 + np.arange(len(first)) - np.repeat(np.cumsum(num_partners) - num_partners, num_partners)
+    cell_x, cell_y = grid_x[first], grid_y[first]
+    first, second = box_ids[first], box_ids[second]
+
+    # a pair of intersecting boxes shares all the cells of the intersection,
+    # it is counted only in the cell of the top left corner of the intersection
+    first_cell = (np.maximum(cx1[first], cx1[second]) == cell_x) & (np.maximum(cy1[first], cy1[second]) == cell_y)
+    overlap = (np.maximum(x1[first], x1[second]) < np.minimum(x2[first], x2[second])) & (
+        np.maximum(y1[first], y1[second]) < np.minimum(y2[first], y2[second])
+    )
+    keep = first_cell & overlap
+    return first[keep], second[keep]
+
+
+def _matched_pairs(predictions: np.ndarray, match_metric: str, match_threshold: float):
+    """
+    Finds all the ordered pairs (S, T) where the metric of T with S reaches the threshold.
+    The metric is computed in float32 in the same order of operations as in nms(), so the matches
+    are exactly the same, although the union of (S, T) may differ from (T, S) in the last bit.
+    Returns:
+        selected, matched: (np.ndarray, np.ndarray) indices of S and T of each matched pair.
+    """
+    first, second = _candidate_pairs(predictions[:, :4])
+    selected = np.concatenate((first, second))
+    matched = np.concatenate((second, first))
+
+    x1, y1, x2, y2 = predictions[:, 0], predictions[:, 1], predictions[:, 2], predictions[:, 3]
+    areas = (x2 - x1) * (y2 - y1)
+    w = np.clip(np.minimum(x2[matched], x2[selected]) - np.maximum(x1[matched], x1[selected]), 0.0, None)
+    h = np.clip(np.minimum(y2[matched], y2[selected]) - np.maximum(y1[matched], y1[selected]), 0.0, None)
+    inter = w * h
+    rem_areas = areas[matched]
+    if match_metric == "IOU":
+        match_metric_value = inter / ((rem_areas - inter) + areas[selected])
+    else:
+        match_metric_value = inter / np.minimum(rem_areas, areas[selected])
+    mask = ~(match_metric_value < np.float32(match_threshold))
+    return selected[mask], matched[mask]
+
+
+def _group_matches(selected: np.ndarray, matched: np.ndarray, matched_rank: np.ndarray, num_boxes: int):
+    """
+    Groups the matched boxes by the selected box, sorted by the given rank within each group.
+    Returns:
+        matched: (np.ndarray) indices of the matched boxes;
+        bounds: (np.ndarray) Shape: [num_boxes + 1], the matches of box i are matched[bounds[i]:bounds[i + 1]].
+    """
+    order = np.lexsort((matched_rank, selected))
+    bounds = np.searchsorted(selected[order], np.arange(num_boxes + 1))
+    return matched[order], bounds
+
+
+def spatial_nms(
+    predictions: torch.tensor,
+    match_metric: str = "IOU",
+    match_threshold: float = 0.5,
+):
+    """
+    Same as nms(), but only the intersecting boxes found through a spatial grid are compared,
+    and the suppression is a single pass over the boxes in the order of scores.
+    Equal scores are resolved stably: the box with the larger index is selected first.
+    Falls back to nms() if the grid can not give the same result, see _is_spatially_indexable().
+    Args:
+        predictions: (tensor) The location preds for the image
+            along with the class predscores, Shape: [num_boxes,5].
+        match_metric: (str) IOU or IOS
+        match_threshold: (float) The overlap thresh for
+            match metric.
+    Returns:
+        A list of filtered indexes, Shape: [ ,]
+    """
+    predictions_as_numpy = _predictions_to_numpy(predictions)
+    if len(predictions_as_numpy) == 0:
+        return []
+    if not _is_spatially_indexable(predictions_as_numpy, match_metric, match_threshold):
+        return nms(torch.as_tensor(predictions), match_metric, match_threshold)
+
+    num_boxes = len(predictions_as_numpy)
+    order = np.argsort(predictions_as_numpy[:, 4], kind="stable")[::-1]
+    rank = np.empty(num_boxes, dtype=np.int64)
+    rank[order] = np.arange(num_boxes)
+    selected, matched = _matched_pairs(predictions_as_numpy, match_metric, match_threshold)
+    # only the boxes after S in the order are still in the pool when S is selected
+    later = rank[matched] > rank[selected]
+    matched, bounds = _group_matches(selected[later], matched[later], rank[matched[later]], num_boxes)
+
+    keep = []
+    suppressed = np.zeros(num_boxes, dtype=bool)
+    for idx in order.tolist():
+        if suppressed[idx]:
+            continue
+        keep.append(idx)
+        suppressed[matched[bounds[idx] : bounds[idx + 1]]] = True
+    return keep
+
+
+def spatial_greedy_nmm(
+    object_predictions_as_tensor: torch.tensor,
+    match_metric: str = "IOU",
+    match_threshold: float = 0.5,
+):
+    """
+    Same as greedy_nmm(), but only the intersecting boxes found through a spatial grid are compared.
+    Equal scores are resolved stably: the box with the larger index is selected first.
+    Falls back to greedy_nmm() if the grid can not give the same result, see _is_spatially_indexable().
+    Args:
+        object_predictions_as_tensor: (tensor) The location preds for the image
+            along with the class predscores, Shape: [num_boxes,5].
+        match_metric: (str) IOU or IOS
+        match_threshold: (float) The overlap thresh for
+            match metric.
+    Returns:
+        keep_to_merge_list: (Dict[int:List[int]]) mapping from prediction indices
+        to keep to a list of prediction indices to be merged.
+    """
+    predictions_as_numpy = _predictions_to_numpy(object_predictions_as_tensor)
+    if len(predictions_as_numpy) == 0:
+        return {}
+    if not _is_spatially_indexable(predictions_as_numpy, match_metric, match_threshold):
+        return greedy_nmm(torch.as_tensor(object_predictions_as_tensor), match_metric, match_threshold)
+
+    num_boxes = len(predictions_as_numpy)
+    order = np.argsort(predictions_as_numpy[:, 4], kind="stable")[::-1]
+    rank = np.empty(num_boxes, dtype=np.int64)
+    rank[order] = np.arange(num_boxes)
+    selected, matched = _matched_pairs(predictions_as_numpy, match_metric, match_threshold)
+    later = rank[matched] > rank[selected]
+    # the boxes to be merged are listed from the highest score, as in greedy_nmm()
+    matched, bounds = _group_matches(selected[later], matched[later], rank[matched[later]], num_boxes)
+
+    keep_to_merge_list = {}
+    merged = np.zeros(num_boxes, dtype=bool)
+    for idx in order.tolist():
+        if merged[idx]:
+            continue
+        matched_box_indices = matched[bounds[idx] : bounds[idx + 1]]
+        matched_box_indices = matched_box_indices[~merged[matched_box_indices]]
+        merged[matched_box_indices] = True
+        keep_to_merge_list[idx] = matched_box_indices.tolist()
+    return keep_to_merge_list
+
+
+def spatial_nmm(
+    object_predictions_as_tensor: torch.tensor,
+    match_metric: str = "IOU",
+    match_threshold: float = 0.5,
+):
+    """
+    Same as nmm(), but only the intersecting boxes found through a spatial grid are compared.
+    Equal scores are resolved stably: the box with the smaller index is processed first.
+    Falls back to nmm() if the grid can not give the same result, see _is_spatially_indexable().
+    Args:
+        object_predictions_as_tensor: (tensor) The location preds for the image
+            along with the class predscores, Shape: [num_boxes,5].
+        match_metric: (str) IOU or IOS
+        match_threshold: (float) The overlap thresh for
+            match metric.
+    Returns:
+        keep_to_merge_list: (Dict[int:List[int]]) mapping from prediction indices
+        to keep to a list of prediction indices to be merged.
+    """
+    predictions_as_numpy = _predictions_to_numpy(object_predictions_as_tensor)
+    if len(predictions_as_numpy) == 0:
+        return {}
+    if not _is_spatially_indexable(predictions_as_numpy, match_metric, match_threshold):
+        return nmm(torch.as_tensor(object_predictions_as_tensor), match_metric, match_threshold)
+
+    num_boxes = len(predictions_as_numpy)
+    order = np.argsort(-predictions_as_numpy[:, 4], kind="stable")
+    rank = np.empty(num_boxes, dtype=np.int64)
+    rank[order] = np.arange(num_boxes)
+    selected, matched = _matched_pairs(predictions_as_numpy, match_metric, match_threshold)
+    # the matched boxes are listed from the lowest score, as in nmm()
+    matched, bounds = _group_matches(selected, matched, -rank[matched], num_boxes)
+
+    keep_to_merge_list = {}
+    merge_to_keep = {}
+    for pred_ind in order.tolist():
+        matched_box_indices = matched[bounds[pred_ind] : bounds[pred_ind + 1]].tolist()
+        if pred_ind not in merge_to_keep:
+            keep_to_merge_list[pred_ind] = []
+            for matched_box_ind in matched_box_indices:
+                if matched_box_ind not in merge_to_keep:
+                    keep_to_merge_list[pred_ind].append(matched_box_ind)
+                    merge_to_keep[matched_box_ind] = pred_ind
+        else:
+            keep = merge_to_keep[pred_ind]
+            for matched_box_ind in matched_box_indices:
+                if matched_box_ind not in keep_to_merge_list and matched_box_ind not in merge_to_keep:
+                    keep_to_merge_list[keep].append(matched_box_ind)
+                    merge_to_keep[matched_box_ind] = keep
+    return keep_to_merge_list
+
+
 class PostprocessPredictions:
     """Utilities for calculating IOU/IOS based match for given ObjectPredictions"""
 
@@ -452,10 +715,13 @@ class PostprocessPredictions:
         match_threshold: float = 0.5,
         match_metric: str = "IOU",
         class_agnostic: bool = True,
+        spatial_index: bool = True,
     ):
         self.match_threshold = match_threshold
         self.class_agnostic = class_agnostic
         self.match_metric = match_metric
+        # compare only the intersecting boxes found through a grid, the results are the same
+        self.spatial_index = spatial_index
 
         check_requirements(["torch"])
 
@@ -471,12 +737,15 @@ class NMSPostprocess(PostprocessPredictions):
         object_prediction_list = ObjectPredictionList(object_predictions)
         object_predictions_as_torch = object_prediction_list.totensor()
         if self.class_agnostic:
-            keep = nms(
+            keep = (spatial_nms if self.spatial_index else nms)(
                 object_predictions_as_torch, match_threshold=self.match_threshold, match_metric=self.match_metric
             )
         else:
             keep = batched_nms(
-                object_predictions_as_torch, match_threshold=self.match_threshold, match_metric=self.match_metric
+                object_predictions_as_torch,
+                match_threshold=self.match_threshold,
+                match_metric=self.match_metric,
+                spatial_index=self.spatial_index,
             )
 
         selected_object_predictions = object_prediction_list[keep].tolist()
@@ -494,7 +763,7 @@ class NMMPostprocess(PostprocessPredictions):
         object_prediction_list = ObjectPredictionList(object_predictions)
         object_predictions_as_torch = object_prediction_list.totensor()
         if self.class_agnostic:
-            keep_to_merge_list = nmm(
+            keep_to_merge_list = (spatial_nmm if self.spatial_index else nmm)(
                 object_predictions_as_torch,
                 match_threshold=self.match_threshold,
                 match_metric=self.match_metric,
@@ -504,6 +773,7 @@ class NMMPostprocess(PostprocessPredictions):
                 object_predictions_as_torch,
                 match_threshold=self.match_threshold,
                 match_metric=self.match_metric,
+                spatial_index=self.spatial_index,
             )
 
         selected_object_predictions = []
@@ -531,7 +801,7 @@ class GreedyNMMPostprocess(PostprocessPredictions):
         object_prediction_list = ObjectPredictionList(object_predictions)
         object_predictions_as_torch = object_prediction_list.totensor()
         if self.class_agnostic:
-            keep_to_merge_list = greedy_nmm(
+            keep_to_merge_list = (spatial_greedy_nmm if self.spatial_index else greedy_nmm)(
                 object_predictions_as_torch,
                 match_threshold=self.match_threshold,
                 match_metric=self.match_metric,
@@ -541,6 +811,7 @@ class GreedyNMMPostprocess(PostprocessPredictions):
                 object_predictions_as_torch,
                 match_threshold=self.match_threshold,
                 match_metric=self.match_metric,
+                spatial_index=self.spatial_index,
             )
 
         selected_object_predictions = []
@@ -3,27 +3,41 @@ from typing import List, Union
 
 import numpy as np
 import torch
-from shapely.geometry import MultiPolygon, Polygon
 
 from model.sahi.annotation import BoundingBox, Category, Mask
 from model.sahi.prediction import ObjectPrediction
 from model.sahi.utils.cv import get_coco_segmentation_from_bool_mask
-from model.sahi.utils.shapely import ShapelyAnnotation, get_shapely_multipolygon
 
 
 class ObjectPredictionList(Sequence):
-    def __init__(self, list):
+    """
+    List of ObjectPredictions along with their N x [x1, y1, x2, y2, score, category_id] array,
+    which is built in a single pass on first use and shared with the sublists taken from it.
+    """
+
+    __slots__ = ("list", "_array")
+
+    def __init__(self, list, array: np.ndarray = None):
         self.list = list
+        self._array = array
         super().__init__()
 
+    @property
+    def array(self) -> np.ndarray:
+        if self._array is None:
+            self._array = object_predictions_to_array(self.list)
+        return self._array
+
     def __getitem__(self, i):
         if torch.is_tensor(i) or isinstance(i, np.ndarray):
             i = i.tolist()
         if isinstance(i, int):
-            return ObjectPredictionList([self.list[i]])
+            array = None if self._array is None else self._array[[i]]
+            return ObjectPredictionList([self.list[i]], array)
         elif isinstance(i, (tuple, list)):
             accessed_mapping = map(self.list.__getitem__, i)
-            return ObjectPredictionList(list(accessed_mapping))
+            array = None if self._array is None else self._array[list(i)]
+            return ObjectPredictionList(list(accessed_mapping), array)
         else:
             raise NotImplementedError(f"{type(i)}")
 
@@ -43,6 +57,7 @@ class ObjectPredictionList(Sequence):
                     self.list[i[ind]] = el
         else:
             raise NotImplementedError(f"{type(i)}")
+        self._array = None
 
     def __len__(self):
         return len(self.list)
@@ -51,6 +66,10 @@ class ObjectPredictionList(Sequence):
         return str(self.list)
 
     def extend(self, object_prediction_list):
+        if self._array is not None and object_prediction_list._array is not None:
+            self._array = np.concatenate((self._array, object_prediction_list._array))
+        else:
+            self._array = None
         self.list.extend(object_prediction_list.list)
 
     def totensor(self):
@@ -66,18 +85,33 @@ class ObjectPredictionList(Sequence):
             return self.list
 
 
+def object_predictions_to_array(object_predictions: List[ObjectPrediction]) -> np.ndarray:
+    """
+    Returns:
+        np.ndarray of size N x [x1, y1, x2, y2, score, category_id] of float32
+    """
+    return np.array(
+        [
+            (
+                object_prediction.bbox.minx,
+                object_prediction.bbox.miny,
+                object_prediction.bbox.maxx,
+                object_prediction.bbox.maxy,
+                object_prediction.score.value,
+                object_prediction.category.id,
+            )
+            for object_prediction in object_predictions
+        ],
+        dtype=np.float32,
+    ).reshape(-1, 6)
+
+
 def object_prediction_list_to_torch(object_prediction_list: ObjectPredictionList) -> torch.tensor:
     """
     Returns:
         torch.tensor of size N x [x1, y1, x2, y2, score, category_id]
     """
-    num_predictions = len(object_prediction_list)
-    torch_predictions = torch.zeros([num_predictions, 6], dtype=torch.float32)
-    for ind, object_prediction in enumerate(object_prediction_list):
-        torch_predictions[ind, :4] = torch.tensor(object_prediction.tolist().bbox.to_xyxy(), dtype=torch.float32)
-        torch_predictions[ind, 4] = object_prediction.tolist().score.value
-        torch_predictions[ind, 5] = object_prediction.tolist().category.id
-    return torch_predictions
+    return torch.from_numpy(object_prediction_list_to_numpy(object_prediction_list))
 
 
 def object_prediction_list_to_numpy(object_prediction_list: ObjectPredictionList) -> np.ndarray:
@@ -85,13 +119,9 @@ def object_prediction_list_to_numpy(object_prediction_list: ObjectPredictionList
     Returns:
         np.ndarray of size N x [x1, y1, x2, y2, score, category_id]
     """
-    num_predictions = len(object_prediction_list)
-    numpy_predictions = np.zeros([num_predictions, 6], dtype=np.float32)
-    for ind, object_prediction in enumerate(object_prediction_list):
-        numpy_predictions[ind, :4] = np.array(object_prediction.tolist().bbox.to_xyxy(), dtype=np.float32)
-        numpy_predictions[ind, 4] = object_prediction.tolist().score.value
-        numpy_predictions[ind, 5] = object_prediction.tolist().category.id
-    return numpy_predictions
+    if isinstance(object_prediction_list, ObjectPredictionList):
+        return object_prediction_list.array.copy()
+    return object_predictions_to_array(object_prediction_list)
 
 
 def calculate_box_union(box1: Union[List[int], np.ndarray], box2: Union[List[int], np.ndarray]) -> List[int]:
@@ -161,18 +191,27 @@ def has_match(
 
 
 def get_merged_mask(pred1: ObjectPrediction, pred2: ObjectPrediction) -> Mask:
+    """
+    Returns the union of the masks of the predictions.
+    The cached crop-local bitmaps of the masks are unioned on the canvas of the union
+    of their boxes, so that the canvas of the full image is never allocated.
+    """
     mask1 = pred1.mask
     mask2 = pred2.mask
-
-    # buffer(0) is a quickhack to fix invalid polygons most of the time
-    poly1 = get_shapely_multipolygon(mask1.segmentation).buffer(0)
-    poly2 = get_shapely_multipolygon(mask2.segmentation).buffer(0)
-    union_poly = poly1.union(poly2)
-    if not hasattr(union_poly, "geoms"):
-        union_poly = MultiPolygon([union_poly])
+    crops = [(mask.bool_mask_crop, mask.offset) for mask in (mask1, mask2)]
+    crops = [(crop, offset) for crop, offset in crops if crop.size > 0]
+    if len(crops) == 0:
+        union = []
     else:
-        union_poly = MultiPolygon([g.buffer(0) for g in union_poly.geoms if isinstance(g, Polygon)])
-    union = ShapelyAnnotation(multipolygon=union_poly).to_coco_segmentation()
+        x0 = min(offset[0] for _, offset in crops)
+        y0 = min(offset[1] for _, offset in crops)
+        x1 = max(offset[0] + crop.shape[1] for crop, offset in crops)
+        y1 = max(offset[1] + crop.shape[0] for crop, offset in crops)
+        union_mask = np.zeros((y1 - y0, x1 - x0), dtype=bool)
+        for crop, offset in crops:
+            x, y = offset[0] - x0, offset[1] - y0
+            union_mask[y : y + crop.shape[0], x : x + crop.shape[1]] |= crop
+        union = get_coco_segmentation_from_bool_mask(union_mask, offset=[x0, y0])
     return Mask(
         segmentation=union,
         full_shape=mask1.full_shape,
@@ -3,6 +3,8 @@
 
 import logging
 import os
+import queue
+import threading
 import time
 from typing import List, Optional
 
@@ -35,6 +37,7 @@ from model.sahi.utils.cv import (
     crop_object_predictions,
     cv2,
     get_video_reader,
+    read_image_as_numpy,
     read_image_as_pil,
     visualize_object_predictions,
 )
@@ -50,6 +53,11 @@ POSTPROCESS_NAME_TO_CLASS = {
 
 LOW_MODEL_CONFIDENCE = 0.1
 
+# marks the end of the stream of batches passed between the stages of get_sliced_prediction()
+_PIPELINE_END = object()
+# how often (in seconds) a stage waiting on a queue checks whether the pipeline was stopped
+_PIPELINE_POLL_INTERVAL = 0.1
+
 
 logger = logging.getLogger(__name__)
 
@@ -86,11 +94,11 @@ def get_prediction(
     """
     durations_in_seconds = dict()
 
-    # read image as pil
-    image_as_pil = read_image_as_pil(image)
+    # read image, numpy images are passed without the round trip through pil
+    image_as_numpy = read_image_as_numpy(image)
     # get prediction
     time_start = time.time()
-    detection_model.perform_inference(np.ascontiguousarray(image_as_pil))
+    detection_model.perform_inference(image_as_numpy)
     time_end = time.time() - time_start
     durations_in_seconds["prediction"] = time_end
 
@@ -122,6 +130,38 @@ def get_prediction(
     )
 
 
+def get_batch_prediction(
+    images: list,
+    detection_model,
+    shift_amount_list: list,
+    full_shape_list: list,
+) -> List[List[ObjectPrediction]]:
+    """
+    Function for performing prediction for a batch of images using given detection_model
+    in a single perform_inference call. Each element carries its own shift amount and full shape.
+
+    Arguments:
+        images: list
+            List of image locations or numpy image matrices
+        detection_model: model.DetectionModel
+            Model that supports batched inference (detection_model.supports_batch is True)
+        shift_amount_list: List
+            Shift amounts of the images, should be in the form of [[shift_x, shift_y], ...]
+        full_shape_list: List
+            Sizes of the full images, should be in the form of [[height, width], ...]
+
+    Returns:
+        A list with a list of ObjectPrediction per image
+    """
+    image_list = [read_image_as_numpy(image) for image in images]
+    detection_model.perform_inference(image_list)
+    detection_model.convert_original_predictions(
+        shift_amount=shift_amount_list,
+        full_shape=full_shape_list,
+    )
+    return detection_model.object_prediction_list_per_image
+
+
 def get_sliced_prediction(
     image,
     detection_model=None,
@@ -139,6 +179,8 @@ def get_sliced_prediction(
     auto_slice_resolution: bool = True,
     slice_export_prefix: str = None,
     slice_dir: str = None,
+    batch_size: int = 16,
+    prefetch_batches: int = 2,
 ) -> PredictionResult:
     """
     Function for slice image + get predicion for each slice + combine predictions in full image.
@@ -188,6 +230,15 @@ def get_sliced_prediction(
             Prefix for the exported slices. Defaults to None.
         slice_dir: str
             Directory to save the slices. Defaults to None.
+        batch_size: int
+            Number of slices stacked into a single forward pass. Used only if the detection
+            model supports batched inference, otherwise slices are predicted one by one. Default: 16.
+        prefetch_batches: int
+            The slices are read in a background thread and the predictions are shifted and merged
+            in another one, while the model runs on the calling thread. This is the maximal number of
+            batches waiting between the stages, so that memory stays bounded. The batches pass the
+            stages in order, so the result is the same as without the pipeline.
+            0 runs all the stages one after another on the calling thread. Default: 2.
 
     Returns:
         A Dict with fields:
@@ -198,8 +249,23 @@ def get_sliced_prediction(
     # for profiling
     durations_in_seconds = dict()
 
-    # currently only 1 batch supported
-    num_batch = 1
+    num_batch = max(1, batch_size) if detection_model.supports_batch else 1
+
+    # init match postprocess instance, before slicing opens the image file
+    if postprocess_type not in POSTPROCESS_NAME_TO_CLASS.keys():
+        raise ValueError(
+            f"postprocess_type should be one of {list(POSTPROCESS_NAME_TO_CLASS.keys())} but given as {postprocess_type}"
+        )
+    elif postprocess_type == "UNIONMERGE":
+        # deprecated in v0.9.3
+        raise ValueError("'UNIONMERGE' postprocess_type is deprecated, use 'GREEDYNMM' instead.")
+    postprocess_constructor = POSTPROCESS_NAME_TO_CLASS[postprocess_type]
+    postprocess = postprocess_constructor(
+        match_threshold=postprocess_match_threshold,
+        match_metric=postprocess_match_metric,
+        class_agnostic=postprocess_class_agnostic,
+    )
+
     # create slices from full image
     time_start = time.time()
     slice_image_result = slice_image(
@@ -217,66 +283,118 @@ def get_sliced_prediction(
     time_end = time.time() - time_start
     durations_in_seconds["slice"] = time_end
 
-    # init match postprocess instance
-    if postprocess_type not in POSTPROCESS_NAME_TO_CLASS.keys():
-        raise ValueError(
-            f"postprocess_type should be one of {list(POSTPROCESS_NAME_TO_CLASS.keys())} but given as {postprocess_type}"
-        )
-    elif postprocess_type == "UNIONMERGE":
-        # deprecated in v0.9.3
-        raise ValueError("'UNIONMERGE' postprocess_type is deprecated, use 'GREEDYNMM' instead.")
-    postprocess_constructor = POSTPROCESS_NAME_TO_CLASS[postprocess_type]
-    postprocess = postprocess_constructor(
-        match_threshold=postprocess_match_threshold,
-        match_metric=postprocess_match_metric,
-        class_agnostic=postprocess_class_agnostic,
-    )
-
     # create prediction input
-    num_group = int(num_slices / num_batch)
+    num_group = (num_slices + num_batch - 1) // num_batch
+    full_shape = [
+        slice_image_result.original_image_height,
+        slice_image_result.original_image_width,
+    ]
     # if verbose == 1 or verbose == 2:
     #     tqdm.write(f"Performing prediction on {num_slices} slices.")
     object_prediction_list = []
-    # perform sliced prediction
-    for group_ind in range(num_group):
-        # prepare batch (currently supports only 1 batch)
-        image_list = []
-        shift_amount_list = []
-        for image_ind in range(num_batch):
-            image_list.append(slice_image_result.images[group_ind * num_batch + image_ind])
-            shift_amount_list.append(slice_image_result.starting_pixels[group_ind * num_batch + image_ind])
+    # the slices are read batch by batch, so that lazy slices of large images are never all in memory
+    sliced_image_list = slice_image_result.sliced_image_list
+
+    def prepare_batch(group_ind: int):
+        # prepare batch, the last one may be smaller
+        start = group_ind * num_batch
+        batch_sliced_images = sliced_image_list[start : start + num_batch]
+        image_list = [read_image_as_numpy(sliced_image.image) for sliced_image in batch_sliced_images]
+        shift_amount_list = [sliced_image.starting_pixel for sliced_image in batch_sliced_images]
+        return image_list, shift_amount_list
+
+    def predict_batch(image_list: list, shift_amount_list: list):
         # perform batch prediction
-        prediction_result = get_prediction(
-            image=image_list[0],
-            detection_model=detection_model,
-            shift_amount=shift_amount_list[0],
-            full_shape=[
-                slice_image_result.original_image_height,
-                slice_image_result.original_image_width,
-            ],
-        )
+        if num_batch > 1:
+            return get_batch_prediction(
+                images=image_list,
+                detection_model=detection_model,
+                shift_amount_list=shift_amount_list,
+                full_shape_list=[full_shape] * len(image_list),
+            )
+        return [
+            get_prediction(
+                image=image_list[0],
+                detection_model=detection_model,
+                shift_amount=shift_amount_list[0],
+                full_shape=full_shape,
+            ).object_prediction_list
+        ]
+
+    def merge_batch(prediction_lists: list):
+        nonlocal object_prediction_list
         # convert sliced predictions to full predictions
-        for object_prediction in prediction_result.object_prediction_list:
-            if object_prediction:  # if not empty
-                object_prediction_list.append(object_prediction.get_shifted_object_prediction())
+        for prediction_list in prediction_lists:
+            for object_prediction in prediction_list:
+                if object_prediction:  # if not empty
+                    object_prediction_list.append(object_prediction.get_shifted_object_prediction())
 
         # merge matching predictions during sliced prediction
         if merge_buffer_length is not None and len(object_prediction_list) > merge_buffer_length:
             object_prediction_list = postprocess(object_prediction_list)
 
-    # perform standard prediction
-    if num_slices > 1 and perform_standard_pred:
-        prediction_result = get_prediction(
-            image=image,
-            detection_model=detection_model,
-            shift_amount=[0, 0],
-            full_shape=[
-                slice_image_result.original_image_height,
-                slice_image_result.original_image_width,
-            ],
-            postprocess=None,
+    # perform sliced prediction, the file of lazy TIFF image is closed as soon as all the slices are read
+    if prefetch_batches < 1:
+        try:
+            for group_ind in range(num_group):
+                merge_batch(predict_batch(*prepare_batch(group_ind)))
+        finally:
+            slice_image_result.close()
+        standard_prediction_list = _get_standard_prediction_list(
+            image, detection_model, num_slices, perform_standard_pred, full_shape
         )
-        object_prediction_list.extend(prediction_result.object_prediction_list)
+    else:
+        prepared = queue.Queue(maxsize=prefetch_batches)
+        predicted = queue.Queue(maxsize=prefetch_batches)
+        stop = threading.Event()
+        errors = []
+
+        def prepare_worker():
+            try:
+                for group_ind in range(num_group):
+                    if not _put_batch(prepared, prepare_batch(group_ind), stop):
+                        return
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+            finally:
+                slice_image_result.close()
+                _put_batch(prepared, _PIPELINE_END, stop)
+
+        def merge_worker():
+            try:
+                for prediction_lists in _iter_batches(predicted, stop):
+                    merge_batch(prediction_lists)
+            except BaseException as e:
+                errors.append(e)
+                stop.set()
+
+        workers = [
+            threading.Thread(target=prepare_worker, name="sahi-prepare", daemon=True),
+            threading.Thread(target=merge_worker, name="sahi-merge", daemon=True),
+        ]
+        for worker in workers:
+            worker.start()
+        try:
+            for image_list, shift_amount_list in _iter_batches(prepared, stop):
+                if not _put_batch(predicted, predict_batch(image_list, shift_amount_list), stop):
+                    break
+            # the standard prediction overlaps with merging of the last batches
+            standard_prediction_list = []
+            if not stop.is_set():
+                standard_prediction_list = _get_standard_prediction_list(
+                    image, detection_model, num_slices, perform_standard_pred, full_shape
+                )
+        except BaseException:
+            stop.set()
+            raise
+        finally:
+            _put_batch(predicted, _PIPELINE_END, stop)
+            for worker in workers:
+                worker.join()
+        if errors:
+            raise errors[0]
+    object_prediction_list.extend(standard_prediction_list)
 
     # merge matching predictions
     if len(object_prediction_list) > 1:
@@ -302,6 +420,50 @@ def get_sliced_prediction(
     )
 
 
+def _put_batch(batch_queue: queue.Queue, batch, stop: threading.Event) -> bool:
+    """
+    Puts the batch into the bounded queue, waiting while the queue is full.
+    Returns False if the pipeline was stopped before the batch was put.
+    """
+    while not stop.is_set():
+        try:
+            batch_queue.put(batch, timeout=_PIPELINE_POLL_INTERVAL)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _iter_batches(batch_queue: queue.Queue, stop: threading.Event):
+    """
+    Yields the batches from the queue until the end of the stream or until the pipeline is stopped.
+    """
+    while not stop.is_set():
+        try:
+            batch = batch_queue.get(timeout=_PIPELINE_POLL_INTERVAL)
+        except queue.Empty:
+            continue
+        if batch is _PIPELINE_END:
+            return
+        yield batch
+
+
+def _get_standard_prediction_list(image, detection_model, num_slices, perform_standard_pred, full_shape) -> list:
+    """
+    Returns the predictions on the whole image, which are added to the sliced ones,
+    or an empty list if there is a single slice or the standard prediction is off.
+    """
+    if num_slices > 1 and perform_standard_pred:
+        return get_prediction(
+            image=image,
+            detection_model=detection_model,
+            shift_amount=[0, 0],
+            full_shape=full_shape,
+            postprocess=None,
+        ).object_prediction_list
+    return []
+
+
 def bbox_sort(a, b, thresh):
     """
     a, b  - function receives two bounding bboxes
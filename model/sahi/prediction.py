@@ -14,6 +14,8 @@ from model.sahi.utils.file import Path
 
 
 class PredictionScore:
+    __slots__ = ("value",)
+
     def __init__(self, value: float):
         """
         Arguments:
@@ -40,6 +42,8 @@ class ObjectPrediction(ObjectAnnotation):
     Class for handling detection model predictions.
     """
 
+    __slots__ = ("score",)
+
     def __init__(
         self,
         bbox: Optional[List[int]] = None,
@@ -164,11 +168,34 @@ class PredictionResult:
         image: Union[Image.Image, str, np.ndarray],
         durations_in_seconds: Optional[Dict] = None,
     ):
-        self.image: Image.Image = read_image_as_pil(image)
-        self.image_width, self.image_height = self.image.size
+        # the image is converted to pil only when it is used, e.g. by export_visuals()
+        self._image = image
+        self._image_as_pil: Optional[Image.Image] = None
         self.object_prediction_list: List[ObjectPrediction] = object_prediction_list
         self.durations_in_seconds = durations_in_seconds
 
+    @property
+    def image(self) -> Image.Image:
+        if self._image_as_pil is None:
+            self._image_as_pil = read_image_as_pil(self._image)
+        return self._image_as_pil
+
+    @property
+    def image_width(self) -> int:
+        return self._image_size()[1]
+
+    @property
+    def image_height(self) -> int:
+        return self._image_size()[0]
+
+    def _image_size(self):
+        # the size of numpy images and lazy handles is known without the conversion
+        if self._image_as_pil is None and isinstance(getattr(self._image, "shape", None), tuple):
+            if not isinstance(self._image, np.ndarray) or self._image.shape[0] >= 5:
+                return self._image.shape[:2]
+        width, height = self.image.size
+        return height, width
+
     def export_visuals(
         self,
         export_dir: str,
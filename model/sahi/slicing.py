@@ -15,7 +15,14 @@ from tqdm import tqdm
 
 from model.sahi.annotation import BoundingBox, Mask
 from model.sahi.utils.coco import Coco, CocoAnnotation, CocoImage, create_coco_dict
-from model.sahi.utils.cv import IMAGE_EXTENSIONS_LOSSLESS, IMAGE_EXTENSIONS_LOSSY, read_image_as_pil
+from model.sahi.utils.cv import (
+    IMAGE_EXTENSIONS_LOSSLESS,
+    IMAGE_EXTENSIONS_LOSSY,
+    TIFF_EXTENSIONS,
+    LargeImage,
+    read_image_as_numpy,
+    read_image_as_pil,
+)
 from model.sahi.utils.file import load_json, save_json
 
 logger = logging.getLogger(__name__)
@@ -150,32 +157,58 @@ def process_coco_annotations(
 class SlicedImage:
     def __init__(self, image, coco_image, starting_pixel):
         """
-        image: np.array
-            Sliced image.
+        image: np.array or ImageTile
+            Sliced image, either a view of the full image or a lazy handle of its region,
+            which is read from the file on every access.
         coco_image: CocoImage
             Coco styled image object that belong to sliced image.
         starting_pixel: list of list of int
             Starting pixel coordinates of the sliced image.
         """
-        self.image = image
+        self._image = image
         self.coco_image = coco_image
         self.starting_pixel = starting_pixel
 
+    @property
+    def image(self) -> np.ndarray:
+        return np.asarray(self._image)
+
 
 class SliceImageResult:
-    def __init__(self, original_image_size: List[int], image_dir: Optional[str] = None):
+    def __init__(
+        self,
+        original_image_size: List[int],
+        image_dir: Optional[str] = None,
+        large_image: Optional[LargeImage] = None,
+    ):
         """
         image_dir: str
             Directory of the sliced image exports.
         original_image_size: list of int
             Size of the unsliced original image in [height, width]
+        large_image: LargeImage
+            Lazy image opened by slice_image(), which the slices are read from. Its file stays open
+            until close() is called, the result can be used as a context manager to close it.
         """
         self.original_image_height = original_image_size[0]
         self.original_image_width = original_image_size[1]
         self.image_dir = image_dir
+        self._large_image = large_image
 
         self._sliced_image_list: List[SlicedImage] = []
 
+    def close(self):
+        """Closes the file of the lazy image opened by slice_image(), the lazy slices can not be read afterwards."""
+        if self._large_image is not None:
+            self._large_image.close()
+            self._large_image = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def add_sliced_image(self, sliced_image: SlicedImage):
         if not isinstance(sliced_image, SlicedImage):
             raise TypeError("sliced_image must be a SlicedImage instance")
@@ -189,6 +222,7 @@ class SliceImageResult:
     @property
     def images(self):
         """Returns sliced images.
+        All the lazy slices are read at once, iterate over sliced_image_list to read them one by one.
 
         Returns:
             images: a list of np.array
@@ -262,7 +296,7 @@ class SliceImageResult:
 
 
 def slice_image(
-    image: Union[str, Image.Image],
+    image: Union[str, Image.Image, np.ndarray, LargeImage],
     coco_annotation_list: Optional[List[CocoAnnotation]] = None,
     output_file_name: Optional[str] = None,
     output_dir: Optional[str] = None,
@@ -279,7 +313,10 @@ def slice_image(
     sliced images.
 
     Args:
-        image (str or PIL.Image): File path of image or Pillow Image to be sliced.
+        image (str or PIL.Image or np.ndarray or LargeImage): File path of image, Pillow Image,
+            numpy image or lazy handle of a large image to be sliced. The slices of numpy images
+            are views of the image, and the slices of TIFF files and LargeImages are lazy handles
+            read from the file only when used, so that the slices take no memory of their own.
         coco_annotation_list (List[CocoAnnotation], optional): List of CocoAnnotation objects.
         output_file_name (str, optional): Root name of output files (coordinates will
             be appended to this)
@@ -315,7 +352,8 @@ def slice_image(
     # define verboseprint
     verboselog = logger.info if verbose else lambda *a, **k: None
 
-    def _export_single_slice(image: np.ndarray, output_dir: str, slice_file_name: str):
+    def _export_single_slice(sliced_image: SlicedImage, output_dir: str, slice_file_name: str):
+        image = sliced_image.image
         image_pil = read_image_as_pil(image)
         slice_file_path = str(Path(output_dir) / slice_file_name)
         # export sliced image
@@ -327,81 +365,103 @@ def slice_image(
     if output_dir is not None:
         Path(output_dir).mkdir(parents=True, exist_ok=True)
 
-    # read image
-    image_pil = read_image_as_pil(image)
-    verboselog("image.shape: " + str(image_pil.size))
-
-    image_width, image_height = image_pil.size
-    if not (image_width != 0 and image_height != 0):
-        raise RuntimeError(f"invalid image size: {image_pil.size} for 'slice_image'.")
-    slice_bboxes = get_slice_bboxes(
-        image_height=image_height,
-        image_width=image_width,
-        auto_slice_resolution=auto_slice_resolution,
-        slice_height=slice_height,
-        slice_width=slice_width,
-        overlap_height_ratio=overlap_height_ratio,
-        overlap_width_ratio=overlap_width_ratio,
+    # read image, the slices are taken from the array or from the lazy handle in place.
+    # The handle opened here is owned by the result, see SliceImageResult.close()
+    opened_large_image = None
+    if isinstance(image, str) and Path(image).suffix.lower() in TIFF_EXTENSIONS:
+        try:
+            image = opened_large_image = LargeImage(image)
+        except ValueError:
+            pass
+    image_filename = image if isinstance(image, str) else getattr(image, "filename", None)
+    if isinstance(image, LargeImage):
+        image_arr = image
+    else:
+        image_arr = read_image_as_numpy(image)
+    verboselog("image.shape: " + str(image_arr.shape))
+
+    image_height, image_width = image_arr.shape[:2]
+
+    # init images and annotations lists, the opened file is closed if slicing fails
+    sliced_image_result = SliceImageResult(
+        original_image_size=[image_height, image_width], image_dir=output_dir, large_image=opened_large_image
     )
+    try:
+        if not (image_width != 0 and image_height != 0):
+            raise RuntimeError(f"invalid image size: {(image_width, image_height)} for 'slice_image'.")
+        slice_bboxes = get_slice_bboxes(
+            image_height=image_height,
+            image_width=image_width,
+            auto_slice_resolution=auto_slice_resolution,
+            slice_height=slice_height,
+            slice_width=slice_width,
+            overlap_height_ratio=overlap_height_ratio,
+            overlap_width_ratio=overlap_width_ratio,
+        )
+
+        n_ims = 0
+
+        # iterate over slices
+        for slice_bbox in slice_bboxes:
+            n_ims += 1
 
-    n_ims = 0
-
-    # init images and annotations lists
-    sliced_image_result = SliceImageResult(original_image_size=[image_height, image_width], image_dir=output_dir)
-
-    image_pil_arr = np.asarray(image_pil)
-    # iterate over slices
-    for slice_bbox in slice_bboxes:
-        n_ims += 1
-
-        # extract image
-        tlx = slice_bbox[0]
-        tly = slice_bbox[1]
-        brx = slice_bbox[2]
-        bry = slice_bbox[3]
-        image_pil_slice = image_pil_arr[tly:bry, tlx:brx]
-
-        # set image file suffixes
-        slice_suffixes = "_".join(map(str, slice_bbox))
-        if out_ext:
-            suffix = out_ext
-        elif hasattr(image_pil, "filename"):
-            suffix = Path(getattr(image_pil, "filename")).suffix
-            if suffix in IMAGE_EXTENSIONS_LOSSY:
+            # extract image
+            tlx = slice_bbox[0]
+            tly = slice_bbox[1]
+            brx = slice_bbox[2]
+            bry = slice_bbox[3]
+            if isinstance(image_arr, LargeImage):
+                image_pil_slice = image_arr.tile(tlx, tly, brx, bry)
+            else:
+                image_pil_slice = image_arr[tly:bry, tlx:brx]
+
+            # set image file suffixes
+            slice_suffixes = "_".join(map(str, slice_bbox))
+            if out_ext:
+                suffix = out_ext
+            elif image_filename:
+                suffix = Path(image_filename).suffix
+                if suffix in IMAGE_EXTENSIONS_LOSSY:
+                    suffix = ".png"
+                elif suffix in IMAGE_EXTENSIONS_LOSSLESS:
+                    suffix = Path(image_filename).suffix
+            else:
                 suffix = ".png"
-            elif suffix in IMAGE_EXTENSIONS_LOSSLESS:
-                suffix = Path(image_pil.filename).suffix
-        else:
-            suffix = ".png"
 
-        # set image file name and path
-        slice_file_name = f"{output_file_name}_{slice_suffixes}{suffix}"
+            # set image file name and path
+            slice_file_name = f"{output_file_name}_{slice_suffixes}{suffix}"
 
-        # create coco image
-        slice_width = slice_bbox[2] - slice_bbox[0]
-        slice_height = slice_bbox[3] - slice_bbox[1]
-        coco_image = CocoImage(file_name=slice_file_name, height=slice_height, width=slice_width)
+            # create coco image
+            slice_width = slice_bbox[2] - slice_bbox[0]
+            slice_height = slice_bbox[3] - slice_bbox[1]
+            coco_image = CocoImage(file_name=slice_file_name, height=slice_height, width=slice_width)
 
-        # append coco annotations (if present) to coco image
-        if coco_annotation_list is not None:
-            for sliced_coco_annotation in process_coco_annotations(coco_annotation_list, slice_bbox, min_area_ratio):
-                coco_image.add_annotation(sliced_coco_annotation)
+            # append coco annotations (if present) to coco image
+            if coco_annotation_list is not None:
+                for sliced_coco_annotation in process_coco_annotations(coco_annotation_list, slice_bbox, min_area_ratio):
+                    coco_image.add_annotation(sliced_coco_annotation)
 
-        # create sliced image and append to sliced_image_result
-        sliced_image = SlicedImage(
-            image=image_pil_slice, coco_image=coco_image, starting_pixel=[slice_bbox[0], slice_bbox[1]]
-        )
-        sliced_image_result.add_sliced_image(sliced_image)
-
-    # export slices if output directory is provided
-    if output_file_name and output_dir:
-        conc_exec = concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS)
-        conc_exec.map(
-            _export_single_slice,
-            sliced_image_result.images,
-            [output_dir] * len(sliced_image_result),
-            sliced_image_result.filenames,
-        )
+            # create sliced image and append to sliced_image_result
+            sliced_image = SlicedImage(
+                image=image_pil_slice, coco_image=coco_image, starting_pixel=[slice_bbox[0], slice_bbox[1]]
+            )
+            sliced_image_result.add_sliced_image(sliced_image)
+
+        # export slices if output directory is provided
+        if output_file_name and output_dir:
+            # waits for the exports, since the lazy slices can not be read after the result is closed
+            with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as conc_exec:
+                list(
+                    conc_exec.map(
+                        _export_single_slice,
+                        sliced_image_result.sliced_image_list,
+                        [output_dir] * len(sliced_image_result),
+                        sliced_image_result.filenames,
+                    )
+                )
+    except BaseException:
+        sliced_image_result.close()
+        raise
 
     verboselog(
         "Num slices: " + str(n_ims) + " slice_height: " + str(slice_height) + " slice_width: " + str(slice_width)
@@ -471,7 +531,7 @@ def slice_coco(
         # get annotation json list corresponding to selected coco image
         # slice image
         try:
-            slice_image_result = slice_image(
+            with slice_image(
                 image=image_path,
                 coco_annotation_list=coco_image.annotations,
                 output_file_name=f"{Path(coco_image.file_name).stem}_{idx}",
@@ -483,9 +543,9 @@ def slice_coco(
                 min_area_ratio=min_area_ratio,
                 out_ext=out_ext,
                 verbose=verbose,
-            )
-            # append slice outputs
-            sliced_coco_images.extend(slice_image_result.coco_images)
+            ) as slice_image_result:
+                # append slice outputs
+                sliced_coco_images.extend(slice_image_result.coco_images)
         except TopologicalError:
             logger.warning(f"Invalid annotation found, skipping this image: {image_path}")
 
@@ -5,7 +5,7 @@ import copy
 import os
 import random
 import time
-from typing import List, Optional, Union
+from typing import List, Optional, Tuple, Union
 
 import cv2
 import numpy as np
@@ -137,18 +137,103 @@ def convert_image_to(read_path, extension: str = "jpg", grayscale: bool = False)
     cv2.imwrite(save_path, image)
 
 
-def read_large_image(image_path: str):
+TIFF_EXTENSIONS = [".tif", ".tiff"]
+
+
+class LargeImage:
+    """
+    Array-like handle of a large TIFF image, which reads only the requested regions from the file.
+    The regions are read through a memory map from uncompressed contiguous TIFFs, or through zarr
+    from tiled and compressed ones if zarr is installed. Otherwise the image is read at once as a fallback.
+    The regions are returned as RGB uint8 arrays, as read_image_as_pil() does.
+    """
+
+    def __init__(self, image_path: str):
+        import tifffile
+
+        self.image_path = str(image_path)
+        self.filename = self.image_path
+        self.lazy = True
+        self._tif = tifffile.TiffFile(self.image_path)
+        series = self._tif.series[0]
+        if series.axes not in ("YX", "YXS"):
+            self._tif.close()
+            raise ValueError(f"TIFF image with axes {series.axes} is not supported by LargeImage.")
+        try:
+            self._array = tifffile.memmap(self.image_path, series=0, mode="r")
+        except ValueError:
+            # compressed or tiled data can not be mapped, but can be read tile by tile through zarr
+            try:
+                import zarr
+
+                self._array = zarr.open(series.aszarr(level=0), mode="r")
+            except ImportError:
+                self._array = series.asarray()
+                self.lazy = False
+        self.height, self.width = series.shape[:2]
+        self.shape = (self.height, self.width, 3)
+
+    def read_region(self, x0: int, y0: int, x1: int, y1: int) -> np.ndarray:
+        """
+        Returns the region [y0:y1, x0:x1] of the image as RGB uint8 np.ndarray (height, width, 3)
+        """
+        region = np.asarray(self._array[y0:y1, x0:x1])
+        if region.ndim == 2:
+            region = np.repeat(region[:, :, None], 3, axis=2)
+        region = region[:, :, :3]
+        if region.dtype != np.uint8:
+            # clipped as PIL converts 16-bit images to RGB
+            region = np.clip(region, 0, 255).astype(np.uint8)
+        # copied, so that the regions do not keep the memory map of the file open
+        return np.array(region, order="C")
+
+    def tile(self, x0: int, y0: int, x1: int, y1: int) -> "ImageTile":
+        """
+        Returns lazy handle of the region [y0:y1, x0:x1], which is read only when converted to np.ndarray
+        """
+        return ImageTile(self, [x0, y0, x1, y1])
+
+    def __array__(self, dtype=None, copy=None):
+        image = self.read_region(0, 0, self.width, self.height)
+        return image if dtype is None else image.astype(dtype)
+
+    def close(self):
+        """Closes the file, dropping the memory map of it as well"""
+        self._array = None
+        self._tif.close()
+
+
+class ImageTile:
+    """
+    Lazy handle of a region of LargeImage, the region is read on every conversion to np.ndarray
+    """
+
+    def __init__(self, large_image: LargeImage, bbox: List[int]):
+        self.large_image = large_image
+        self.bbox = bbox
+        self.shape = (bbox[3] - bbox[1], bbox[2] - bbox[0], 3)
+
+    def __array__(self, dtype=None, copy=None):
+        image = self.large_image.read_region(*self.bbox)
+        return image if dtype is None else image.astype(dtype)
+
+
+def read_large_image(image_path: str, lazy: bool = False):
     """
     Reads a large image from the specified image path.
 
     Args:
         image_path (str): The path to the image file.
+        lazy (bool): Whether to return LargeImage handle instead of the image data for TIFF images,
+            so that the regions of the image are read only when they are needed.
 
     Returns:
         tuple: A tuple containing the image data and a flag indicating whether cv2 was used to read the image.
-            The image data is a numpy array representing the image in RGB format.
+            The image data is a numpy array representing the image in RGB format (or LargeImage if lazy).
             The flag is True if cv2 was used, False otherwise.
     """
+    if lazy and Path(image_path).suffix.lower() in TIFF_EXTENSIONS:
+        return LargeImage(image_path), False
     use_cv2 = True
     # read image, cv2 fails on large files
     try:
@@ -223,6 +308,8 @@ def read_image_as_pil(image: Union[Image.Image, str, np.ndarray], exif_fix: bool
                 image_pil = Image.fromarray(image_sk, mode="RGB")
             else:
                 raise TypeError(f"image with shape: {image_sk.shape[3]} is not supported.")
+    elif isinstance(image, (LargeImage, ImageTile)):
+        image_pil = Image.fromarray(np.asarray(image))
     elif isinstance(image, np.ndarray):
         if image.shape[0] < 5:  # image in CHW
             image = image[:, :, ::-1]
@@ -232,6 +319,17 @@ def read_image_as_pil(image: Union[Image.Image, str, np.ndarray], exif_fix: bool
     return image_pil
 
 
+def read_image_as_numpy(image: Union[Image.Image, str, np.ndarray, LargeImage, ImageTile]) -> np.ndarray:
+    """
+    Loads an image as contiguous np.ndarray, the same as np.ascontiguousarray(read_image_as_pil(image)).
+    Numpy images (also views of larger images) and lazy handles are converted directly,
+    without the round trip through PIL, which copies the whole image twice.
+    """
+    if isinstance(image, (LargeImage, ImageTile)) or (isinstance(image, np.ndarray) and image.shape[0] >= 5):
+        return np.ascontiguousarray(image)
+    return np.ascontiguousarray(read_image_as_pil(image))
+
+
 def select_random_color():
     """
     Selects a random color from a predefined list of colors.
@@ -598,7 +696,7 @@ def visualize_object_predictions(
     return {"image": image, "elapsed_time": elapsed_time}
 
 
-def get_coco_segmentation_from_bool_mask(bool_mask):
+def get_coco_segmentation_from_bool_mask(bool_mask, offset: list = [0, 0]):
     """
     Convert boolean mask to coco segmentation format
     [
@@ -606,12 +704,16 @@ def get_coco_segmentation_from_bool_mask(bool_mask):
         [x1, y1, x2, y2, x3, y3, ...],
         ...
     ]
+    The offset [x, y] is added to the coordinates, so that a crop of a larger mask
+    gives the segmentation in the coordinates of the larger mask.
     """
     # Generate polygons from mask
     mask = np.squeeze(bool_mask)
     mask = mask.astype(np.uint8)
     mask = cv2.copyMakeBorder(mask, 1, 1, 1, 1, cv2.BORDER_CONSTANT, value=0)
-    polygons = cv2.findContours(mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE, offset=(-1, -1))
+    polygons = cv2.findContours(
+        mask, cv2.RETR_LIST, cv2.CHAIN_APPROX_SIMPLE, offset=(int(offset[0]) - 1, int(offset[1]) - 1)
+    )
     polygons = polygons[0] if len(polygons) == 2 else polygons[1]
     # Convert polygon to coco segmentation
     coco_segmentation = []
@@ -643,6 +745,41 @@ def get_bool_mask_from_coco_segmentation(coco_segmentation: List[List[float]], w
     return bool_mask
 
 
+def get_bool_mask_crop_from_coco_segmentation(
+    coco_segmentation: List[List[float]], width: int = None, height: int = None
+) -> Tuple[np.ndarray, List[int]]:
+    """
+    Convert coco segmentation to 2D boolean mask of the bounding box of the segmentation only,
+    so that the mask of a small object is not drawn on the canvas of the full image.
+
+    Parameters:
+    - coco_segmentation: list of points representing the coco segmentation
+    - width: width of the full image, the mask is clipped to it if given
+    - height: height of the full image, the mask is clipped to it if given
+
+    Returns:
+    - bool_mask: 2D boolean mask of the crop, the same as
+      get_bool_mask_from_coco_segmentation(...)[y:y + h, x:x + w]
+    - offset: [x, y] of the top left corner of the crop in the full image
+    """
+    points = [np.array(point).reshape(-1, 2).round().astype(np.int32) for point in coco_segmentation]
+    points = [point for point in points if len(point) > 0]
+    if len(points) == 0:
+        return np.zeros((0, 0), dtype=bool), [0, 0]
+    all_points = np.concatenate(points)
+    x0, y0 = np.maximum(all_points.min(axis=0), 0)
+    x1, y1 = all_points.max(axis=0) + 1
+    if width is not None:
+        x1 = min(x1, width)
+    if height is not None:
+        y1 = min(y1, height)
+    if x1 <= x0 or y1 <= y0:
+        return np.zeros((0, 0), dtype=bool), [0, 0]
+    crop = np.zeros((y1 - y0, x1 - x0), dtype=np.uint8)
+    cv2.fillPoly(crop, [point - np.array([x0, y0], dtype=np.int32) for point in points], 1)
+    return crop.view(bool), [int(x0), int(y0)]
+
+
 def get_bbox_from_bool_mask(bool_mask: np.ndarray) -> Optional[List[int]]:
     """
     Generate VOC bounding box [xmin, ymin, xmax, ymax] from given boolean mask.
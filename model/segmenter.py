@@ -8,13 +8,19 @@ These are the models for:
 import os
 import numpy as np
 from ultralytics import YOLO
-from model.sahi.utils.cv import read_image
 from model.sahi.predict import get_sliced_prediction
 from model.sahi.auto_model import AutoDetectionModel
 
 from model.BaseModel import BaseModel
 from model.utils import *
 
+# params of x20 inference, see Segmenter.count_x20()
+X20_INFERENCE_PARAMS = {"conf": 0.3, "iou": 0.6, "max_det": 2000, "retina_masks": True}
+# params of sliced x10 inference, see Segmenter.count_x10()
+X10_SLICE_PARAMS = {"slice_height": 144, "slice_width": 144,
+                    "overlap_height_ratio": .1, "overlap_width_ratio": .1}
+X10_CONFIDENCE_THRESHOLD = 0.005
+
 
 class Segmenter(BaseModel):
     def init_x20_model(self, path_to_model: str):
@@ -24,12 +30,16 @@ class Segmenter(BaseModel):
         self.model_x10 = AutoDetectionModel.from_pretrained(
             model_type='yolov8',
             model_path=path_to_model,
-            confidence_threshold=0.005,
+            confidence_threshold=X10_CONFIDENCE_THRESHOLD,
             device="cpu", # or 'cuda:0'
         )
 
+    def cache_params(self) -> dict:
+        return {"model": type(self).__name__, "x20": X20_INFERENCE_PARAMS,
+                "x10": dict(X10_SLICE_PARAMS, confidence_threshold=self.model_x10.confidence_threshold)}
+
     def count_x20(self, input_image, plot = True, colormap="tab20", tracking=False,
-              filename=".cache/cell_tmp_img_with_detections.png", min_score=0.05,
+              filename=None, min_score=0.05,
               alpha=0.75, store_bin_mask=False, **kwargs):
         """
         This function performs inference on a given image using a pre-trained given model.
@@ -42,85 +52,94 @@ class Segmenter(BaseModel):
 
         Args:
             - model: loaded ultralytics YOLO model;
-            - input_image: path to input image;
+            - input_image: path to input image or the image itself as BGR np.array;
+            - filename: path for saving the image with detections. Nothing is saved if None;
             - **kwargs: additional configurations for model inference: conf, iou etc.
 
         Returns:
             - list of dictionaries containing detections information.
         """
-        try:
+        if filename is not None and os.path.exists(filename):
             os.remove(filename)
-        except FileNotFoundError:
-            pass
 
-        #every time detect from fresh
-        self.detections = None
-        
         colormap = self.object_size['color_map']
+        self.original_image = load_image_bgr(input_image)
+        self.h, self.w = self.original_image.shape[0], self.original_image.shape[1]
+        # the inference is skipped if the detections were taken from the cache
         if self.detections is None:
-            outputs = self.model(input_image, conf=0.3, iou=0.6,
-                                max_det = 2000, retina_masks=True, **kwargs)[0]
-            self.original_image = outputs.orig_img
+            outputs = self.model(self.original_image, **X20_INFERENCE_PARAMS, **kwargs)[0]
             if outputs.masks is None:
                 return None
-            self.detections = results_to_pandas(outputs, store_bin_mask)
-            self.h, self.w = outputs.orig_img.shape[0], outputs.orig_img.shape[1]
-            self.detections['box'] = self.detections['box'].apply(lambda b: b * np.array([self.w,
-            self.h, self.w, self.h]))
-
-            if tracking is False:
-                self.object_size['signal']("set_size", self.detections['box'].copy())
-                self.detections[['id_label', 'confidence', 'diameter', 'area',
-                                 'volume']].to_csv(self.out_dir / "cell_data.csv",
-                                                   sep=';', index=False)
-
-        detections = self.detections[self.detections['confidence'] >= min_score]
-        if tracking is False:
-            self.object_size['signal']("set_size", self.detections['box'].copy())
-        original_image = self.original_image.copy()
+            self.detections = self.outputs_to_detections(outputs, store_bin_mask)
+
+        self.set_render_state(self.original_image, min_score, colormap=colormap, alpha=alpha)
         if tracking is False:
-            filtered_detections = filter_detections(detections,
-                                                    min_size = self.object_size['min_size'],
-                                                    max_size= self.object_size['max_size'])
-        else:
-            filtered_detections = detections
-
-        self.prediction_image = None
-        if plot is True:
-            self.prediction_image = plot_predictions(original_image, filtered_detections['mask'].tolist(),
-                            filename=filename, colormap=colormap, alpha=alpha)
-        return filtered_detections
+            self.object_size['signal']("set_size", self.detections.box_areas())
+            self.detections.to_pandas(['id_label', 'confidence', 'diameter', 'area',
+                                       'volume']).to_csv(self.out_dir / "cell_data.csv",
+                                                         sep=';', index=False)
+        # the detections are filtered by size only outside of tracking
+        return self.refilter(filename=filename, plot=plot, filter_by_size=tracking is False)
+
+    @staticmethod
+    def outputs_to_detections(outputs, store_bin_mask=False):
+        """
+        Converts ultralytics Results of a single image into Detections
+        with the boxes in pixels of the original image.
+        """
+        return results_to_detections(outputs, store_bin_mask)
+
+    def count_batch(self, input_images: list, batch_size: int = 8, min_score=0.05,
+                    store_bin_mask=False, **kwargs):
+        """
+        Performs batched inference of x20 model on a list of images.
+        Images are passed through the model in chunks of batch_size, so that the per-call
+        overhead of ultralytics is paid once per batch rather than once per image.
+        No filtering by size and no plotting is applied here.
+
+        Input params:
+        - input_images: list of paths to images or numpy arrays (H, W, C) in BGR format;
+        - batch_size: int - number of images in a single forward pass. Default to 8;
+        - min_score: float - minimal confidence of the detections to be kept;
+        - store_bin_mask: bool - whether to store binary masks in the tables;
+        - **kwargs: additional configurations for model inference.
+
+        Returns:
+        - list of Detections, one per input image (None if nothing was found).
+        """
+        if batch_size < 1:
+            raise ValueError(f"Batch size must be positive, got {batch_size}")
+        tables = []
+        for start in range(0, len(input_images), batch_size):
+            batch = list(input_images[start:start + batch_size])
+            outputs = self.model(batch, **X20_INFERENCE_PARAMS,
+                                 batch=len(batch), verbose=False, **kwargs)
+            for result in outputs:
+                if result.masks is None:
+                    tables.append(None)
+                    continue
+                detections = self.outputs_to_detections(result, store_bin_mask)
+                tables.append(detections.filter_by_score(min_score))
+        return tables
 
     def count_x10(self, input_image: str, colormap="tab20",
-              filename=".cache/cell_tmp_img_with_detections.png", min_score=0.01,
+              filename=None, min_score=0.01,
               alpha=0.75, **kwargs):
-        try:
+        if filename is not None and os.path.exists(filename):
             os.remove(filename)
-        except FileNotFoundError:
-            pass
         colormap = self.object_size['color_map']
+        self.original_image = load_image_bgr(input_image)
+        self.h, self.w = self.original_image.shape[0], self.original_image.shape[1]
+        # the inference is skipped if the detections were taken from the cache
         if self.detections is None:
-            self.original_image = read_image(input_image)
+            # RGB view of the image, the slices are taken from it without copying the whole image
             outputs = get_sliced_prediction(
-                input_image,
+                self.original_image[:, :, ::-1],
                 self.model_x10,
-                slice_height=144,
-                slice_width=144,
-                overlap_height_ratio=.1,
-                overlap_width_ratio=.1
-            ).to_coco_predictions()
-            self.h, self.w = self.original_image.shape[0], self.original_image.shape[1]
-            self.detections = sahi_to_pandas(outputs, self.h, self.w)
-            self.object_size['signal']("set_size", self.detections['box'].copy())
-
-        detections = self.detections[self.detections['confidence'] >= min_score]
-
-        original_image = self.original_image.copy()
-
-        filtered_detections = filter_detections(detections,
-                                                min_size = self.object_size['min_size'],
-                                                max_size= self.object_size['max_size'])
-        self.prediction_image = None
-        self.prediction_image = plot_predictions(original_image, filtered_detections['mask'].tolist(),
-                         filename=filename, colormap=colormap, alpha=alpha)
-        return filtered_detections
+                **X10_SLICE_PARAMS
+            ).object_prediction_list
+            self.detections = sahi_predictions_to_detections(outputs, self.h, self.w)
+
+        self.object_size['signal']("set_size", self.detections.box_areas())
+        self.set_render_state(self.original_image, min_score, colormap=colormap, alpha=alpha)
+        return self.refilter(filename=filename)
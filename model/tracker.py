@@ -6,11 +6,85 @@ import os
 import shutil
 from pathlib import Path
 import numpy as np
-import pandas as pd
 import cv2
 
-from model.segmenter import Segmenter
 from model.utils import *
+from model.lsm import PageStream
+
+TRACK_COLUMNS = {
+    "frame_num": (np.int64, None),
+    "id_label": (np.int64, None),
+    "old_label": (np.int64, None),
+    "box": (np.float64, 4),
+    "confidence": (np.float64, None),
+    "diameter": (np.float64, None),
+    "area": (np.float64, None),
+    "volume": (np.float64, None)
+}
+
+
+class ColumnBuffer():
+    """
+    Growable columnar buffer for accumulating records of a sequence of frames.
+    The columns are preallocated numpy arrays, whose capacity is doubled when they are full,
+    so that appending a frame costs time proportional to the number of its records only.
+
+    Input params are:
+    - columns: dict - name of the column -> (dtype, width), where width is None for scalar columns;
+    - capacity: int - initial number of records. Default to 256.
+    """
+    def __init__(self, columns: dict, capacity: int = 256):
+        self.columns = columns
+        self.size = 0
+        self.data = {name: np.zeros((capacity,) if width is None else (capacity, width), dtype=dtype)
+                     for name, (dtype, width) in columns.items()}
+
+    def __len__(self):
+        return self.size
+
+    def extend(self, **values):
+        """Appends the records given as arrays of equal length for every column."""
+        n = len(next(iter(values.values())))
+        capacity = len(next(iter(self.data.values())))
+        if self.size + n > capacity:
+            capacity = max(2 * capacity, self.size + n)
+            for name, column in self.data.items():
+                grown = np.zeros((capacity,) + column.shape[1:], dtype=column.dtype)
+                grown[:self.size] = column[:self.size]
+                self.data[name] = grown
+        for name, column in self.data.items():
+            column[self.size:self.size + n] = values[name]
+        self.size += n
+
+    def to_pandas(self) -> "pd.DataFrame":
+        """Builds the DataFrame of all the accumulated records at once."""
+        import pandas as pd
+        data = {}
+        for name, (_, width) in self.columns.items():
+            column = self.data[name][:self.size]
+            data[name] = list(column) if width is not None else column
+        return pd.DataFrame(data, columns=list(self.columns))
+
+
+def associate(iou_matrix: np.array, min_iou: float = 0.0):
+    """
+    Finds the optimal one-to-one assignment between the objects of 2 frames
+    maximizing the total IoU (Hungarian algorithm).
+
+    Input params:
+    - iou_matrix: np.array (N, M) - IoU of i-th object from the previous frame and j-th object from the current one;
+    - min_iou: float - assigned pairs with IoU not greater than this value are discarded. Default to 0.0.
+
+    Returns:
+    - rows, cols: np.arrays of indices of the matched objects in the previous and the current frames.
+    """
+    from scipy.optimize import linear_sum_assignment
+    if iou_matrix.size == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rows, cols = linear_sum_assignment(iou_matrix, maximize=True)
+    keep = iou_matrix[rows, cols] > min_iou
+    return rows[keep], cols[keep]
+
 
 class Tracker():
     """
@@ -19,16 +93,36 @@ class Tracker():
     a pre-trained YOLO11x instance segmentation model (defined as Segmenter class instance).
     """
     def __init__(self, path_to_model: str, size):
+        # ultralytics is loaded only when the tracker is actually created
+        from model.segmenter import Segmenter
         self.path = path_to_model
         self.model = Segmenter(path_to_model, size)
         self.output_dir = Path("tracker_output")
         self.img_dir = self.output_dir / "frames"
         self.table_dir = self.output_dir / "tabular data"
 
-    def track(self, img_seq_folder: str, time_period: float = 15):
+    @staticmethod
+    def iter_frames(img_seq_folder: str, channel: int = 0, read_ahead: int = 2):
+        """
+        Yields the frames of the sequence as BGR np.arrays.
+        The sequence is either a folder of single frames processed in sorted order,
+        or a single multi-page lsm/tif file streamed frame by frame, see model.lsm.PageStream.
+        """
+        if os.path.isfile(img_seq_folder):
+            for page in PageStream(img_seq_folder, [channel], read_ahead=read_ahead):
+                yield cv2.cvtColor(to_uint8(page[0]), cv2.COLOR_GRAY2BGR)
+        else:
+            for frame_name in sorted(os.listdir(img_seq_folder)):
+                yield load_image_bgr(os.path.join(img_seq_folder, frame_name))
+
+    def track(self, img_seq_folder: str, time_period: float = 15, min_iou: float = 0.0,
+              channel: int = 0, read_ahead: int = 2):
         """
         Tracks spheroid instances through the sequence of frames.
         Uses Segmenter segmentation model for segmenting given frames.
+        Each frame is associated with the previous processed one: the spheroids are matched by
+        the optimal assignment of their masks' IoU, the matched ones keep their IDs
+        and the unmatched ones start new tracks.
         Afterwards, it saves the results in the tracker_output folder.
         The obtained saved results include:
         - all processed frames with masks visualized above;
@@ -36,8 +130,11 @@ class Tracker():
         - individual CSV tables for each spheroid instance with its size params at each frame.
 
         Input params include:
-        - img_seq_folder: str - directory containing sequence of frames;
-        - time_period: time period (presumably, in seconds) between frame shots. Default to 15.
+        - img_seq_folder: str - directory containing sequence of frames, or multi-page lsm/tif file;
+        - time_period: time period (presumably, in seconds) between frame shots. Default to 15;
+        - min_iou: float - minimal IoU of the masks for matching spheroids of consecutive frames. Default to 0.0;
+        - channel: int - channel of multi-page lsm/tif file with the spheroids. Default to 0;
+        - read_ahead: int - maximal number of pages of lsm/tif file decoded ahead of the model. Default to 2.
 
         Output:
         - None
@@ -52,135 +149,51 @@ class Tracker():
         os.makedirs(self.img_dir, exist_ok=True)
         os.makedirs(self.table_dir, exist_ok=True)
 
-        self.results = {
-            "frame_num": [],
-            "id_label": [],
-            "old_label": [],
-            "box": [],
-            "mask": [],
-            "confidence": [],
-            "diameter": [],
-            "area": [],
-            "volume": []
-        }
-
-        frame_names = os.listdir(img_seq_folder)
-        zero_frame = True
-        i = -1
+        buffer = ColumnBuffer(TRACK_COLUMNS)
+        # state of the previous processed frame: label image, areas of the labels and their track IDs
+        prev_labels, prev_areas, prev_track_ids = None, None, None
+        next_track_id = 0
+
         # we process each frame one-by-one in the loop below
-        for frame_name in frame_names:
-            i += 1
-            path = os.path.join(img_seq_folder, frame_name)
+        for i, frame in enumerate(self.iter_frames(img_seq_folder, channel, read_ahead)):
             filename = str(self.img_dir / ("frame_" + str(i).zfill(3) + ".png"))
-            output = self.model.count_x20(path, plot=False, filename=filename,
+            output = self.model.count_x20(frame, plot=False, filename=filename,
                                           store_bin_mask=True, tracking=True)
             self.model.clear_cached_detections()
-            # if it is the first frame in the sequence, we need to process it a bit differently
-            if zero_frame:
-                current_results = pandas_to_ultralytics(output, cv2.imread(path),
-                                                        path=filename, frame_num=i)
-                if current_results is None:
-                    continue
-                current_image = current_results.plot(conf=True, labels=True, boxes=True,
-                                                     masks=True, probs=False, show=False,
-                                                     save=True, color_mode="class",
-                                                     filename=filename)
-                zero_frame_results = output.copy()
-                for c, _ in enumerate(zero_frame_results['mask'].tolist()):
-                    # some masks are of 0 length, so we must filter and skip them
-                    if len(zero_frame_results['mask'].iloc[c]) == 0:
-                        pass
-                    else:
-                        # but in general we just mine the needed data and save it
-                        _, morphology = plot_mask(zero_frame_results['mask'].iloc[c])
-
-                        self.results["frame_num"].append(i)
-                        self.results["id_label"].append(c)
-                        self.results["old_label"].append(c)
-                        self.results["box"].append(zero_frame_results['box'].iloc[c])
-                        self.results["mask"].append(zero_frame_results['mask'].iloc[c])
-                        self.results["confidence"].append(zero_frame_results['confidence'].iloc[c])
-                        self.results["diameter"].append(morphology['diameter'])
-                        self.results["area"].append(morphology['area'])
-                        self.results["volume"].append(morphology['volume'])
-                
-            # below we process the other sequence frames
-            else:
-                # firstly, converting current results to pandas dataframe
-                self.results = pd.DataFrame(self.results)
-                # then, we need to correspond the spheroid from current frame with spheroids
-                # from the very first frame to assign the same IDs to them
-                iou_matrix, morphology = compute_iou(zero_frame_results['mask'].tolist(), output['mask'].tolist())
-
-                # Mask to identify columns with non-zero elements
-                non_zero_columns = (iou_matrix != 0).any(axis=0)
-
-                # Create a reduced matrix with only the desired columns
-                filtered_matrix = iou_matrix[:, non_zero_columns]
-
-                # Compute argmax for the filtered matrix
-                id_indices = np.full(iou_matrix.shape[1], -1)  # Default value for excluded columns (-1 or another value)
-                iou_values = np.full(iou_matrix.shape[1], -1).astype(float)  # Default value for excluded columns (-1 or another value)
-                id_indices[non_zero_columns] = np.argmax(filtered_matrix, axis=0)
-                iou_values[non_zero_columns] = np.max(filtered_matrix, axis=0)
-
-                # now we need to filter out those instances which correspond to 2+
-                # original ones at the same time by choosing the "real" one
-                # Step 1: Identify unique id_indices (excluding -1 values) and their indices
-                unique_indices = np.unique(id_indices[non_zero_columns])
-
-                # Step 2: Iterate over unique indices and handle duplicates
-                for index in unique_indices:
-                    if np.sum(id_indices == index) > 1:  # If the index appears more than once
-                        # Find the position where iou_values are maximized for this index
-                        max_iou_index = np.argmax(iou_values[id_indices == index])
-
-                        # Set all occurrences of this index to -1 except the one with the maximum IOU value
-                        indices_to_update = np.where(id_indices == index)[0]
-                        for itu in indices_to_update:
-                            if itu != indices_to_update[max_iou_index]:
-                                id_indices[itu] = -1
-
-                for k, row in output.iterrows():
-                    if k >= len(id_indices):
-                        break
-                    row["id_label"] = id_indices[k]
-                    record = pd.DataFrame({
-                        "frame_num": [i],
-                        "id_label": [row['id_label']],
-                        "old_label": [k],
-                        "box": [row['box']],
-                        "mask": [row['mask']],
-                        "confidence": [row['confidence']],
-                        "diameter": [morphology[k]['diameter']],
-                        "area": [morphology[k]['area']],
-                        "volume": [morphology[k]['volume']]
-                    })
-                    # here we assigned all the iIDs, mined all the data and then save it below
-                    self.results = pd.concat((self.results, record), ignore_index=True)
-                filtered_results = self.results[(self.results['frame_num'] == i)
-                                                & (self.results['id_label'] != -1)]
-                columns_of_interest = ["frame_num", "old_label", "box", "mask",
-                                       "confidence", "diameter", "area", "volume"]
-                current_results = pd.merge(filtered_results[columns_of_interest],
-                                           output[['id_label', 'bin_mask']],
-                                           left_on='old_label', right_on='id_label', how='inner')
-                current_results['id_label'] = filtered_results['id_label'].tolist()
-                current_results = pandas_to_ultralytics(current_results, cv2.imread(path),
-                                                        path=filename, frame_num=i)
-                if current_results is None:
-                    continue
-                current_image = current_results.plot(conf=True, labels=True, boxes=True,
-                                                     masks=True, probs=False, show=False,
-                                                     save=True, color_mode="class",
-                                                     filename=filename)
-            zero_frame = False
-        # now we processed all frames and start saving the results
-        self.results['id_label'].dropna(inplace=True)
-        self.results = self.results[self.results['id_label'] != -1]
-        unique_spheroids = self.results['id_label'].unique().tolist()
-        for spheroid in unique_spheroids:
-            spheroid_records = self.results[self.results['id_label'] == spheroid]
+            # frames without detections are skipped and do not break the tracks
+            if output is None or output.empty:
+                continue
+            labels, areas = rasterize_labels(output.masks)
+            morphology = morphology_from_area(areas / labels.size)
+
+            # the spheroids matched with the previous frame inherit its IDs, the others get new ones
+            track_ids = np.full(len(output), -1, dtype=np.int64)
+            if prev_labels is not None:
+                rows, cols = associate(label_iou(prev_labels, prev_areas, labels, areas), min_iou)
+                track_ids[cols] = prev_track_ids[rows]
+            new_tracks = track_ids == -1
+            track_ids[new_tracks] = np.arange(next_track_id, next_track_id + np.sum(new_tracks))
+            next_track_id += int(np.sum(new_tracks))
+            prev_labels, prev_areas, prev_track_ids = labels, areas, track_ids
+
+            buffer.extend(frame_num=np.full(len(output), i), id_label=track_ids,
+                          old_label=np.arange(len(output)), box=output.boxes,
+                          confidence=output.confidence, diameter=morphology['diameter'],
+                          area=morphology['area'], volume=morphology['volume'])
+
+            tracked = output.subset(np.arange(len(output)))
+            tracked.id_label = track_ids
+            current_results = pandas_to_ultralytics(tracked, frame,
+                                                    path=filename, frame_num=i)
+            if current_results is None:
+                continue
+            current_results.plot(conf=True, labels=True, boxes=True,
+                                 masks=True, probs=False, show=False,
+                                 save=True, color_mode="class",
+                                 filename=filename)
+        # now we processed all frames and build the table at once to save the results
+        self.results = buffer.to_pandas()
+        for spheroid, spheroid_records in self.results.groupby('id_label'):
             columns_of_interest = ["frame_num", "confidence", "diameter", "area", "volume"]
             filename = str(self.table_dir / ("spheroid_" + str(spheroid).zfill(2) + ".csv"))
             spheroid_records[columns_of_interest].to_csv(filename, sep=';', index=False)
@@ -3,14 +3,12 @@
 import os
 import cv2
 import numpy as np
-import torch
-import pandas as pd
-import matplotlib.pyplot as plt
-import matplotlib.colors as mcolors
 
-from ultralytics.engine.results import Results
+from model.detections import Detections
+from model.lsm import get_lsm_reader, read_lsm_channels, to_uint8
 
-import tiffile
+# torch, ultralytics and matplotlib are imported inside of the functions using them,
+# so that importing this module does not load the frameworks of the backends left unused
 
 
 
@@ -34,22 +32,23 @@ COLOR_NUMBER = {
     }
 
 def read_lsm_img(img_path, cell_channel=0, nuclei_channel=1):
-    """Reads lsm image and returns as array."""
-    with tiffile.TiffFile(img_path) as tif:
-        image = tif.pages[0].asarray()
-    if np.transpose(image, (1, 2, 0)).shape[-1] == 1:
-        return cv2.cvtColor(np.transpose(image, (1, 2, 0)), cv2.COLOR_GRAY2RGB)
-    elif np.transpose(image, (1, 2, 0)).shape[-1] == 2:
-        img = np.transpose(image, (1, 2, 0))
-        stacked_array = np.dstack((img, np.zeros((512,512)).astype('uint8')))
-        return stacked_array
-    elif np.transpose(image, (1, 2, 0)).shape[-1] == 3:
-        return np.transpose(image, (1, 2, 0))
+    """
+    Reads lsm image and returns it as (H, W, 3) array, where the channels are:
+    - all 3 channels of the image, if it has 3 channels;
+    - the single channel repeated 3 times, if the image is grayscale;
+    - cell channel, nuclei channel and zeros otherwise.
+    Only the needed channels are read, see model.lsm.LsmReader.
+    """
+    reader = get_lsm_reader(img_path)
+    if reader.num_channels == 1:
+        return cv2.cvtColor(reader.channel(0), cv2.COLOR_GRAY2RGB)
+    elif reader.num_channels == 3:
+        return np.transpose(reader.channels([0, 1, 2]), (1, 2, 0))
+    elif reader.num_channels == 2:
+        channels = reader.channels([0, 1])
     else:
-        img = np.transpose(image, (1, 2, 0))
-        stacked_array = np.dstack((img[cell_channel], img[nuclei_channel],
-                                   np.zeros((512,512)).astype('uint8')))
-        return stacked_array
+        channels = reader.channels([cell_channel, nuclei_channel])
+    return np.dstack((channels[0], channels[1], np.zeros(channels.shape[1:], dtype=channels.dtype)))
 
 def read_standard_img(img_path):
     """Reads image in grayscale jpg/png/tif/bmp which contains cells only."""
@@ -57,6 +56,24 @@ def read_standard_img(img_path):
     return cv2.cvtColor(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY,
                                      cv2.COLOR_GRAY2RGB))
 
+def load_image_bgr(image) -> np.array:
+    """
+    Loads image of cells as BGR np.array with 3 channels.
+    The image may be given either as a path or as already decoded np.array,
+    in which case it is converted to BGR without touching the filesystem.
+    """
+    if isinstance(image, np.ndarray):
+        img = image
+    else:
+        img = cv2.imdecode(np.fromfile(image, dtype=np.uint8), cv2.IMREAD_COLOR)
+        if img is None:
+            raise RuntimeError(f"Unable to load image {image}")
+    if img.ndim == 2:
+        img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+    elif img.shape[2] == 4:
+        img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+    return img
+
 def is_image_valid(img_path: str):
     """Checks if provided image is in correct format."""
     extension = img_path.split('.')[-1]
@@ -85,17 +102,18 @@ def calculate_lsm(cell_counter, nuclei_counter,
     - Cells: count for all the cells detected;
     - %: the target percentage for alive cells (given lsm image only).
     """
-    img = read_lsm_img(img_path)
+    # only the two needed channels are read from the file
+    cell_channel_img, nuclei_channel_img = read_lsm_channels(img_path, [cell_channel, nuclei_channel])
+    return calculate_lsm_channels(cell_counter, nuclei_counter, cell_channel_img, nuclei_channel_img)
 
-    cell_img = cv2.cvtColor(img[:,:,cell_channel], cv2.COLOR_GRAY2BGR)
-    tmp_path = 'cell_tmp_img.png'
-    cv2.imwrite(tmp_path, cell_img)
-    cell_count = cell_counter.count_cells(tmp_path)
-    try:
-        os.remove(tmp_path)
-    except FileNotFoundError:
-        pass
-    nuclei_count = nuclei_counter.countNuclei(img[:,:,nuclei_channel])
+def calculate_lsm_channels(cell_counter, nuclei_counter, cell_channel_img, nuclei_channel_img):
+    """
+    Calculates the resulting target values given the channels of lsm image as (H, W) arrays,
+    e.g. the channels of a single page of multi-page lsm image. See calculate_lsm() for the output.
+    """
+    cell_img = cv2.cvtColor(to_uint8(cell_channel_img), cv2.COLOR_GRAY2BGR)
+    cell_count = cell_counter.count_cells(cell_img)
+    nuclei_count = nuclei_counter.countNuclei(to_uint8(nuclei_channel_img))
     percentage = (1 - nuclei_count/cell_count.shape[0]) * 100
     return {'Nuclei': nuclei_count, 'Cells': cell_count, '%': round(percentage,3)}
 
@@ -125,8 +143,7 @@ def draw_bounding_box(img, class_id, confidence, x, y, x_plus_w, y_plus_h, draw_
     else:
         img = cv2.circle(img, (x, y), 2, color, -1)
 
-def filter_detections(detections: pd.DataFrame, min_size: float = 0.0, max_size: float = 1.0, img_size: tuple = (512,512)) -> pd.DataFrame:
-    # NOTE: this function is deprecatedand no longer used, since we have implemented new inference pipeline
+def filter_detections(detections, min_size: float = 0.0, max_size: float = 1.0, img_size: tuple = (512,512)):
     """
     Filters bounding boxes based on their area.
     Bboxes of size < min_size or > max_size are removed.
@@ -134,68 +151,59 @@ def filter_detections(detections: pd.DataFrame, min_size: float = 0.0, max_size:
     This filtering function is implemented in October, 2024, to reduce the amount of garbage detected as cells.
 
     Input args:
-    - detections: pd.DataFrame of detections, including bboxes in [x1, y1, w, h] format, where x1, y1 - lower-left corner coordinates;
+    - detections: Detections or pd.DataFrame of detections, including bboxes in [x1, y1, w, h] format, where x1, y1 - upper-left corner coordinates;
     - min_size: float representing the minimal possible size of bbox;
     - max_size: float representing the maximal possible size of bbox;
-    - img_size: tuple of size 2 representing width and height of image.
+    - img_size: tuple of size 2 representing width and height of image. Used for DataFrames only,
+    since Detections know the size of their image.
 
-    Returns np.array of filtered bboxes.
+    Returns filtered detections of the same type.
     """
-    # assert(min_size <= max_size)
+    if isinstance(detections, Detections):
+        return detections.filter_by_size(min_size=min_size, max_size=max_size)
     if detections.empty:
         return detections
-    img_sq = img_size[0] * img_size[1]
-    # print(type(detections['box']))
-    # print(detections.head())
-    # print(detections['box'].head())
-    filtered_detections = detections[detections['box'].apply(lambda b: min_size <= b[2] * b[3] / img_sq <= max_size)]
-    # filtered_detections = filtered_detections[filtered_detections['box'].apply(lambda b: (min_size <= b[2] * b[3] / img_sq <= max_size).item())]
-    return filtered_detections
-
-def results_to_pandas(outputs: Results, store_bin_mask:bool = False) -> pd.DataFrame:
-    """Converts ultralytics Results instance to pandas DataFrame for easy filtering."""
-    if store_bin_mask is False:
-        data = {
-            "id_label": [],
-            "box": [],
-            "mask": [],
-            "confidence": [],
-            "diameter": [],
-            "area": [],
-            "volume": []
-        }
+    boxes = np.stack(detections['box'].to_numpy())
+    areas = boxes[:, 2] * boxes[:, 3] / (img_size[0] * img_size[1])
+    return detections[(areas >= min_size) & (areas <= max_size)]
+
+def results_to_detections(outputs: "Results", store_bin_mask:bool = False) -> Detections:
+    """
+    Converts ultralytics Results instance to Detections container for easy filtering.
+    All the boxes, confidences and morphology are computed in one pass: the areas are taken
+    from the mask tensor when it matches the original image shape (retina masks), otherwise
+    from the polygons using the shoelace formula.
+    """
+    polygons = outputs.masks.xyn
+    ids = np.flatnonzero([len(polygon) > 0 for polygon in polygons])
+    boxes = outputs.boxes.xyxy.cpu().detach().numpy()[ids]
+    boxes[:, 2:] -= boxes[:, :2]
+    confidences = outputs.boxes.conf.cpu().detach().numpy()[ids]
+    masks = [polygons[i] for i in ids]
+
+    h, w = outputs.orig_shape[0], outputs.orig_shape[1]
+    bin_masks = None
+    if tuple(outputs.masks.data.shape[1:]) == (h, w):
+        import torch
+        bin_masks = outputs.masks.data[torch.as_tensor(ids, dtype=torch.long)] > 0.5
+        areas = bin_masks.sum(dim=(1, 2)).cpu().numpy() / (h * w)
     else:
-        data = {
-            "id_label": [],
-            "box": [],
-            "mask": [],
-            "confidence": [],
-            "diameter": [],
-            "area": [],
-            "volume": [],
-            "bin_mask": []
-        }
-    for i, _ in enumerate(outputs.masks.xyn):
-        if len(outputs.masks.xyn[i]) == 0:
-            pass
+        areas = polygon_areas(masks)
+    morphology = morphology_from_area(areas)
+
+    stored_bin_masks = None
+    if store_bin_mask is True:
+        if bin_masks is not None:
+            stored_bin_masks = list(bin_masks.cpu().numpy())
         else:
-            data['id_label'].append(i)
-            box = outputs.boxes.xyxyn[i].cpu().detach().numpy()
-            box[2:] -= box[:2]
-            data['box'].append(box)
-            data['mask'].append(outputs.masks.xyn[i])
-            data['confidence'].append(outputs.boxes.conf[i].cpu().detach().numpy())
-            bin_mask, morphology = plot_mask(outputs.masks.xyn[i], image_size=outputs.orig_shape)
-            data['diameter'].append(morphology['diameter'])
-            data['area'].append(morphology['area'])
-            data['volume'].append(morphology['volume'])
-            if store_bin_mask is True:
-                data['bin_mask'].append(bin_mask)
-    return pd.DataFrame(data)
-
-def sahi_to_pandas(outputs: list, h: int, w: int) -> pd.DataFrame:
-    """
-    Converts predictions from SAHI model to pandas dataframe for further processing.
+            stored_bin_masks = [plot_mask(mask, image_size=(h, w))[0] for mask in masks]
+    return Detections.from_polygons(masks, boxes, confidences, (h, w), id_label=ids,
+                                    diameter=morphology['diameter'], area=morphology['area'],
+                                    volume=morphology['volume'], bin_masks=stored_bin_masks)
+
+def sahi_to_detections(outputs: list, h: int, w: int) -> Detections:
+    """
+    Converts predictions from SAHI model to Detections container for further processing.
 
     Input args:
     - outputs: list - model predictions in COCO_predictions format (list of dictionaries);
@@ -203,48 +211,178 @@ def sahi_to_pandas(outputs: list, h: int, w: int) -> pd.DataFrame:
     - w: image width (for normalizing masks).
 
     Returns:
-    - pd.DataFrame of the standard form with the predictions in it.
-    """
-    data = {
-        "id_label": [],
-        "box": [],
-        "mask": [],
-        "confidence": [],
-        "diameter": [],
-        "area": [],
-        "volume": []
-    }
-    try:
-        for i, obj in enumerate(outputs):
-            if len(obj['bbox']) == 4 and len(obj['segmentation']) == 1 and len(obj['segmentation'][0]) >= 8:
-                data['id_label'].append(i)
-                data['box'].append(np.array(obj['bbox']))
-                xs, ys = np.array(obj['segmentation'][0][::2]) / w, np.array(obj['segmentation'][0][1::2]) / h
-                mask_array = np.vstack((xs, ys)).T
-                data['mask'].append(mask_array)
-                data['confidence'].append(obj['score'])
-                _, morphology = plot_mask(mask_array)
-                data['diameter'].append(morphology['diameter'])
-                data['area'].append(morphology['area'])
-                data['volume'].append(morphology['volume'])
-    except:
-        print("Something wrong happenned...")
-    return pd.DataFrame(data)
+    - Detections of the standard form with the predictions in it.
+    """
+    ids, boxes, masks, confidences = [], [], [], []
+    for i, obj in enumerate(outputs):
+        if len(obj['bbox']) == 4 and len(obj['segmentation']) == 1 and len(obj['segmentation'][0]) >= 8:
+            ids.append(i)
+            boxes.append(obj['bbox'])
+            masks.append(np.array(obj['segmentation'][0]).reshape(-1, 2) / np.array([w, h]))
+            confidences.append(obj['score'])
+    return _sahi_polygons_to_detections(ids, boxes, masks, confidences, h, w)
+
+
+def sahi_predictions_to_detections(object_predictions: list, h: int, w: int) -> Detections:
+    """
+    Converts ObjectPredictions of SAHI model to Detections container directly, the same way as
+    sahi_to_detections() does with their COCO predictions, but without building the COCO dicts.
+    The COCO export passes each polygon through shapely, which fixes the invalid ones and truncates
+    the coordinates. Here all the polygons are validated by shapely at once, the valid ones are
+    truncated as arrays and only the invalid ones take the COCO export.
+
+    Input args:
+    - object_predictions: list of sahi.prediction.ObjectPrediction in the coordinates of the full image;
+    - h: image height (for normalizing masks);
+    - w: image width (for normalizing masks).
+
+    Returns:
+    - Detections of the standard form with the predictions in it.
+    """
+    import shapely
+
+    # predictions have masks only if their segmentation is a single polygon of 4+ points
+    masked = [i for i, prediction in enumerate(object_predictions) if prediction.mask is not None]
+    points = [np.array(object_predictions[i].mask.segmentation[0], dtype=np.float64).reshape(-1, 2)
+              for i in masked]
+    if len(points) > 0:
+        rings = shapely.linearrings(np.concatenate(points),
+                                    indices=np.repeat(np.arange(len(points)), [len(p) for p in points]))
+        polygons = shapely.polygons(rings)
+        valid = shapely.is_valid(polygons) & (shapely.area(polygons) != 0)
+    else:
+        valid = np.zeros(0, dtype=bool)
+
+    ids, boxes, masks, confidences = [], [], [], []
+    for i, polygon, is_valid in zip(masked, points, valid):
+        prediction = object_predictions[i]
+        if is_valid:
+            # the closing point is dropped and the coordinates are truncated as shapely does
+            if (polygon[0] == polygon[-1]).all():
+                polygon = polygon[:-1]
+            if len(polygon) < 4:
+                continue
+            (minx, miny), (maxx, maxy) = polygon.min(axis=0), polygon.max(axis=0)
+            bbox = [minx, miny, maxx - minx, maxy - miny]
+            polygon = np.trunc(polygon).astype(np.int64)
+        else:
+            obj = prediction.to_coco_prediction().json
+            if not (len(obj['bbox']) == 4 and len(obj['segmentation']) == 1
+                    and len(obj['segmentation'][0]) >= 8):
+                continue
+            bbox = obj['bbox']
+            polygon = np.array(obj['segmentation'][0]).reshape(-1, 2)
+        ids.append(i)
+        boxes.append(bbox)
+        masks.append(polygon / np.array([w, h]))
+        confidences.append(prediction.score.value)
+    return _sahi_polygons_to_detections(ids, boxes, masks, confidences, h, w)
+
+
+def _sahi_polygons_to_detections(ids, boxes, masks, confidences, h, w) -> Detections:
+    morphology = morphology_from_area(polygon_areas(masks))
+    return Detections.from_polygons(masks, np.array(boxes).reshape(-1, 4), confidences, (h, w),
+                                    id_label=ids, diameter=morphology['diameter'],
+                                    area=morphology['area'], volume=morphology['volume'])
+
+def labels_to_detections(label_image: np.array, prob_map: np.array = None, scores=None,
+                         img_shape: tuple = None, store_bin_mask: bool = False) -> Detections:
+    """
+    Converts label image produced by instance segmentation models (Cellpose, StarDist, InstanSeg)
+    to Detections container, where each positive label is one object and 0 is the background.
+    All the objects are tabulated in a single pass over the image: bounding boxes come from
+    scipy.ndimage.find_objects() slices, areas and mean probabilities from bincounts,
+    and the outer contour of each object is extracted from its local crop only.
+
+    Input params:
+    - label_image: np.array (H, W) of integer labels;
+    - prob_map: np.array (H, W) - probability map, the confidence of an object is its mean
+    probability. If its shape does not match the label image, the confidences are NaN;
+    - scores: array of confidences of the objects in the order of their labels;
+    - img_shape: tuple - (height, width) used for normalizing the contours. Default to the label image shape;
+    - store_bin_mask: bool - whether to store binary masks of the objects.
+    The confidences are 1.0 if neither prob_map nor scores are given.
+
+    Returns:
+    - Detections with pixel boxes in [x1, y1, w, h] format, normalized outer contours,
+    pixel areas and equivalent diameters. The volume equals the area for 2D objects.
+    """
+    from scipy.ndimage import find_objects
+    label_image = np.asarray(label_image)
+    label_image = label_image.reshape(label_image.shape[-2:])
+    if img_shape is None:
+        img_shape = label_image.shape
+    img_height, img_width = img_shape[0], img_shape[1]
+
+    slices = find_objects(label_image)
+    ids = np.array([k + 1 for k, box in enumerate(slices) if box is not None], dtype=np.int64)
+    if len(ids) == 0:
+        return Detections.empty_for((img_height, img_width))
+    flat_labels = label_image.ravel()
+    areas = np.bincount(flat_labels, minlength=len(slices) + 1)[ids].astype(np.float64)
+
+    if prob_map is not None:
+        if prob_map.shape == label_image.shape:
+            sums = np.bincount(flat_labels, weights=prob_map.ravel().astype(np.float64),
+                               minlength=len(slices) + 1)[ids]
+            confidence = sums / areas
+        else:
+            print(f"Warning: probability map shape {prob_map.shape} mismatches label image shape "
+                  f"{label_image.shape}. Confidence set to NaN.")
+            confidence = np.full(len(ids), np.nan)
+    elif scores is not None:
+        scores = np.asarray(scores, dtype=np.float64).reshape(-1)[:len(ids)]
+        confidence = np.full(len(ids), np.nan)
+        confidence[:len(scores)] = scores
+    else:
+        confidence = np.ones(len(ids))
+
+    boxes = np.empty((len(ids), 4), dtype=np.float64)
+    polygons = []
+    bin_masks = [] if store_bin_mask else None
+    scale = np.array([img_width, img_height], dtype=np.float32)
+    for i, object_id in enumerate(ids):
+        y_slice, x_slice = slices[object_id - 1]
+        boxes[i] = (x_slice.start, y_slice.start, x_slice.stop - x_slice.start,
+                    y_slice.stop - y_slice.start)
+        crop = label_image[y_slice, x_slice] == object_id
+        # the crop is padded, so that the objects touching the crop border get closed contours
+        contours, _ = cv2.findContours(np.pad(crop, 1).astype(np.uint8), cv2.RETR_EXTERNAL,
+                                       cv2.CHAIN_APPROX_SIMPLE,
+                                       offset=(int(x_slice.start) - 1, int(y_slice.start) - 1))
+        if contours:
+            contour = max(contours, key=cv2.contourArea)
+            polygons.append(contour.reshape(-1, 2).astype(np.float32) / scale)
+        else:
+            polygons.append(np.zeros((0, 2), dtype=np.float32))
+        if store_bin_mask:
+            bin_mask = np.zeros(label_image.shape, dtype=bool)
+            bin_mask[y_slice, x_slice] = crop
+            bin_masks.append(bin_mask)
+
+    diameter = np.sqrt(4 * areas / np.pi)
+    return Detections.from_polygons(polygons, boxes, confidence, (img_height, img_width),
+                                    id_label=ids, diameter=diameter, area=areas, volume=areas,
+                                    bin_masks=bin_masks)
 
 def pandas_to_ultralytics(df, original_image, path, frame_num: int = 0):
-    """Converts pandas DataFrame instance to ultralytics Results for easier plotting."""
-    names = {}
-    for n in range(100):
-        names[n] = str(n)
-    conf_array = np.array(df['confidence'].tolist())
+    """
+    Converts pandas DataFrame or Detections instance to ultralytics Results for easier plotting.
+    Binary masks of the detections are required.
+    """
+    conf_array = np.asarray(df['confidence'], dtype=np.float64).reshape(-1)
     if len(conf_array) == 0:
         return None
-    class_array = np.array(df['id_label'].tolist())
-    df['box'] = df['box'].apply(lambda b: [b[0], b[1], b[2] + b[0], b[3] + b[1]])
-    box_array = np.array(df['box'].tolist())
+    class_array = np.asarray(df['id_label'], dtype=np.float64).reshape(-1)
+    # track IDs of long sequences may exceed the default 100 names
+    names = {n: str(n) for n in range(max(100, int(class_array.max()) + 1))}
+    box_array = np.array(np.stack(list(df['box'])), dtype=np.float64)
+    box_array[:, 2:] += box_array[:, :2]
     box_array = np.hstack((box_array, np.expand_dims(conf_array, axis=1),
                            np.expand_dims(class_array, axis=1)))
-    mask_array = np.stack(df['bin_mask'].tolist(), axis=0)
+    mask_array = np.stack(list(df['bin_mask']), axis=0)
+    import torch
+    from ultralytics.engine.results import Results
     probs = torch.Tensor(conf_array)
     boxes = torch.Tensor(box_array)
     try:
@@ -255,34 +393,110 @@ def pandas_to_ultralytics(df, original_image, path, frame_num: int = 0):
                       masks=masks, probs=probs, keypoints=None, obb=None, speed=None)
     return results
 
-def compute_iou(masks_1: list, masks_2: list) -> np.array:
+def compute_iou(masks_1: list, masks_2: list, image_size=(1000,1000)) -> np.array:
     """
     Computes IoU matrix for 2 given sets of polygon masks.
     The function is used for spheroid tracjing.
+    Each set is rasterized only once into a label image, see rasterize_labels() and label_iou() below.
 
     Input params:
     - masks_1: list - first set of polygon masks defined as ultralytics.engine.Results.Masks.xyn numpy array;
-    - masks_2: list - second set of polygon masks defined as ultralytics.engine.Results.Masks.xyn numpy array.
+    - masks_2: list - second set of polygon masks defined as ultralytics.engine.Results.Masks.xyn numpy array;
+    - image_size = (1000, 1000) - size of the canvas for drawing.
 
     Returns:
-    - iou_matrix: numpy array - matrix of IoU values for corresponding i-th mask from the first set and j-th mask from the second set.
-    """
-    iou_matrix = np.zeros((len(masks_1), len(masks_2)))
-    mask_2_morphologies = []
-    for i, _ in enumerate(masks_1):
-        for j, _ in enumerate(masks_2):
-            mask1, _ = plot_mask(masks_1[i])
-            mask2, morphology = plot_mask(masks_2[j])
-            mask_2_morphologies.append(morphology)
-            intersection = np.sum(mask1 * mask2)
-            union = np.sum(np.clip(mask1 + mask2, 0, 1))
-            iou_matrix[i,j] = intersection / union
+    - iou_matrix: numpy array - matrix of IoU values for corresponding i-th mask from the first set and j-th mask from the second set;
+    - mask_2_morphologies: list - morphology of each mask from the second set.
+    """
+    labels_1, areas_1 = rasterize_labels(masks_1, image_size)
+    labels_2, areas_2 = rasterize_labels(masks_2, image_size)
+    iou_matrix = label_iou(labels_1, areas_1, labels_2, areas_2)
+    morphology = morphology_from_area(areas_2 / (image_size[0] * image_size[1]))
+    mask_2_morphologies = [{key: morphology[key][j] for key in morphology} for j in range(len(masks_2))]
     return iou_matrix, mask_2_morphologies
 
+def rasterize_labels(masks: list, image_size=(1000,1000)):
+    """
+    Rasterizes the given polygon masks into a single label image,
+    where the pixels of i-th mask have value i + 1 and the background pixels have value 0.
+    Where the masks overlap, the pixels belong to the mask drawn last.
+
+    Input params:
+    - masks: list - polygon masks defined as ultralytics.engine.Results.Masks.xyn numpy array;
+    - image_size = (1000, 1000) - size of the canvas for drawing.
+
+    Returns:
+    - label_image: np.array of int32 with the shape of image_size;
+    - areas: np.array - number of pixels of each mask in the label image.
+    """
+    label_image = np.zeros(image_size, dtype=np.int32)
+    scale = np.array([image_size[1], image_size[0]])
+    for i, mask in enumerate(masks):
+        if len(mask) == 0:
+            continue
+        coords = (np.asarray(mask).reshape(-1, 2) * scale).astype(np.int32)
+        cv2.fillPoly(label_image, [coords], i + 1)
+    areas = np.bincount(label_image.ravel(), minlength=len(masks) + 1)[1:]
+    return label_image, areas
+
+def label_bounding_boxes(label_image: np.array, num_labels: int) -> np.array:
+    """
+    Returns bounding boxes of the labels 1..num_labels as np.array (num_labels, 4)
+    in [y1, y2, x1, x2] format with exclusive ends. Missing labels get empty boxes.
+    """
+    from scipy.ndimage import find_objects
+    boxes = np.zeros((num_labels, 4), dtype=np.int64)
+    for i, box in enumerate(find_objects(label_image, max_label=num_labels)):
+        if box is not None:
+            boxes[i] = (box[0].start, box[0].stop, box[1].start, box[1].stop)
+    return boxes
+
+def label_iou(labels_1: np.array, areas_1: np.array, labels_2: np.array, areas_2: np.array) -> np.array:
+    """
+    Computes IoU matrix for all the pairs of labels of 2 label images of the same shape.
+    Intersections of all the pairs are taken from a single joint histogram of the paired labels.
+    When only few pairs have overlapping bounding boxes, the intersections are counted
+    inside of the overlapping parts of the boxes only, without passing the whole images.
+
+    Input params:
+    - labels_1, labels_2: np.array - label images as returned by rasterize_labels();
+    - areas_1, areas_2: np.array - number of pixels of each label.
+
+    Returns:
+    - iou_matrix: np.array (len(areas_1), len(areas_2)) of IoU values.
+    """
+    n_1, n_2 = len(areas_1), len(areas_2)
+    iou_matrix = np.zeros((n_1, n_2))
+    if n_1 == 0 or n_2 == 0:
+        return iou_matrix
+    boxes_1 = label_bounding_boxes(labels_1, n_1)
+    boxes_2 = label_bounding_boxes(labels_2, n_2)
+    y1 = np.maximum(boxes_1[:, None, 0], boxes_2[None, :, 0])
+    y2 = np.minimum(boxes_1[:, None, 1], boxes_2[None, :, 1])
+    x1 = np.maximum(boxes_1[:, None, 2], boxes_2[None, :, 2])
+    x2 = np.minimum(boxes_1[:, None, 3], boxes_2[None, :, 3])
+    overlaps = np.clip(y2 - y1, 0, None) * np.clip(x2 - x1, 0, None)
+    candidates = np.argwhere(overlaps > 0)
+    if len(candidates) == 0:
+        return iou_matrix
+    intersections = np.zeros((n_1, n_2), dtype=np.int64)
+    if overlaps.sum() < labels_1.size:
+        # sparse case: only the pairs with overlapping boxes can intersect
+        for i, j in candidates:
+            crop = (slice(y1[i, j], y2[i, j]), slice(x1[i, j], x2[i, j]))
+            intersections[i, j] = np.count_nonzero((labels_1[crop] == i + 1) & (labels_2[crop] == j + 1))
+    else:
+        joint = np.bincount(labels_1.ravel().astype(np.int64) * (n_2 + 1) + labels_2.ravel(),
+                            minlength=(n_1 + 1) * (n_2 + 1)).reshape(n_1 + 1, n_2 + 1)
+        intersections = joint[1:, 1:]
+    unions = areas_1[:, None] + areas_2[None, :] - intersections
+    np.divide(intersections, unions, out=iou_matrix, where=unions > 0)
+    return iou_matrix
+
 def plot_mask(in_mask: np.array, image_size=(1000,1000)) -> np.array:
     """
     Plots given mask on a 1000x1000 canvas for its further processing.
-    This util is used as a helper for compute_iou() function above.
+    This util is used for drawing a single mask, see rasterize_labels() for drawing a set of masks.
 
     Input params:
     - in_mask: np.array - np.array of contour points in ultralytics.engine.Results.Masks.xyn format;
@@ -326,6 +540,8 @@ def colormap_to_hex(cmap_name):
     assert cmap_name in color_number, f"incorrect colormap specified: {cmap_name}"
     num_colors = color_number[cmap_name]
     # Get the colormap object
+    import matplotlib.pyplot as plt
+    import matplotlib.colors as mcolors
     cmap = plt.get_cmap(cmap_name)
     color_values = [cmap(i / (num_colors - 1)) for i in range(num_colors)]
     hex_colors = [mcolors.to_hex(c) for c in color_values]
@@ -343,6 +559,7 @@ def hex_to_bgr(hex_colors):
     # Convert HEX to RGB
     if isinstance(hex_colors, str):  # Single color
         hex_colors = [hex_colors]
+    import matplotlib.colors as mcolors
     bgr_colors = []
     for hex_color in hex_colors:
         rgb = [int(c * 255) for c in mcolors.hex2color(hex_color)]
@@ -353,13 +570,15 @@ def denormalize_coordinates(coords, image_shape):
     """Converts normalized coords to given image coordinates."""
     return coords * np.array([image_shape[1], image_shape[0]])
 
-def plot_predictions(image, pred_masks, filename: str = ".cache/cell_tmp_img_with_detections.png",
+def plot_predictions(image, pred_masks, filename: str = None,
                      alpha=.75, colormap="tab20"):
-    """Draws predicted masks on the image."""
+    """Draws predicted masks on the image. The result is saved to disk only if filename is given."""
     hex_colors = hex_to_bgr(colormap_to_hex(colormap))
     if not pred_masks:
         print("No masks found.")
-        return
+        if filename is not None:
+            cv2.imwrite(filename, image)
+        return image
     overlay = image.copy()
     for i, mask in enumerate(pred_masks):
         coords = np.array(mask)
@@ -369,9 +588,40 @@ def plot_predictions(image, pred_masks, filename: str = ".cache/cell_tmp_img_wit
         coords = coords.astype(int)
         cv2.fillPoly(overlay, [coords], color)
     cv2.addWeighted(overlay, alpha, image, 1 - alpha, 0, image)
-    cv2.imwrite(filename, image)
+    if filename is not None:
+        cv2.imwrite(filename, image)
     return image
 
+def export_detections(image, detections, path: str):
+    """
+    Exports the image with detections and the table of detections on user request.
+    The table is saved next to the image with the same name and .csv extension.
+
+    Input params:
+    - image: np.array - BGR image with detections drawn;
+    - detections: Detections or pd.DataFrame of the detections, may be None;
+    - path: str - path to the exported image.
+
+    Returns:
+    - list of paths to the saved files.
+    """
+    saved = []
+    extension = os.path.splitext(path)[1]
+    success, encoded = cv2.imencode(extension if extension else '.png', image)
+    if not success:
+        raise RuntimeError(f"Unable to encode image for {path}")
+    encoded.tofile(path)
+    saved.append(path)
+    if detections is not None and not isinstance(detections, (int, float)):
+        if isinstance(detections, Detections):
+            detections = detections.to_pandas(['id_label', 'confidence', 'diameter',
+                                               'area', 'volume'])
+        table_path = os.path.splitext(path)[0] + '.csv'
+        columns = [c for c in detections.columns if c not in ('box', 'mask', 'bin_mask')]
+        detections[columns].to_csv(table_path, sep=';', index=False)
+        saved.append(table_path)
+    return saved
+
 def calculate_morphology(bin_mask: np.array) -> dict:
     """
     Calculates the morphology for the given segmented object.
@@ -383,8 +633,43 @@ def calculate_morphology(bin_mask: np.array) -> dict:
     - volume - relative to the image volume (image area multiplied by square root of image area).
     """
     img_area = bin_mask.shape[0] * bin_mask.shape[1]
-    area = np.sum(bin_mask)
+    return morphology_from_area(np.sum(bin_mask) / img_area)
+
+def morphology_from_area(area):
+    """
+    Calculates the morphology of segmented objects from their areas relative to the image area.
+    Works both for a single value and for np.array of values, see calculate_morphology() for details.
+    """
+    area = np.asarray(area, dtype=np.float64)
     diameter = 2 * np.sqrt(area / np.pi)
     radius = diameter / 2
     volume = (4/3) * np.pi * radius**3
-    return {'diameter': diameter / np.sqrt(img_area), 'area': area / img_area, 'volume': volume / (img_area * np.sqrt(img_area))}
+    return {'diameter': diameter, 'area': area, 'volume': volume}
+
+def polygon_areas(polygons: list) -> np.array:
+    """
+    Calculates the areas of the given polygons with the shoelace formula in a single vectorized pass.
+    For polygons in normalized coordinates the areas are relative to the image area.
+
+    Input params:
+    - polygons: list - list of np.arrays of contour points with shape (N, 2).
+
+    Returns:
+    - np.array of polygon areas.
+    """
+    if len(polygons) == 0:
+        return np.zeros(0, dtype=np.float64)
+    lengths = np.array([len(polygon) for polygon in polygons])
+    coords = np.concatenate([np.asarray(polygon, dtype=np.float64).reshape(-1, 2)
+                             for polygon in polygons])
+    starts = np.concatenate(([0], np.cumsum(lengths)[:-1]))
+    nonempty = lengths > 0
+    areas = np.zeros(len(polygons), dtype=np.float64)
+    if not nonempty.any():
+        return areas
+    # index of the next vertex of every polygon, wrapping the last one to the first one
+    next_idx = np.arange(len(coords)) + 1
+    next_idx[(starts + lengths - 1)[nonempty]] = starts[nonempty]
+    cross = coords[:, 0] * coords[next_idx, 1] - coords[next_idx, 0] * coords[:, 1]
+    areas[nonempty] = np.add.reduceat(cross, starts[nonempty])
+    return np.abs(areas) / 2
@@ -0,0 +1,104 @@
+"""Tests of streaming the frames of multi-page LSM / TIFF stacks."""
+import numpy as np
+import pytest
+
+tifffile = pytest.importorskip("tifffile")
+
+from model.lsm import PageStream, read_stack_layout, is_multipage
+from model.Model import Model
+
+
+def make_stack(num_frames=3, num_channels=2, height=16, width=20):
+    """Returns (T, C, H, W) stack, where each plane is filled with 10 * t + c."""
+    stack = np.zeros((num_frames, num_channels, height, width), dtype=np.uint16)
+    for t in range(num_frames):
+        for c in range(num_channels):
+            stack[t, c] = 10 * t + c
+    return stack
+
+
+def frame_means(path, channels, read_ahead=2):
+    return [[float(plane.mean()) for plane in frame]
+            for frame in PageStream(str(path), channels, read_ahead=read_ahead)]
+
+
+def test_imagej_hyperstack_channels_as_pages(tmp_path):
+    path = tmp_path / "hyperstack.tif"
+    tifffile.imwrite(path, make_stack(), imagej=True, metadata={'axes': 'TCYX'})
+    layout = read_stack_layout(str(path))
+    assert layout.channels_in_pages and layout.num_channels == 2 and layout.num_frames == 3
+    assert len(PageStream(str(path))) == 3
+    assert frame_means(path, [0]) == [[0], [10], [20]]
+    assert frame_means(path, [1]) == [[1], [11], [21]]
+    assert frame_means(path, [0, 1], read_ahead=1) == [[0, 1], [10, 11], [20, 21]]
+    assert frame_means(path, [1, 0]) == [[1, 0], [11, 10], [21, 20]]
+
+
+def test_imagej_hyperstack_with_z_axis(tmp_path):
+    path = tmp_path / "hyperstack.tif"
+    stack = make_stack(num_frames=6, num_channels=3).reshape(2, 3, 3, 16, 20)
+    tifffile.imwrite(path, stack, imagej=True, metadata={'axes': 'TZCYX'})
+    assert len(PageStream(str(path))) == 6
+    assert frame_means(path, [2, 0]) == [[10 * t + 2, 10 * t] for t in range(6)]
+
+
+def test_lsm_style_stack_channels_in_pages(tmp_path):
+    # as in LSM files, each page holds all the channels of a frame
+    path = tmp_path / "stack.lsm"
+    tifffile.imwrite(path, make_stack(), photometric='minisblack', planarconfig='separate',
+                     metadata={'axes': 'TCYX'})
+    layout = read_stack_layout(str(path))
+    assert not layout.channels_in_pages and layout.num_channels == 2 and layout.num_frames == 3
+    assert frame_means(path, [0, 1]) == [[0, 1], [10, 11], [20, 21]]
+    assert frame_means(path, None) == [[0, 1], [10, 11], [20, 21]]
+    assert is_multipage(str(path))
+
+
+def test_grayscale_stack(tmp_path):
+    path = tmp_path / "gray.tif"
+    tifffile.imwrite(path, make_stack(num_channels=1)[:, 0], photometric='minisblack')
+    assert read_stack_layout(str(path)).channel_axis is None
+    assert frame_means(path, [0]) == [[0], [10], [20]]
+    with pytest.raises(ValueError, match="out of range"):
+        PageStream(str(path), [0, 1])
+
+
+def test_single_page_is_not_multipage(tmp_path):
+    path = tmp_path / "single.tif"
+    tifffile.imwrite(path, make_stack()[0, 0])
+    assert not is_multipage(str(path))
+    assert frame_means(path, [0]) == [[0]]
+
+
+def test_stream_stops_when_consumer_leaves(tmp_path):
+    path = tmp_path / "hyperstack.tif"
+    tifffile.imwrite(path, make_stack(num_frames=10), imagej=True, metadata={'axes': 'TCYX'})
+    for frame in PageStream(str(path), [0], read_ahead=1):
+        break
+    assert frame[0].mean() == 0
+
+
+class FakeCounter():
+    """Cell counter returning the mean of the image, so that the processed frames can be told apart."""
+    inference_duration = 0
+
+    def count_cells(self, img):
+        assert img.ndim == 3 and img.shape[2] == 3 and img.dtype == np.uint8
+        return float(img.mean())
+
+
+def fake_model():
+    model = Model.__new__(Model)
+    model.cell_counter = FakeCounter()
+    model.nuclei_counter = None
+    model.inference_duration = 0
+    return model
+
+
+def test_calculate_stream_grayscale_tiff_as_standard_images(tmp_path):
+    path = tmp_path / "gray.tif"
+    stack = make_stack(num_channels=1)[:, 0].astype(np.uint8)
+    tifffile.imwrite(path, stack, photometric='minisblack')
+    results = list(fake_model().calculate_stream(str(path)))
+    assert [result['Cells'] for result in results] == [0, 10, 20]
+    assert all(result['Nuclei'] == -100 and result['%'] == -100 for result in results)
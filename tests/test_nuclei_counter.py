@@ -0,0 +1,63 @@
+"""Equivalence tests of the connected components NucleiCounter against the DBSCAN reference."""
+import numpy as np
+import pytest
+
+pytest.importorskip("sklearn")
+pytest.importorskip("scipy")
+
+from model.NucleiCounter import NucleiCounter
+
+# eps < 1, eps in [1, sqrt(2)), eps >= sqrt(2) and eps >= 2
+PARAMS = [(0.5, 1), (0.9, 1), (1, 1), (1, 3), (1.2, 2), (1.5, 3), (2, 1), (2, 5),
+          (2.5, 7), (3, 10), (5, 10)]
+
+
+def random_mask(seed, shape=(64, 80), density=0.3):
+    rng = np.random.default_rng(seed)
+    return (rng.random(shape) < density).astype(np.uint8) * 255
+
+
+def blob_channel(seed, shape=(96, 96), num_blobs=12):
+    """Returns uint8 channel of noisy bright blobs on dark background."""
+    rng = np.random.default_rng(seed)
+    channel = rng.integers(0, 40, shape).astype(np.float32)
+    yy, xx = np.mgrid[:shape[0], :shape[1]]
+    for _ in range(num_blobs):
+        y, x = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        radius = rng.uniform(2, 7)
+        channel[(yy - y)**2 + (xx - x)**2 <= radius**2] += rng.uniform(100, 215)
+    return np.clip(channel, 0, 255).astype(np.uint8)
+
+
+def dbscan_groups(counter, mask):
+    return counter.groupNuclei(counter.channel2points(mask))
+
+
+@pytest.mark.parametrize("eps, min_samples", PARAMS)
+@pytest.mark.parametrize("density", [0.05, 0.3, 0.6])
+def test_components_match_dbscan_on_random_masks(eps, min_samples, density):
+    counter = NucleiCounter(threshold=100, eps=eps, min_samples=min_samples)
+    for seed in range(3):
+        mask = random_mask(seed, density=density)
+        assert counter.groupNucleiComponents(mask > counter.threshold) == dbscan_groups(counter, mask)
+
+
+@pytest.mark.parametrize("eps, min_samples", PARAMS)
+def test_components_match_dbscan_on_empty_and_full_masks(eps, min_samples):
+    counter = NucleiCounter(threshold=100, eps=eps, min_samples=min_samples)
+    for mask in (np.zeros((32, 40), dtype=np.uint8), np.full((32, 40), 255, dtype=np.uint8)):
+        assert counter.groupNucleiComponents(mask > counter.threshold) == dbscan_groups(counter, mask)
+
+
+@pytest.mark.parametrize("eps, min_samples", PARAMS)
+def test_count_nuclei_matches_dbscan(eps, min_samples):
+    counter = NucleiCounter(threshold=100, eps=eps, min_samples=min_samples)
+    for seed in range(3):
+        channel = blob_channel(seed)
+        assert counter.countNuclei(channel) == counter.countNucleiDBSCAN(channel)
+
+
+def test_count_nuclei_of_uniform_channel():
+    counter = NucleiCounter()
+    channel = np.full((32, 40), 200, dtype=np.uint8)
+    assert counter.countNuclei(channel) == counter.countNucleiDBSCAN(channel) == 0